@@ -5,13 +5,39 @@
 from pathlib import Path
 import sys
 import math
-import random
+import hashlib
 import numpy as np
 import pandas as pd
 from Geometry import *
+from Information import pwarn, t_error
+from BboxTable import load_bbox_index
 
 
 
+## Bin index of every feature
+#
+# \pr{features, array like, Features to be binned.}
+# \pr{bin_array, array like, A bin array that every element specifies a left or right boundary or a bin.}
+# \rt{bin_idx, numpy array, 0 for features < first_bin_left, k for bin_array[k-1] \f$\le\f$ feature < bin_array[k],}
+#  and len(bin_array) for features beyond the last boundary.
+def bin_indices(features, bin_array):
+    bins = np.sort(np.asarray(bin_array, dtype=np.float64))
+    return np.searchsorted(bins, np.asarray(features, dtype=np.float64), side='right')
+
+## Group object indices by bins
+#
+# \pr{features, array like, Features by which objects will be binned.}
+# \pr{bin_array, array like, A bin array that every element specifies a left or right boundary or a bin.}
+# \rt{order, numpy array, Indices of binned objects sorted by feature.}
+# \rt{offsets, numpy array, Objects of bin k are order[offsets[k]:offsets[k+1]]; bins are as in \c binning_objects.}
+def bin_objects(features, bin_array):
+    features = np.asarray(features, dtype=np.float64)
+    order = np.argsort(features, kind='stable')
+    counts = np.bincount(bin_indices(features, bin_array), minlength=len(bin_array)+1)
+    offsets = np.zeros(len(bin_array)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[:-1])
+    return order[:offsets[-1]], offsets
+
 ## Bin objects into bin_array by features.
 #
 # \pr{objects, array like, Objects to be binned.}
@@ -20,54 +46,15 @@ from Geometry import *
 # \rt{result, nested list, Every sub-list is a list of objects laying in the corresponding bin.}
 #  Explicitly, the features of objects laying in a bin satisfie bin_left \f$\le\f$ feature < bin_right.
 #  The first bin contains objects whose features are \f$-\infty\f$ < feature < first_bin_left.
+#  Objects are sorted by feature in every bin; duplicate objects are all kept.
 def binning_objects(objects, features, bin_array):
-
-    objs = objects
-    ftrs = features
-    bins = sorted(bin_array)
-
-    try:
-        objs = objs.to_list()
-        ftrs = ftrs.to_list()
-        bins = bins.to_list()
-    except:
-        pass
-
-    assert len(objects)==len(features), \
+    objs = list(objects)
+    assert len(objs)==len(features), \
         t_error('The lengths of object and feature are not equal')
 
-    obj_ftr_raw  = dict(zip(objs,ftrs))
-    obj_ftr = sorted( obj_ftr_raw.items(), key=lambda item: item[1])
-    obj_ftr_it = iter(obj_ftr)
-
-    result = []
-    obj_ftr_idx = 0
-    obj_ftr_idx_max = len(obj_ftr)-1
-
-    for idx in range(len(bins)):
-        bin_result = []
-
-        if obj_ftr_idx == obj_ftr_idx_max+1:
-            result.append(bin_result)
-            continue
-
-        if idx == 0:
-            bin_left = float("-inf")
-            bin_right = bins[0]
-        else:
-            bin_left = bins[idx-1]
-            bin_right = bins[idx]
-
-        while obj_ftr_idx <= obj_ftr_idx_max:
-            if (obj_ftr[obj_ftr_idx][1] >= bin_left) and (obj_ftr[obj_ftr_idx][1] < bin_right):
-                bin_result.append(obj_ftr[obj_ftr_idx][0])
-                obj_ftr_idx += 1
-            else:
-                break
-
-        result.append(bin_result)
-
-    return result
+    order, offsets = bin_objects(features, bin_array)
+    order = order.tolist()
+    return [ [objs[i] for i in order[offsets[k]:offsets[k+1]]] for k in range(len(bin_array)) ]
 
 
 ## Normalize anchors' parameters from pixel presentations to [0,1] presentations.
@@ -127,6 +114,10 @@ def make_anchor_pyramid(anchor_scales, anchor_ratios, pos_center):
 
 ## Make all anchors given an image
 #
+# Anchors are generated in closed form by broadcasting the pyramid centers
+# against the scale-ratio sides. Identical anchor tensors are kept in memory
+# for the lifetime of the process, and are also saved to cache_dir if given,
+# so that later processes load them instead of rebuilding them.
 # \pr{input_shape, list or tuple, (img_height}
 # , img_width).
 # \pr{ratio, int, Average pixel distance between two adjacent anchors.}
@@ -135,34 +126,81 @@ def make_anchor_pyramid(anchor_scales, anchor_ratios, pos_center):
 # \pr{anchor_ratios, nested list or tuple, Every sublist of anchor_ratios is}
 # a 2-element list of the form [width, height], in which width and height satisfy
 # height\f$ \times \f$width = 1.
+# \pr{cache_dir, Path object, Optional directory for the on-disk anchor cache.}
 # \rt{anchors, nested list, The first 2 indices represent the column and}
 # row number of the anchor pyramid. The last index indicates a specific
 # anchor in the anchor pyramid. Every anchor is a list of normalized
 # [xmin, xmax, ymin, ymax]
-def make_anchors(input_shape, ratio, anchor_scales, anchor_ratios):
+def make_anchors(input_shape, ratio, anchor_scales, anchor_ratios, cache_dir=None):
+
+    key = anchor_cache_key(input_shape, ratio, anchor_scales, anchor_ratios)
+    if key in _anchor_cache:
+        return _anchor_cache[key].copy()
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = Path(cache_dir).joinpath(f'anchors_{key}.npy')
+        if cache_file.exists():
+            anchors = np.load(cache_file)
+            _anchor_cache[key] = anchors
+            return anchors.copy()
+
+    anchors = calc_anchors(input_shape, ratio, anchor_scales, anchor_ratios)
+    _anchor_cache[key] = anchors
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        np.save(cache_file, anchors)
+
+    return anchors.copy()
+
+_anchor_cache = {}
+
+## Make a hashable key that identifies an anchor grid
+#
+# \pr{input_shape, list or tuple, (img_height}
+# , img_width).
+# \pr{ratio, int, Average pixel distance between two adjacent anchors.}
+# \pr{anchor_scales, list or tuple, Anchor scales.}
+# \pr{anchor_ratios, nested list or tuple, Anchor ratios.}
+# \rt{key, str, A short sha1 digest of all anchor parameters.}
+def anchor_cache_key(input_shape, ratio, anchor_scales, anchor_ratios):
+    params = (tuple(int(n) for n in input_shape[:2]), float(ratio),\
+                tuple(float(scale) for scale in anchor_scales),\
+                tuple(tuple(float(side) for side in xy_set) for xy_set in anchor_ratios))
+    return hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+
+## Calculate all anchors given an image without any caching
+#
+# The arguments are the same as \c make_anchors.
+# \rt{anchors, numpy array, Anchors of shape (row number}
+# , col number, num_anchors, 4) in float32.
+def calc_anchors(input_shape, ratio, anchor_scales, anchor_ratios):
 
-    # Calculate the shape of the anchor map
-    num_anchors = len(anchor_scales) * len(anchor_ratios)
     img_height = input_shape[0]
     img_width = input_shape[1]
-    num_row_anchor = img_height/ratio
-    num_col_anchor = img_width/ratio
-    num_row_anchor = int(num_row_anchor)
-    num_col_anchor = int(num_col_anchor)
+    num_row_anchor = int(img_height/ratio)
+    num_col_anchor = int(img_width/ratio)
 
-    # register memory for anchors
-    anchors = np.zeros(shape=(num_row_anchor, num_col_anchor, num_anchors, 4), dtype=np.float32)
+    # pyramid centers; the first row of anchors lays at the top of the image
+    x_centers = np.arange(num_col_anchor)*ratio/img_width
+    y_centers = 1 - np.arange(num_row_anchor)*ratio/img_height
 
-    # fill in data to empty arrays
-    num_anchor_area = num_row_anchor * num_col_anchor
-    for i in range(num_row_anchor):
-        for j in range(num_col_anchor):
-            x_center = j*ratio/img_width
-            y_center = 1 - i*ratio/img_height
-            pos_center = (x_center, y_center)
-            anchors[i][j] = make_anchor_pyramid(anchor_scales, anchor_ratios, pos_center)
+    # half sides of every anchor in a pyramid, ordered by scale then ratio
+    scales = np.asarray(anchor_scales, dtype=np.float64)
+    sides = np.asarray(anchor_ratios, dtype=np.float64)
+    half_widths = (scales[:,None]*sides[None,:,0]).reshape(-1)/2
+    half_heights = (scales[:,None]*sides[None,:,1]).reshape(-1)/2
 
-    return anchors
+    x = x_centers[None,:,None]
+    y = y_centers[:,None,None]
+    shape = (num_row_anchor, num_col_anchor, len(half_widths))
+    anchors = np.stack([np.broadcast_to(x-half_widths, shape),\
+                        np.broadcast_to(x+half_widths, shape),\
+                        np.broadcast_to(y-half_heights, shape),\
+                        np.broadcast_to(y+half_heights, shape)], axis=-1)
+
+    return anchors.astype(np.float32)
 
 ## Create an empty score-bbox reference map
 #
@@ -265,57 +303,54 @@ def make_label_map(score_bbox_map, lim_lo, lim_up):
 # \pr{nWant, int, Minimum number of valid (positive or negative) anchors. If a }
 # label map has less than nWant valid anchors, the function will continue but
 # throw a warning.
-# \rt{samples, nested list, Randomlly sampled label map. Masked anchors won't be
+# \pr{rng, object, np.random or a numpy Generator, e.g. from \c window_rng.}
+# \rt{samples, numpy array, Randomlly sampled label map. Masked anchors won't be
 # used in backpropagation.}
-def sample_label_map(label_map, posCut, nWant):
-    (iNum, jNum, kNum) = label_map.shape
-    samples = np.zeros(shape=(iNum, jNum, kNum))
-    samples[:] = np.nan
-
-    negNum = 0
-    posNum = 0
-    neg_index_list = []
-    pos_index_list = []
+def sample_label_map(label_map, posCut, nWant, rng=np.random):
+    label_map = np.asarray(label_map)
+    samples = np.full(shape=label_map.shape, fill_value=np.nan)
 
-    for i in range(iNum):
-        for j in range(jNum):
-            for k in range(kNum):
-                if label_map[i][j][k] == 0:
-                    negNum += 1
-                    neg_index_list.append([i,j,k])
-                elif label_map[i][j][k] == 1:
-                    posNum += 1
-                    pos_index_list.append([i,j,k])
-                else:
-                    pass
+    neg_index = np.flatnonzero(label_map == 0)
+    pos_index = np.flatnonzero(label_map == 1)
+    negNum = len(neg_index)
+    posNum = len(pos_index)
 
     totNum = negNum + posNum
     if totNum < nWant: # extreme case which may never happen
-        neg_index_selected_list = neg_index_list
-        pos_index_selected_list = pos_index_list
-        pwarn(f'Extreme case detected in sampling label maps, negNum: {megNum}; posNum: {posNum}')
+        neg_index_selected = neg_index
+        pos_index_selected = pos_index
+        pwarn(f'Extreme case detected in sampling label maps, negNum: {negNum}; posNum: {posNum}')
     elif posNum < posCut:
-        # pdebug('Hello')
         neg_want = nWant-posNum
-        neg_index_selected_list = random.sample(neg_index_list, neg_want)
-        pos_index_selected_list = pos_index_list
+        neg_index_selected = rng.choice(neg_index, neg_want, replace=False)
+        pos_index_selected = pos_index
     elif posNum < negNum:
         neg_want = posNum
-        neg_index_selected_list = random.sample(neg_index_list, neg_want)
-        pos_index_selected_list = pos_index_list
+        neg_index_selected = rng.choice(neg_index, neg_want, replace=False)
+        pos_index_selected = pos_index
     else:
         pos_want = negNum
-        neg_index_selected_list = neg_index_list
-        pos_index_selected_list = random.sample(pos_index_list, pos_want)
+        neg_index_selected = neg_index
+        pos_index_selected = rng.choice(pos_index, pos_want, replace=False)
 
-    for i, j, k in pos_index_selected_list:
-        samples[i][j][k] = 1
-
-    for i, j, k in neg_index_selected_list:
-        samples[i][j][k] = 0
+    samples.flat[pos_index_selected] = 1
+    samples.flat[neg_index_selected] = 0
 
     return samples
 
+## Make a random generator for a window
+#
+# The stream only depends on the seed, the window id and the epoch, so a
+# window is sampled the same way no matter which process handles it or in
+# what order.
+# \pr{window_id, int, Id of the window, e.g. from \c Raster.image_index.}
+# \pr{seed, int, Seed shared by all windows of a run.}
+# \pr{epoch, int, Training epoch for windows resampled every epoch; None otherwise.}
+# \rt{rng, numpy Generator, The random generator of the window.}
+def window_rng(window_id, seed=0, epoch=None):
+    entropy = [seed, window_id] if epoch is None else [seed, window_id, epoch]
+    return np.random.default_rng(np.random.SeedSequence(entropy))
+
 ## Calculate delta given an anchor and a bounding box
 #
 # Return [tx, ty, tw, th] defined in the original paper.
@@ -374,6 +409,93 @@ def make_delta_map(score_bbox_map, lim_up, anchors):
 
     return delta_map
 
+## Score every anchor against all bounding boxes of an image at once.
+#
+# This is the vectorized counterpart of \c make_score_bbox_map and
+# \c update_score_bbox_map. The full anchors-by-bboxes IoU matrix is computed
+# in one shot, and every anchor keeps the first bbox that reaches its maximum IoU.
+# \pr{anchors, numpy array, Normalized anchors of shape (iNum}
+# , jNum, kNum, 4) made by \c make_anchors.
+# \pr{bboxes, array like, Normalized bboxes of the image. Every bbox is [xmin}
+# , xmax, ymin, ymax].
+# \rt{score_map, 3-D numpy array, The highest IoU of every anchor in float32.}
+# \rt{bbox_map, 4-D numpy array, The bbox that every anchor matches best in}
+# float32. Anchors overlapping no bbox are filled with nan.
+def score_anchors(anchors, bboxes):
+    anchor_3d_shape = anchors.shape[:3]
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+
+    score_map = np.zeros(shape=anchor_3d_shape, dtype=np.float32)
+    bbox_map = np.full(shape=anchor_3d_shape+(4,), fill_value=np.nan, dtype=np.float32)
+    if len(bboxes) == 0:
+        return score_map, bbox_map
+
+    ious = iou_matrix(anchors.reshape(-1, 4), bboxes)
+    bbox_idx = ious.argmax(axis=1)
+    scores = ious[np.arange(len(bbox_idx)), bbox_idx]
+    matched = scores > 0
+
+    score_map[:] = scores.reshape(anchor_3d_shape)
+    bbox_map.reshape(-1, 4)[matched] = bboxes[bbox_idx[matched]]
+    return score_map, bbox_map
+
+## Generate a label map from a dense score map.
+#
+# The vectorized counterpart of \c make_label_map. Labels follow the same rule
+# as \c label_anchor.
+# \pr{score_map, 3-D numpy array, The score map made by \c score_anchors.}
+# \pr{lim_lo, float, The lower limit of the score range in which anchors should be masked.}
+# \pr{lim_up, float, The upper limit of the score range in which anchors should be masked.}
+# \rt{label_map, 3-D numpy array, A float32 label map of 0, 1 and nan.}
+def make_label_map_by_scores(score_map, lim_lo, lim_up):
+    label_map = np.full(shape=score_map.shape, fill_value=np.nan, dtype=np.float32)
+    label_map[score_map < lim_lo] = 0
+    label_map[score_map > lim_up] = 1
+    return label_map
+
+## Calculate deltas given arrays of anchors and bounding boxes
+#
+# The vectorized counterpart of \c calc_delta.
+# \pr{anchors, numpy array, An array of normalized [xmin}
+# , xmax, ymin, ymax] with shape (n, 4).
+# \pr{bboxes, numpy array, An array of normalized [xmin}
+# , xmax, ymin, ymax] with shape (n, 4).
+# \rt{deltas, numpy array, Calculated [tx}
+# , ty, tw, th] with shape (n, 4).
+def calc_deltas(anchors, bboxes):
+    gx = (bboxes[:,0] + bboxes[:,1])/2
+    gy = (bboxes[:,2] + bboxes[:,3])/2
+    gw = bboxes[:,1]-bboxes[:,0]
+    gh = bboxes[:,3]-bboxes[:,2]
+    xa = (anchors[:,0] + anchors[:,1])/2
+    ya = (anchors[:,2] + anchors[:,3])/2
+    wa = anchors[:,1]-anchors[:,0]
+    ha = anchors[:,3]-anchors[:,2]
+
+    tx = (gx-xa)/wa
+    ty = (gy-ya)/ha
+    tw = np.log(gw/wa)
+    th = np.log(gh/ha)
+
+    return np.stack([tx, ty, tw, th], axis=-1)
+
+## Generate a delta map from dense score and bbox maps.
+#
+# The vectorized counterpart of \c make_delta_map.
+# \pr{score_map, 3-D numpy array, The score map made by \c score_anchors.}
+# \pr{bbox_map, 4-D numpy array, The bbox map made by \c score_anchors.}
+# \pr{lim_up, float, The upper limit of the score range in which an anchor will be masked.}
+# \pr{anchors, numpy array, Normalized anchors of shape (iNum}
+# , jNum, kNum, 4).
+# \rt{delta_map, 3-D numpy array, A float32 delta map of shape (iNum}
+# , jNum, kNum*4), in which every anchor above lim_up is assigned a delta.
+def make_delta_map_by_scores(score_map, bbox_map, lim_up, anchors):
+    (iNum, jNum, kNum) = score_map.shape
+    delta_map = np.full(shape=(iNum, jNum, kNum, 4), fill_value=np.nan, dtype=np.float32)
+    mask = score_map > lim_up
+    delta_map[mask] = calc_deltas(anchors[mask].astype(np.float64), bbox_map[mask].astype(np.float64))
+    return delta_map.reshape(iNum, jNum, kNum*4)
+
 ## Make a dictionary in which keys are img names and items are bboxes in the img.
 # If an image is skipped (exists in img_dir but not in returned img_bbox_dict),
 # there is no track in the image, which is possible due
@@ -381,25 +503,44 @@ def make_delta_map(score_bbox_map, lim_up, anchors):
 #
 # \pr{img_dir, Path object, A directory that has training images.}
 # \pr{bbox_file, Path object, A csv file that each line represents a bbox.}
+# \pr{use_cache, bool, Use the binary index next to the csv file, see \c BboxTable.}
 # \rt{img_bbox_dict, dict, A dictionary in which keys are img names and items are bboxes in the img.}
-def make_img_bbox_dict(img_dir, bbox_file):
-
-    df = pd.read_csv(bbox_file, index_col=0)
+def make_img_bbox_dict(img_dir, bbox_file, use_cache=True):
 
-    img_names = df['FileName'].unique()
+    index = load_bbox_index(bbox_file, use_cache)
+    bboxes = index.bboxes.tolist()
+    img_bbox_dict = { img : bboxes[index.offsets[i]:index.offsets[i+1]]\
+                        for i, img in enumerate(index.names.tolist()) }
 
-    img_bbox_dict = {img : [] for img in img_names}
-    def add_data(row):
-        img_name = row.at['FileName']
-        xmin = row.at['XMin']
-        xmax = row.at['XMax']
-        ymin = row.at['YMin']
-        ymax = row.at['YMax']
-        img_bbox_dict[img_name].append([xmin,xmax,ymin,ymax])
+    return img_bbox_dict
 
-    df.apply(add_data, axis=1)
+## Make per-image bbox arrays from a bbox table
+#
+# The array counterpart of \c make_img_bbox_dict. Bboxes of an image are a
+# contiguous slice of one float32 array of the whole table.
+# \pr{bbox_file, Path object, A csv file that each line represents a bbox.}
+# \pr{use_cache, bool, Use the binary index next to the csv file, see \c BboxTable.}
+# \rt{img_bbox_dict, dict, {img name: float32 bboxes [xmin, xmax, ymin, ymax] of shape (n, 4)}.}
+# \rt{img_class_dict, dict, {img name: int64 class ids of shape (n,)}. All ids}
+# are 0 if the table has no ClassName column.
+# \rt{classes, numpy array, Class names in the order they first appear; a class id indexes it.}
+def make_img_bbox_arrays(bbox_file, use_cache=True):
+    index = load_bbox_index(bbox_file, use_cache)
+    bboxes = np.ascontiguousarray(index.bboxes, dtype=np.float32)
+    if 'ClassName' in index.columns:
+        class_ids, classes = pd.factorize(index.columns['ClassName'])
+        class_ids = class_ids.astype(np.int64)
+        classes = np.asarray(classes)
+    else:
+        class_ids = np.zeros(len(bboxes), dtype=np.int64)
+        classes = np.array([])
 
-    return img_bbox_dict
+    img_bbox_dict, img_class_dict = {}, {}
+    for i, img in enumerate(index.names.tolist()):
+        rows = slice(index.offsets[i], index.offsets[i+1])
+        img_bbox_dict[img] = bboxes[rows]
+        img_class_dict[img] = class_ids[rows]
+    return img_bbox_dict, img_class_dict, classes
 
 ## Given a delta, it tells an anchor what shape it should be.
 #
@@ -444,17 +585,165 @@ def translate_delta(anchor, delta):
 
 def propose_score_bbox_list(anchors, score_map, delta_map):
 
-    # print(score_map.dtype)
-    (iNum, jNum, kNum) = score_map.shape
-
-    score_bbox_list = []
-    threshold = 0.5
-    for i, j, k in np.ndindex((score_map.shape)):
-        score = score_map[i,j,k]
-        if score > threshold:
-            anchor = anchors[i][j][k]
-            delta = delta_map[i,j,4*k:4*k+4]
-            bbox = translate_delta(anchor, delta)
-            score_bbox_list.append([score, bbox])
+    scores, bboxes, offsets = decode_rpn_outputs(anchors, score_map, delta_map, clip=False)
+    score_bbox_list = [ [score, bbox] for score, bbox in zip(scores, bboxes.tolist()) ]
 
     return score_bbox_list
+
+## Decode RPN outputs of a batch of images into scored bboxes
+#
+# Boxes come out in the order of np.ndindex over (image, i, j, k), the same
+# order as propose_score_bbox_list.
+#
+# \pr{anchors, numpy array, Normalized anchors of shape (i, j, k, 4) from \c make_anchors.}
+# \pr{score_maps, numpy array, RPN scores of shape (N, i, j, k) or (i, j, k).}
+# \pr{delta_maps, numpy array, RPN deltas of shape (N, i, j, 4k) or (i, j, 4k).}
+# \pr{threshold, float, Only anchors whose score > threshold are decoded.}
+# \pr{clip, bool, Clip bboxes to the image, i.e. [0, 1].}
+# \rt{scores, numpy array, Scores of the proposals, shape (M,).}
+# \rt{bboxes, numpy array, float64 [xmin, xmax, ymin, ymax] of the proposals, shape (M, 4).}
+# \rt{offsets, numpy array, Proposals of the n-th image are offsets[n]:offsets[n+1].}
+def decode_rpn_outputs(anchors, score_maps, delta_maps, threshold=0.5, clip=True):
+    anchors = np.asarray(anchors)
+    score_maps = np.asarray(score_maps)
+    delta_maps = np.asarray(delta_maps)
+    if score_maps.ndim == 3:
+        score_maps = score_maps[np.newaxis]
+        delta_maps = delta_maps[np.newaxis]
+    imgNum = score_maps.shape[0]
+
+    img_idx, i, j, k = np.nonzero(score_maps > threshold)
+    scores = score_maps[img_idx, i, j, k]
+    deltas = delta_maps.reshape(delta_maps.shape[:3]+(-1,4))[img_idx, i, j, k].astype(np.float64)
+    anchor = anchors[i, j, k].astype(np.float64)
+
+    xa = (anchor[:,0]+anchor[:,1])/2
+    ya = (anchor[:,2]+anchor[:,3])/2
+    wa = anchor[:,1]-anchor[:,0]
+    ha = anchor[:,3]-anchor[:,2]
+
+    x = deltas[:,0]*wa+xa
+    y = deltas[:,1]*ha+ya
+    w = np.exp(deltas[:,2])*wa
+    h = np.exp(deltas[:,3])*ha
+
+    bboxes = np.stack([x-w/2, x+w/2, y-h/2, y+h/2], axis=1)
+    if clip:
+        bboxes[:,0] = np.maximum(bboxes[:,0], 0)
+        bboxes[:,1] = np.minimum(bboxes[:,1], 1)
+        bboxes[:,2] = np.maximum(bboxes[:,2], 0)
+        bboxes[:,3] = np.minimum(bboxes[:,3], 1)
+
+    offsets = np.zeros(imgNum+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(img_idx, minlength=imgNum))
+    return scores, bboxes, offsets
+
+## Sort proposals into positive and negative examples for the detector
+#
+# Every proposal is matched to the first reference bbox that reaches its
+# highest IoU, the same as looping with \c iou.
+# \pr{proposals, numpy array, Proposed bboxes of an image with shape (m, 4).}
+# \pr{bboxes, numpy array, Reference bboxes of the image with shape (n, 4).}
+# \pr{pos_lim, float, Proposals whose highest IoU > pos_lim are positive.}
+# \pr{neg_lim, float, Other proposals whose highest IoU > neg_lim are negative.}
+# \pr{skip, numpy array, Optional boolean mask of reference bboxes. Proposals matched to them are dropped.}
+# \rt{pos_idx, numpy array, Indexes of the positive proposals.}
+# \rt{neg_idx, numpy array, Indexes of the negative proposals.}
+# \rt{ref_idx, numpy array, Index of the matched reference bbox of every proposal.}
+def assign_proposals(proposals, bboxes, pos_lim=0.5, neg_lim=0.0, skip=None):
+    ious = iou_matrix(proposals, bboxes)
+    if ious.shape[1] == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(ious.shape[0], dtype=np.int64)
+    ref_idx = ious.argmax(axis=1)
+    iou_highest = ious[np.arange(len(ref_idx)), ref_idx]
+
+    keep = iou_highest > 0
+    if skip is not None:
+        keep &= ~np.asarray(skip, dtype=bool)[ref_idx]
+    pos_idx = np.flatnonzero(keep & (iou_highest > pos_lim))
+    neg_idx = np.flatnonzero(keep & (iou_highest <= pos_lim) & (iou_highest > neg_lim))
+    return pos_idx, neg_idx, ref_idx
+
+## Sample RoIs from positive and negative examples
+#
+# If there are fewer examples than roiNum, all examples are repeated and the
+# remainder is sampled without replacement. Otherwise, at most negThreshold
+# negative examples are taken unless there are not enough positive ones.
+# \pr{posNum, int, Number of positive examples.}
+# \pr{negNum, int, Number of negative examples.}
+# \pr{roiNum, int, Number of RoIs per image.}
+# \pr{negThreshold, int, The wanted number of negative examples.}
+# \pr{rng, object, np.random or a numpy Generator.}
+# \rt{selected, numpy array, Shuffled indexes into the positive examples followed}
+# by the negative examples, with shape (roiNum,).
+def sample_rois(posNum, negNum, roiNum, negThreshold, rng=np.random):
+    totNum = posNum + negNum
+    if totNum == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if totNum < roiNum:
+        repNum = roiNum//totNum
+        rest = rng.choice(totNum, roiNum-repNum*totNum, replace=False)
+        selected = np.concatenate([np.tile(np.arange(totNum), repNum), rest])
+    else:
+        if negNum < negThreshold:
+            negWant = negNum
+            posWant = roiNum - negWant
+        elif (negThreshold + posNum) >= roiNum:
+            negWant = negThreshold
+            posWant = roiNum - negThreshold
+        else:
+            posWant = posNum
+            negWant = roiNum - posWant
+        selected = np.concatenate([rng.choice(posNum, posWant, replace=False),\
+                                    posNum+rng.choice(negNum, negWant, replace=False)])
+
+    return rng.permutation(selected).astype(np.int64)
+
+## Make the training targets of the detector for an image
+#
+# \pr{proposals, numpy array, Proposed bboxes of the image with shape (m, 4).}
+# \pr{bboxes, numpy array, Reference bboxes of the image with shape (n, 4).}
+# \pr{class_idx, numpy array, One-hot index of every reference bbox; 0 is background.}
+# \pr{classNum, int, Length of the one-hot vectors, background included.}
+# \pr{roiNum, int, Number of RoIs per image.}
+# \pr{negThreshold, int, The wanted number of negative examples.}
+# \pr{pos_lim, float, See \c assign_proposals.}
+# \pr{neg_lim, float, See \c assign_proposals.}
+# \pr{skip, numpy array, See \c assign_proposals.}
+# \pr{rng, object, np.random or a numpy Generator.}
+# \rt{rois, numpy array, RoIs (x, y, w, h) with (x, y) the upper left corner, shape (roiNum, 4).}
+# \rt{y_classifier, numpy array, One-hot labels with shape (roiNum, classNum).}
+# \rt{y_regressor, numpy array, Reference bboxes (x, y, w, h) in the slot of}
+# the label, with shape (roiNum, classNum*4). Other slots are nan.
+# \rt{posNum, int, Number of positive proposals before sampling.}
+def make_detector_targets(proposals, bboxes, class_idx, classNum, roiNum, negThreshold,\
+                            pos_lim=0.5, neg_lim=0.0, skip=None, rng=np.random):
+    proposals = np.asarray(proposals, dtype=np.float64).reshape(-1, 4)
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    class_idx = np.asarray(class_idx, dtype=np.int64)
+
+    rois = np.full(shape=(roiNum, 4), fill_value=np.nan, dtype=np.float32)
+    y_classifier = np.full(shape=(roiNum, classNum), fill_value=np.nan, dtype=np.float32)
+    y_regressor = np.full(shape=(roiNum, classNum, 4), fill_value=np.nan, dtype=np.float32)
+
+    pos_idx, neg_idx, ref_idx = assign_proposals(proposals, bboxes, pos_lim, neg_lim, skip)
+    sample = sample_rois(len(pos_idx), len(neg_idx), roiNum, negThreshold, rng)
+    selected = np.concatenate([pos_idx, neg_idx])[sample]
+    labels = np.concatenate([class_idx[ref_idx[pos_idx]],\
+                                np.zeros(len(neg_idx), dtype=np.int64)])[sample]
+    n = len(selected)
+
+    # proposal t = (x, y, w, h) as indicated in the original paper
+    # (x,y) is the left upper corner
+    p = proposals[selected]
+    rois[:n] = np.stack([p[:,0], p[:,3], p[:,1]-p[:,0], p[:,3]-p[:,2]], axis=1)
+
+    y_classifier[:n] = np.identity(classNum, dtype=np.float32)[labels]
+
+    # negative examples also record their matched bbox, in the background slot
+    r = bboxes[ref_idx[selected]]
+    y_regressor[np.arange(n), labels] = np.stack([r[:,0], r[:,3], r[:,1]-r[:,0], r[:,3]-r[:,2]], axis=1)
+
+    return rois, y_classifier, y_regressor.reshape(roiNum, classNum*4), len(pos_idx)
@@ -0,0 +1,138 @@
+## @package BboxTable
+#
+# Binary image -> bbox index of bbox tables.
+#
+# A bbox table is a CSV file whose rows are bboxes with FileName, XMin, XMax,
+# YMin and YMax columns. Its index is an .npz file next to it holding the
+# bboxes grouped by image, so scripts can look up the bboxes of an image
+# without parsing the CSV or filtering it per image. The index records the
+# size and modification time of the CSV and is rebuilt when they change.
+
+from pathlib import Path
+import os
+
+import numpy as np
+import pandas as pd
+
+from Information import pwarn
+
+index_version = 1
+# columns grouped along with the bboxes when a table has them
+extra_columns = ['ClassName', 'Score']
+
+class BboxIndex:
+    """ Bboxes of a bbox table grouped by image
+
+    # Constructor parameters
+        names (numpy array) -- image names in the order they first appear in the table
+        offsets (numpy array) -- bboxes of names[i] are rows offsets[i]:offsets[i+1]
+        bboxes (numpy array) -- float64 [xmin, xmax, ymin, ymax] of shape (n, 4)
+        columns (dict) -- other grouped columns, e.g. 'ClassName' and 'Score'
+    """
+    def __init__(self, names, offsets, bboxes, columns):
+        self.names = names
+        self.offsets = offsets
+        self.bboxes = bboxes
+        self.columns = columns
+        self.positions = { name: i for i, name in enumerate(names.tolist()) }
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, img_name):
+        return img_name in self.positions
+
+    ## Rows of an image; an unknown image has no rows
+    def rows(self, img_name):
+        i = self.positions.get(img_name)
+        if i is None:
+            return slice(0, 0)
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    ## Bboxes, or another column, of an image
+    def get(self, img_name, column=None):
+        if column is None:
+            return self.bboxes[self.rows(img_name)]
+        return self.columns[column][self.rows(img_name)]
+
+## Group a bbox table by image
+#
+# \pr{df, DataFrame, A bbox table.}
+# \rt{index, BboxIndex, The bboxes grouped by image in stable order.}
+def build_bbox_index(df):
+    codes, names = pd.factorize(df['FileName'], sort=False)
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(names))
+    offsets = np.zeros(len(names)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    bboxes = df[['XMin', 'XMax', 'YMin', 'YMax']].to_numpy(dtype=np.float64)[order]
+    columns = {}
+    for name in extra_columns:
+        if name in df.columns:
+            column = df[name].to_numpy()[order]
+            if column.dtype == object:
+                column = column.astype(str)
+            columns[name] = column
+    return BboxIndex(np.asarray(names, dtype=str), offsets, bboxes, columns)
+
+## Path of the index of a bbox table
+def bbox_index_file(bbox_file):
+    bbox_file = Path(bbox_file)
+    return bbox_file.with_suffix('.index.npz')
+
+def _stamp(bbox_file):
+    stat = os.stat(bbox_file)
+    return np.array([index_version, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+## Save the index of a bbox table
+#
+# \pr{index, BboxIndex, The index.}
+# \pr{bbox_file, Path object, The CSV file the index describes.}
+def save_bbox_index(index, bbox_file):
+    file = bbox_index_file(bbox_file)
+    tmp_file = file.with_name(file.name+'.tmp.npz')
+    arrays = {'col_'+name: column for name, column in index.columns.items()}
+    np.savez(tmp_file, stamp=_stamp(bbox_file), names=index.names,\
+                offsets=index.offsets, bboxes=index.bboxes, **arrays)
+    os.replace(tmp_file, file)
+
+## Read the index of a bbox table
+#
+# \rt{index, BboxIndex, The index, or None if it is missing or older than the CSV.}
+def read_bbox_index(bbox_file):
+    file = bbox_index_file(bbox_file)
+    if not file.exists():
+        return None
+    with np.load(file) as data:
+        if not np.array_equal(data['stamp'], _stamp(bbox_file)):
+            return None
+        columns = { key[4:]: data[key] for key in data.files if key.startswith('col_') }
+        return BboxIndex(data['names'], data['offsets'], data['bboxes'], columns)
+
+## Load the image -> bbox index of a bbox table
+#
+# \pr{bbox_file, Path object, A CSV bbox table.}
+# \pr{use_cache, bool, Read and write the .npz index next to the CSV; if it}
+# cannot be written, e.g. next to a read-only table, the index is only kept in memory.
+# \rt{index, BboxIndex, The bboxes of the table grouped by image.}
+def load_bbox_index(bbox_file, use_cache=True):
+    if use_cache:
+        index = read_bbox_index(bbox_file)
+        if index is not None:
+            return index
+    index = build_bbox_index(pd.read_csv(bbox_file, index_col=None))
+    if use_cache:
+        try:
+            save_bbox_index(index, bbox_file)
+        except OSError as e:
+            pwarn(f'Cannot write the bbox index of {bbox_file}: {e}')
+    return index
+
+## Write a bbox table and its index
+#
+# \pr{df, DataFrame, The bbox table.}
+# \pr{bbox_file, Path object, Destination CSV file.}
+def write_bbox_table(df, bbox_file):
+    df.to_csv(bbox_file)
+    save_bbox_index(build_bbox_index(df), bbox_file)
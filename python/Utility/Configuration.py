@@ -43,6 +43,7 @@ class frcnn_config:
         # parameters shared by both modes
         self.window = None # =sampling time in mode 1; trackNum in mode 2
         self.resolution = None
+        self.input_channels = 4 # 4 for RGBA images; 1 for the hit occupancy only
 
         ## raw data location information
         self.train_img_dir = None
@@ -163,22 +164,37 @@ class frcnn_config:
     def set_resolution(self, resolution):
         self.resolution = resolution
 
+    def set_input_channels(self, channels):
+        assert channels in [1, 4], \
+            t_error('Input images have either 4 (RGBA) or 1 (occupancy) channels')
+        self.input_channels = channels
+
     def set_raw_training_data(self, bbox_file, img_dir):
         import pandas as pd
         import cv2
+        from Storage import is_shard_store, ShardReader
+        self.train_bbox_reference_file = bbox_file
+        self.train_img_dir = img_dir
+        # every record of an image store has the same shape
+        if is_shard_store(img_dir):
+            self.input_shape = ShardReader(img_dir).record_shape
+            return
         df = pd.read_csv(bbox_file,index_col=0)
         img_names = df['FileName'].unique()
         files = [str(img_dir.joinpath(img)) for img in img_names]
         files_itr = iter(files)
         shape = cv2.imread(next(files_itr),cv2.IMREAD_UNCHANGED).shape
+        # single-channel PNGs are read without a channel axis
+        if len(shape) == 2:
+            shape = shape+(1,)
         for i in range(1,len(files)):
             shape_new = cv2.imread(next(files_itr), cv2.IMREAD_UNCHANGED).shape
+            if len(shape_new) == 2:
+                shape_new = shape_new+(1,)
             if shape_new != shape:
                 print("[ERROR] Training images' shapes are not consistent")
                 raise ValueError
         self.input_shape = shape
-        self.train_bbox_reference_file = bbox_file
-        self.train_img_dir = img_dir
         return
 
     def set_raw_validation_data(self, bbox_file, img_dir):
@@ -335,6 +351,8 @@ class extractor_config:
         self.Y_train_dir = None
         self.X_val_dir = None
         self.Y_val_dir = None
+        # 'onehot' (res, res, 3) float truths or 'index' (res, res) uint8 class indices
+        self.target_format = 'onehot'
 
         # max length for input_arrays
         self.sequence_max_length = None
@@ -391,6 +409,11 @@ class extractor_config:
         self.X_val_dir = val_x_dir
         self.Y_val_dir = val_y_dir
 
+    def set_target_format(self, target_format):
+        assert target_format in ['onehot', 'index'], \
+            t_error("Extractor truths are either 'onehot' or 'index'")
+        self.target_format = target_format
+
     def set_max_length(self, length):
         self.sequence_max_length = length
 
@@ -1,154 +1,464 @@
 from pathlib import Path
+import threading
+import timeit
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import PIL.Image
 from tensorflow.keras.utils import Sequence
 
+from Storage import is_shard_store, open_store
+from Statistics import dataset_stats
+from Abstract import make_img_bbox_arrays, score_anchors, window_rng
+from Raster import image_index, open_images, read_image
+from Preprocess import rpn_targets
+from Information import *
+
+## Open the records of a data directory
+#
+# \pr{dir, Path object, Either a directory of one-.npy-per-sample files or a}
+# store made by Storage.ShardWriter or Storage.SparseWriter.
+# \rt{records, list or store reader, The record source for \c load_records.}
+def open_records(dir):
+    if is_shard_store(dir):
+        return open_store(dir)
+    return [child for child in dir.iterdir()]
+
+## Load a batch of records as one array
+#
+# Scaled and sparse stores are expanded to float32 here, so uint8 images
+# come out normalized and sparse maps come out as dense NaN-filled maps.
+# Integer records, e.g. class-index targets, keep their dtype.
+# \pr{records, list or store reader, A record source made by \c open_records.}
+# \pr{indexes, array like, Indexes of the records in the batch.}
+# \pr{out, numpy array, Optional preallocated buffer that is filled in place.}
+# \rt{batch, numpy array, Records stacked along the first axis.}
+def load_records(records, indexes, out=None):
+    if out is None:
+        out = np.empty(shape=(len(indexes),)+record_shape(records), dtype=record_dtype(records))
+    if not isinstance(records, list):
+        return records.take(indexes, out=out)
+    for i, k in enumerate(indexes):
+        out[i] = np.load(records[k])
+    return out
+
+## Get the shape of a single record
+#
+# \pr{records, list or store reader, A record source made by \c open_records.}
+# \rt{shape, tuple, The shape of every record in the source.}
+def record_shape(records):
+    if not isinstance(records, list):
+        return records.record_shape
+    return np.load(records[0], mmap_mode='r').shape
+
+## Get the dtype records are loaded as
+#
+# \pr{records, list or store reader, A record source made by \c open_records.}
+# \rt{dtype, numpy dtype, The integer dtype of integer records, float32 otherwise.}
+def record_dtype(records):
+    if not isinstance(records, list):
+        dtype = records.dtype
+    else:
+        dtype = np.load(records[0], mmap_mode='r').dtype
+    if np.issubdtype(dtype, np.integer):
+        return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+class BatchPrefetcher:
+    """ Reads batches ahead in a thread pool
+
+    # Constructor parameters
+        sources (list) -- record sources made by open_records
+        batch_indexes (function) -- maps a batch index to its record indexes
+        num_batches (int) -- number of batches in an epoch
+        batch_size (int) -- number of records in a batch
+        workers (int) -- number of loading threads
+        depth (int) -- maximum number of batches read ahead
+        fill (function) -- fill(indexes, buffers) makes a batch in place;
+          by default every source is read into its buffer
+        shapes (list) -- record shapes of the buffers; by default the
+          record shapes of the sources
+
+    Batches are filled in place into a ring of preallocated buffers, float32
+    unless a source holds integer records, and every returned batch is a
+    copy, so batches queued by Keras are never overwritten by a refill.
+    Batches are read ahead assuming sequential access; a request for a
+    batch that was not read ahead is loaded on the calling thread. The
+    generators shuffle their record indexes in on_epoch_end, so they must
+    be passed to model.fit with shuffle=False; with shuffle=True Keras
+    requests batches in random order and nothing read ahead is used.
+    """
+    def __init__(self, sources, batch_indexes, num_batches, batch_size,\
+                    workers=2, depth=4, fill=None, shapes=None):
+        self.sources = sources
+        self.fill = fill if fill is not None else self.__load
+        self.batch_indexes = batch_indexes
+        self.num_batches = num_batches
+        self.depth = depth
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        if shapes is None:
+            shapes = [record_shape(source) for source in sources]
+            dtypes = [record_dtype(source) for source in sources]
+        else:
+            dtypes = [np.float32]*len(shapes)
+        shapes = [(batch_size,)+tuple(shape) for shape in shapes]
+        self.free = [ [np.empty(shape=shape, dtype=dtype) for shape, dtype in zip(shapes, dtypes)]\
+                        for _ in range(depth+1) ]
+        self.pending = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = 0
+        self.hits = 0
+        self.stall_time = 0.0
+        self.depth_sum = 0
+
+    ## Statistics since the last reset_stats()
+    #
+    # \rt{stats, dict, Request count, prefetch hit rate, mean queue depth}
+    # seen by requests, and total/mean time spent waiting for data.
+    def stats(self):
+        requests = max(self.requests, 1)
+        return {'requests': self.requests,\
+                'hit_rate': self.hits/requests,\
+                'mean_queue_depth': self.depth_sum/requests,\
+                'stall_time': self.stall_time,\
+                'mean_stall_time': self.stall_time/requests}
+
+    def __load(self, indexes, buffers):
+        for source, buffer in zip(self.sources, buffers):
+            load_records(source, indexes, out=buffer[:len(indexes)])
+
+    def __fill(self, indexes, buffers):
+        self.fill(indexes, [buffer[:len(indexes)] for buffer in buffers])
+        return buffers
+
+    def __schedule(self, index):
+        for i in range(index+1, min(index+1+self.depth, self.num_batches)):
+            if (i in self.pending) or (len(self.free) == 0):
+                continue
+            buffers = self.free.pop()
+            indexes = np.array(self.batch_indexes(i))
+            self.pending[i] = (self.pool.submit(self.__fill, indexes, buffers), buffers)
+
+    def get(self, index):
+        start = timeit.default_timer()
+        with self.lock:
+            self.requests += 1
+            self.depth_sum += len(self.pending)
+            if index in self.pending:
+                self.hits += 1
+                future, buffers = self.pending.pop(index)
+                future.result()
+            else:
+                buffers = self.free.pop()
+                self.__fill(np.array(self.batch_indexes(index)), buffers)
+
+            batch = [buffer.copy() for buffer in buffers]
+            self.free.append(buffers)
+
+            self.__schedule(index)
+            self.stall_time += timeit.default_timer()-start
+        return batch
+
+    ## Drop every read-ahead batch, e.g. before indexes are reshuffled
+    def reset(self):
+        with self.lock:
+            for future, buffers in self.pending.values():
+                future.result()
+                self.free.append(buffers)
+            self.pending = {}
+
+    def close(self):
+        self.reset()
+        self.pool.shutdown(wait=True)
+
 class DataGenerator(Sequence):
-    def __init__(self, X_dir, Y_dir, batch_size=1, shuffle=True):
-        self.X_list = [child for child in X_dir.iterdir()]
-        self.Y_list = [child for child in Y_dir.iterdir()]
-        self.XY_list = list(zip(self.X_list, self.Y_list))
+    def __init__(self, X_dir, Y_dir, batch_size=1, shuffle=True, workers=0, depth=4):
+        self.X_list = open_records(X_dir)
+        self.Y_list = open_records(Y_dir)
         self.batch_size = batch_size
-        self.indexes = np.arange(len(self.XY_list))
+        self.indexes = np.arange(len(self.X_list))
         self.shuffle = shuffle
+        self.prefetcher = None
         self.on_epoch_end()
+        # workers > 0 reads up to depth batches ahead in a thread pool
+        if workers > 0:
+            self.prefetcher = BatchPrefetcher([self.X_list, self.Y_list],\
+                self.batch_indexes, len(self), batch_size, workers, depth)
 
     def __len__(self):
-        return int(np.floor(len(self.XY_list) / self.batch_size))
+        return int(np.floor(len(self.X_list) / self.batch_size))
 
     def __getitem__(self, index):
-        # Generate indexes of the batch
-        indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+        if self.prefetcher is not None:
+            X, Y = self.prefetcher.get(index)
+            return X, Y
 
-        # Find list of IDs
-        XY_file_list = [self.XY_list[k] for k in indexes]
+        # Generate indexes of the batch
+        indexes = self.batch_indexes(index)
 
         # Generate data
-        X, Y = self.__data_generation(XY_file_list)
+        X, Y = self.__data_generation(indexes)
 
         return X, Y
 
+    def batch_indexes(self, index):
+        return self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+
     def on_epoch_end(self):
+        if self.prefetcher is not None:
+            self.prefetcher.reset()
         if self.shuffle == True:
             np.random.shuffle(self.indexes)
 
-    def __data_generation(self, XY_file_list):
-        X_file_list = []
-        Y_file_list = []
-        for t in XY_file_list:
-            X_file_list.append(t[0])
-            Y_file_list.append(t[1])
-
-        X = [np.load(x_file) for x_file in X_file_list]
-        Y = [np.load(y_file) for y_file in Y_file_list]
-        X = np.array(X, np.float32)
-        Y = np.array(Y, np.float32)
+    def __data_generation(self, indexes):
+        X = load_records(self.X_list, indexes)
+        Y = load_records(self.Y_list, indexes)
         return X, Y
 
 class DataGeneratorV2(Sequence):
-    def __init__(self, X_dir, Y1_dir, Y2_dir, batch_size=1, shuffle=True):
-        self.X_list = [child for child in X_dir.iterdir()]
-        self.Y1_list = [child for child in Y1_dir.iterdir()]
-        self.Y2_list = [child for child in Y2_dir.iterdir()]
-        self.XYY_list = list(zip(self.X_list, self.Y1_list, self.Y2_list))
+    def __init__(self, X_dir, Y1_dir, Y2_dir, batch_size=1, shuffle=True, workers=0, depth=4):
+        self.X_list = open_records(X_dir)
+        self.Y1_list = open_records(Y1_dir)
+        self.Y2_list = open_records(Y2_dir)
         self.batch_size = batch_size
-        self.indexes = np.arange(len(self.XYY_list))
+        self.indexes = np.arange(len(self.X_list))
         self.shuffle = shuffle
+        self.prefetcher = None
         self.on_epoch_end()
+        # workers > 0 reads up to depth batches ahead in a thread pool
+        if workers > 0:
+            self.prefetcher = BatchPrefetcher([self.X_list, self.Y1_list, self.Y2_list],\
+                self.batch_indexes, len(self), batch_size, workers, depth)
 
     def __len__(self):
-        return int(np.floor(len(self.XYY_list) / self.batch_size))
+        return int(np.floor(len(self.X_list) / self.batch_size))
 
     def __getitem__(self, index):
-        # Generate indexes of the batch
-        indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+        if self.prefetcher is not None:
+            X, Y1, Y2 = self.prefetcher.get(index)
+            return X, [Y1, Y2]
 
-        # Find list of IDs
-        XYY_file_list = [self.XYY_list[k] for k in indexes]
+        # Generate indexes of the batch
+        indexes = self.batch_indexes(index)
 
         # Generate data
-        X, Y = self.__data_generation(XYY_file_list)
+        X, Y = self.__data_generation(indexes)
 
         return X, Y
 
+    def batch_indexes(self, index):
+        return self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+
     def on_epoch_end(self):
+        if self.prefetcher is not None:
+            self.prefetcher.reset()
         if self.shuffle == True:
             np.random.shuffle(self.indexes)
 
-    def __data_generation(self, XYY_file_list):
-        X_file_list = []
-        Y1_file_list = []
-        Y2_file_list = []
-        for t in XYY_file_list:
-            X_file_list.append(t[0])
-            Y1_file_list.append(t[1])
-            Y2_file_list.append(t[2])
-
-        X = [np.load(x_file) for x_file in X_file_list]
-        Y1 = [np.load(y_file) for y_file in Y1_file_list]
-        Y2 = [np.load(y_file) for y_file in Y2_file_list]
-        X = np.array(X, np.float32)
-        Y1 = np.array(Y1, np.float32)
-        Y2 = np.array(Y2, np.float32)
+    def __data_generation(self, indexes):
+        X = load_records(self.X_list, indexes)
+        Y1 = load_records(self.Y1_list, indexes)
+        Y2 = load_records(self.Y2_list, indexes)
         return X, [Y1, Y2]
 
 class DataGeneratorV3(Sequence):
-    def __init__(self, X1_dir, X2_dir, Y1_dir, Y2_dir, batch_size=1, shuffle=True):
-        self.X1_list = [child for child in X1_dir.iterdir()]
-        self.X2_list = [child for child in X2_dir.iterdir()]
-        self.Y1_list = [child for child in Y1_dir.iterdir()]
-        self.Y2_list = [child for child in Y2_dir.iterdir()]
-        self.XXYY_list = list(zip(self.X1_list, self.X2_list, self.Y1_list, self.Y2_list))
+    def __init__(self, X1_dir, X2_dir, Y1_dir, Y2_dir, batch_size=1, shuffle=True, workers=0, depth=4):
+        self.X1_list = open_records(X1_dir)
+        self.X2_list = open_records(X2_dir)
+        self.Y1_list = open_records(Y1_dir)
+        self.Y2_list = open_records(Y2_dir)
         self.batch_size = batch_size
-        self.indexes = np.arange(len(self.XXYY_list))
+        self.indexes = np.arange(len(self.X1_list))
         self.shuffle = shuffle
+        self.prefetcher = None
         self.on_epoch_end()
+        # workers > 0 reads up to depth batches ahead in a thread pool
+        if workers > 0:
+            self.prefetcher = BatchPrefetcher([self.X1_list, self.X2_list, self.Y1_list, self.Y2_list],\
+                self.batch_indexes, len(self), batch_size, workers, depth)
 
     def __len__(self):
-        return int(np.floor(len(self.XXYY_list) / self.batch_size))
+        return int(np.floor(len(self.X1_list) / self.batch_size))
 
     def __getitem__(self, index):
-        # Generate indexes of the batch
-        indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+        if self.prefetcher is not None:
+            X1, X2, Y1, Y2 = self.prefetcher.get(index)
+            return [X1, X2], [Y1, Y2]
 
-        # Find list of IDs
-        XXYY_file_list = [self.XXYY_list[k] for k in indexes]
+        # Generate indexes of the batch
+        indexes = self.batch_indexes(index)
 
         # Generate data
-        X, Y = self.__data_generation(XXYY_file_list)
+        X, Y = self.__data_generation(indexes)
 
         return X, Y
 
+    def batch_indexes(self, index):
+        return self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+
     def on_epoch_end(self):
+        if self.prefetcher is not None:
+            self.prefetcher.reset()
         if self.shuffle == True:
             np.random.shuffle(self.indexes)
 
-    def __data_generation(self, XXYY_file_list):
-        X1_file_list = []
-        X2_file_list = []
-        Y1_file_list = []
-        Y2_file_list = []
-        for t in XXYY_file_list:
-            X1_file_list.append(t[0])
-            X2_file_list.append(t[1])
-            Y1_file_list.append(t[2])
-            Y2_file_list.append(t[3])
-
-        X1 = [np.load(x_file) for x_file in X1_file_list]
-        X2 = [np.load(x_file) for x_file in X2_file_list]
-        Y1 = [np.load(y_file) for y_file in Y1_file_list]
-        Y2 = [np.load(y_file) for y_file in Y2_file_list]
-        X1 = np.array(X1, np.float32)
-        X2 = np.array(X2, np.float32)
-        Y1 = np.array(Y1, np.float32)
-        Y2 = np.array(Y2, np.float32)
+    def __data_generation(self, indexes):
+        X1 = load_records(self.X1_list, indexes)
+        X2 = load_records(self.X2_list, indexes)
+        Y1 = load_records(self.Y1_list, indexes)
+        Y2 = load_records(self.Y2_list, indexes)
         return [X1, X2], [Y1, Y2]
 
+class RpnTargetGenerator(Sequence):
+    """ DataGeneratorV2 that makes RPN targets while loading
+
+    # Constructor parameters
+        img_dir (Path) -- a directory of PNG files or a sharded image store
+        bbox_file (Path) -- the bbox reference table of the images
+        anchors (numpy array) -- normalized anchors made by Abstract.make_anchors
+        lim_lo, lim_up (float) -- label limits of the RPN
+        posCut, nWant (int) -- sampling parameters, see Abstract.sample_label_map
+        seed (int) -- seed of the label sampling
+        resample (bool) -- resample the label maps every epoch; validation
+          generators pass False so every epoch is scored on the same targets
+        workers, depth (int) -- see DataGeneratorV2
+
+    Only images and the bbox table are read. Label maps and delta maps are
+    made for every batch, and negatives are resampled every epoch unless
+    resample is False, so the label limits and sampling parameters can
+    change without preprocessing.
+    Images with no anchor above lim_up have nothing to train and are left out.
+    """
+    def __init__(self, img_dir, bbox_file, anchors, lim_lo, lim_up, posCut, nWant,\
+                    batch_size=1, shuffle=True, seed=0, resample=True, workers=0, depth=4):
+        self.img_dir = img_dir
+        self.images = open_images(img_dir)
+        self.anchors = anchors
+        self.limits = (lim_lo, lim_up)
+        self.sample = (posCut, nWant)
+        self.seed = seed
+        self.resample = resample
+        self.epoch = 0
+
+        img_bbox_dict = make_img_bbox_arrays(bbox_file)[0]
+        self.img_bbox_list = [ (img_name, bboxes) for img_name, bboxes in img_bbox_dict.items()\
+                                if (score_anchors(anchors, bboxes)[0] > lim_up).any() ]
+        discardNum = len(img_bbox_dict)-len(self.img_bbox_list)
+        if discardNum != 0:
+            pwarn(f'{discardNum} images have no positive anchor and are left out')
+        assert len(self.img_bbox_list) != 0, \
+            t_error(f'No image in {img_dir} has an anchor above lim_up={lim_up}')
+
+        iNum, jNum, kNum = anchors.shape[:3]
+        img_shape = read_image(img_dir, self.img_bbox_list[0][0], self.images).shape
+        self.shapes = [img_shape, (iNum, jNum, kNum), (iNum, jNum, kNum*4)]
+
+        self.batch_size = batch_size
+        self.indexes = np.arange(len(self.img_bbox_list))
+        self.shuffle = shuffle
+        self.prefetcher = None
+        self.on_epoch_end()
+        # workers > 0 makes up to depth batches ahead in a thread pool
+        if workers > 0:
+            self.prefetcher = BatchPrefetcher([], self.batch_indexes, len(self),\
+                batch_size, workers, depth, fill=self.fill, shapes=self.shapes)
+
+    def __len__(self):
+        return int(np.floor(len(self.img_bbox_list) / self.batch_size))
+
+    def __getitem__(self, index):
+        if self.prefetcher is not None:
+            X, Y1, Y2 = self.prefetcher.get(index)
+            return X, [Y1, Y2]
+
+        indexes = self.batch_indexes(index)
+        X, Y1, Y2 = [ np.empty(shape=(len(indexes),)+shape, dtype=np.float32)\
+                        for shape in self.shapes ]
+        self.fill(indexes, [X, Y1, Y2])
+        return X, [Y1, Y2]
+
+    def batch_indexes(self, index):
+        return self.indexes[index*self.batch_size:(index+1)*self.batch_size]
 
+    def on_epoch_end(self):
+        if self.prefetcher is not None:
+            self.prefetcher.reset()
+        if self.shuffle == True:
+            np.random.shuffle(self.indexes)
+        self.epoch += 1
+
+    ## Make the inputs and targets of a batch in place
+    def fill(self, indexes, buffers):
+        X, Y1, Y2 = buffers
+        lim_lo, lim_up = self.limits
+        posCut, nWant = self.sample
+        for i, k in enumerate(indexes):
+            img_name, bboxes = self.img_bbox_list[k]
+            np.divide(read_image(self.img_dir, img_name, self.images), 255.0, out=X[i])
+            epoch = self.epoch if self.resample else None
+            rng = window_rng(image_index(img_name), self.seed, epoch)
+            Y1[i], Y2[i] = rpn_targets(self.anchors, bboxes, lim_lo, lim_up, posCut, nWant, rng)
+
+class ShardGenerator(Sequence):
+    """ A zero-copy Sequence over sharded stores
+
+    X_dirs and Y_dirs are lists of store directories that share record
+    order. A single X (or Y) store yields an array, several yield a list.
+    Records of a batch are gathered in index order to keep reads local.
+    """
+    def __init__(self, X_dirs, Y_dirs, batch_size=1, shuffle=True):
+        self.X_stores = [open_store(dir) for dir in X_dirs]
+        self.Y_stores = [open_store(dir) for dir in Y_dirs]
+        lengths = [len(store) for store in self.X_stores+self.Y_stores]
+        assert len(set(lengths)) == 1, \
+            f'[ERROR]: Stores have different numbers of records: {lengths}'
+        self.batch_size = batch_size
+        self.indexes = np.arange(lengths[0])
+        self.shuffle = shuffle
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.floor(len(self.indexes) / self.batch_size))
+
+    def __getitem__(self, index):
+        indexes = np.sort(self.indexes[index*self.batch_size:(index+1)*self.batch_size])
+        X = [store.take(indexes) for store in self.X_stores]
+        Y = [store.take(indexes) for store in self.Y_stores]
+        X = X[0] if len(X)==1 else X
+        Y = Y[0] if len(Y)==1 else Y
+        return X, Y
+
+    def on_epoch_end(self):
+        if self.shuffle == True:
+            np.random.shuffle(self.indexes)
+
+
+
+## Class indices of color truth images
+#
+# \pr{Y, numpy array, uint8 truth images with white blank, blue bg and red major pixels.}
+# \rt{classes, numpy array, uint8 class index of every pixel (0 blank, 1 bg, 2 major);}
+# pixels of any other color are 0.
+# \rt{known, numpy array, Whether a pixel has one of the three truth colors.}
+def truth_classes(Y):
+    Y = Y.astype(np.int32)
+    codes = (Y[...,0]<<16) | (Y[...,1]<<8) | Y[...,2]
+    # packed blue, red and white in increasing order, and their classes
+    color_codes = np.array([0x0000FF, 0xFF0000, 0xFFFFFF], dtype=np.int32)
+    color_classes = np.array([1, 2, 0], dtype=np.uint8)
+    pos = np.minimum(np.searchsorted(color_codes, codes), len(color_codes)-1)
+    known = color_codes[pos] == codes
+    classes = np.where(known, color_classes[pos], 0).astype(np.uint8)
+    return classes, known
 
 class ImageGenerator(Sequence):
-    def __init__(self, X_dir, Y_dir, batch_size=1, shuffle=True):
+    def __init__(self, X_dir, Y_dir, batch_size=1, shuffle=True, target_format='onehot'):
+        self.X_dir = X_dir
+        self.target_format = target_format
         self.X_list = [child for child in X_dir.iterdir()]
         self.Y_list = [child for child in Y_dir.iterdir()]
         self.XY_list = list(zip(self.X_list, self.Y_list))
@@ -161,18 +471,11 @@ class ImageGenerator(Sequence):
 
 
     def calc_normalization(self):
-        X = []
-        for file in self.X_list:
-            img = PIL.Image.open(file)
-            arr = np.array(img, dtype=np.float32)
-            X.append(arr)
-            img.close()
-        X = np.array(X, dtype=np.float32)
-        x_mean = X.mean()
-        x_std = X.std()
+        # streamed over the images and cached next to X_dir
+        stats = dataset_stats(self.X_dir)
 
-        self.X_mean = x_mean
-        self.X_std = x_std
+        self.X_mean = np.float32(stats['mean'])
+        self.X_std = np.float32(stats['std'])
         print('Normalization factor calculated')
         return
 
@@ -188,7 +491,7 @@ class ImageGenerator(Sequence):
 
         # Generate data
         X, Y = self.__data_generation(XY_file_list)
-        return
+        return X, Y
 
     def on_epoch_end(self):
         if self.shuffle == True:
@@ -222,8 +525,9 @@ class ImageGenerator(Sequence):
         X = (X-self.X_mean)/self.X_std
 
         Y = np.array(Y, np.float32)
-        Y[(Y==[255,255,255]).all(axis=3)] = np.array([1,0,0], dtype=np.float32)
-        Y[(Y==[0,0,255]).all(axis=3)] = np.array([0,1,0], dtype=np.float32)
-        Y[(Y==[255,0,0]).all(axis=3)] = np.array([0,0,1], dtype=np.float32)
+        classes, known = truth_classes(Y)
+        if self.target_format == 'index':
+            return X, classes
+        Y[known] = np.eye(3, dtype=np.float32)[classes[known]]
 
         return X, Y
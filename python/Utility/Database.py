@@ -42,3 +42,187 @@ class StrawHit(Base):
     y_reco = Column(REAL, nullable=False)
     z_reco = Column(REAL, nullable=False)
     t_reco = Column(REAL, nullable=False)
+
+### Columnar access
+# The ORM above is convenient for single objects, but walking particles one
+# query at a time is slow. load_tracks reads every table of a database in
+# one scan each and groups hits by particle. The result is cached next to
+# the database, so SQLite is only read the first time. The cache records the
+# size and modification time of the database and is rebuilt when they change.
+import sqlite3
+import os
+from pathlib import Path
+
+import numpy as np
+
+# bump when the columns or the cache layout change
+cache_schema_version = 1
+
+class TrackTable:
+    """ Columnar copy of the tables of one track database
+
+    # Attributes
+        particles (dict) -- Particle columns, one entry per particle, sorted by id
+        digis (dict) -- StrawDigiMC columns, grouped by particle
+        hits (dict) -- StrawHit columns, grouped by particle
+        digi_offsets, hit_offsets (numpy array) -- the StrawDigiMC/StrawHit
+            rows of the i-th particle are offsets[i]:offsets[i+1]
+        digi_count, hit_count (numpy array) -- rows per particle
+
+    Ids are int64 and all other columns are float64.
+    """
+    particle_columns = ['id', 'run', 'subRun', 'event', 'track', 'pdgId']
+    digi_columns = ['id', 'particle', 'x', 'y', 'z', 't', 'p']
+    hit_columns = ['id', 'particle', 'strawDigiMC', 'x_reco', 'y_reco', 'z_reco', 't_reco']
+    int_columns = ['id', 'particle', 'strawDigiMC', 'run', 'subRun', 'event', 'track', 'pdgId']
+
+    def __init__(self, particles, digis, hits):
+        self.particles = particles
+        self.digis = digis
+        self.hits = hits
+
+        ptcl_ids = particles['id']
+        self.digi_offsets = self.__offsets(ptcl_ids, digis['particle'])
+        self.hit_offsets = self.__offsets(ptcl_ids, hits['particle'])
+        self.digi_count = np.diff(self.digi_offsets)
+        self.hit_count = np.diff(self.hit_offsets)
+
+    @staticmethod
+    def __offsets(ptcl_ids, owner):
+        offsets = np.empty(len(ptcl_ids)+1, dtype=np.int64)
+        offsets[:-1] = np.searchsorted(owner, ptcl_ids, side='left')
+        offsets[-1] = len(owner)
+        return offsets
+
+    def __len__(self):
+        return len(self.particles['id'])
+
+    def digi_slice(self, i):
+        return slice(self.digi_offsets[i], self.digi_offsets[i+1])
+
+    def hit_slice(self, i):
+        return slice(self.hit_offsets[i], self.hit_offsets[i+1])
+
+## Read a table into columns with a single query
+#
+# \pr{con, sqlite3 Connection, An open database.}
+# \pr{table, str, Name of the table.}
+# \pr{columns, list, Columns to read.}
+# \pr{order, str, ORDER BY clause.}
+# \rt{data, dict, Column name -> numpy array.}
+def read_columns(con, table, columns, order):
+    query = f'SELECT {", ".join(columns)} FROM {table} ORDER BY {order}'
+    rows = np.array(con.execute(query).fetchall(), dtype=np.float64)
+    rows = rows.reshape(-1, len(columns))
+    data = {}
+    for i, column in enumerate(columns):
+        if column in TrackTable.int_columns:
+            data[column] = rows[:,i].astype(np.int64)
+        else:
+            data[column] = rows[:,i]
+    return data
+
+def _stamp(db_file):
+    stat = os.stat(db_file)
+    return np.array([cache_schema_version, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+## Cache file of a track database
+#
+# \pr{db_file, Path object, A track SQLite database.}
+# \pr{cache_dir, Path object, Directory of the caches; defaults to track_cache next to the database.}
+# \rt{cache_file, Path object, The .npz cache of the database and schema version.}
+def track_cache_file(db_file, cache_dir=None):
+    db_file = Path(db_file)
+    if cache_dir is None:
+        cache_dir = db_file.parent.joinpath('track_cache')
+    name = f'{db_file.name}.v{cache_schema_version}.npz'
+    return Path(cache_dir).joinpath(name)
+
+## Write a TrackTable to an .npz file
+#
+# \pr{stamp, numpy array, Optional stamp of the database, stored along with the table.}
+def save_tracks(table, file, stamp=None):
+    arrays = {}
+    if stamp is not None:
+        arrays['stamp'] = stamp
+    for group, columns in [('particles', table.particles), ('digis', table.digis), ('hits', table.hits)]:
+        for column, array in columns.items():
+            arrays[f'{group}/{column}'] = array
+    # write to a temporary file first so that a partial cache is never read
+    tmp_file = file.with_name(file.name+'.tmp')
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, file)
+
+## Read a TrackTable from an .npz file written by save_tracks
+#
+# \pr{stamp, numpy array, If given, the table is only read if it was saved with this stamp.}
+# \rt{table, TrackTable, The table, or None if its stamp differs.}
+def read_tracks(file, stamp=None):
+    groups = {'particles': {}, 'digis': {}, 'hits': {}}
+    with np.load(file) as data:
+        if (stamp is not None) and (('stamp' not in data.files) or\
+                (not np.array_equal(data['stamp'], stamp))):
+            return None
+        for key in data.files:
+            if key == 'stamp':
+                continue
+            group, column = key.split('/')
+            groups[group][column] = data[key]
+    return TrackTable(groups['particles'], groups['digis'], groups['hits'])
+
+## Read a track database from SQLite
+#
+# \pr{db_file, Path object, A track SQLite database.}
+# \rt{table, TrackTable, Particles with their StrawDigiMC and StrawHit rows.}
+def read_track_db(db_file):
+    con = sqlite3.connect(str(db_file))
+    try:
+        particles = read_columns(con, 'Particle', TrackTable.particle_columns, 'id')
+        digis = read_columns(con, 'StrawDigiMC', TrackTable.digi_columns, 'particle, id')
+        hits = read_columns(con, 'StrawHit', TrackTable.hit_columns, 'particle, id')
+    finally:
+        con.close()
+    return TrackTable(particles, digis, hits)
+
+## Load a track database into a TrackTable
+#
+# The columnar cache is used when its stamp matches the size and
+# modification time of the database and is (re)built otherwise. A new
+# cache_schema_version gets a new cache file.
+#
+# \pr{db_file, Path object, A track SQLite database.}
+# \pr{cache_dir, Path object, Directory of the caches; defaults to track_cache next to the database.}
+# \pr{use_cache, bool, False reads SQLite and leaves the cache alone.}
+# \rt{table, TrackTable, Particles with their StrawDigiMC and StrawHit rows.}
+def load_tracks(db_file, cache_dir=None, use_cache=True):
+    if not use_cache:
+        return read_track_db(db_file)
+
+    cache_file = track_cache_file(db_file, cache_dir)
+    stamp = _stamp(db_file)
+    if cache_file.exists():
+        table = read_tracks(cache_file, stamp)
+        if table is not None:
+            return table
+
+    table = read_track_db(db_file)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        save_tracks(table, cache_file, stamp)
+    except OSError:
+        # e.g. a read-only track directory; the table is still usable
+        pass
+    return table
+
+## Build the columnar caches of several track databases
+#
+# \pr{db_files, list, Track SQLite databases.}
+# \pr{cache_dir, Path object, Directory of the caches; defaults to track_cache next to each database.}
+# \rt{cache_files, list, The cache file of every database.}
+def build_track_cache(db_files, cache_dir=None):
+    cache_files = []
+    for db_file in db_files:
+        load_tracks(db_file, cache_dir)
+        cache_files.append(track_cache_file(db_file, cache_dir))
+    return cache_files
@@ -0,0 +1,115 @@
+## @package Evaluation
+#
+# Precision, recall, degeneracy and average precision of bbox predictions.
+#
+# All metrics of an image come from its reference-by-prediction IoU matrix
+# and are computed for every IoU cut at once.
+#
+# Precision, recall and degeneracy follow the grading used by the analysis
+# scripts: a prediction is a true positive if it overlaps any reference bbox
+# by at least the cut, a reference bbox is missed if no prediction does, and
+# the degeneracy of a reference bbox is the number of predictions covering it.
+#
+# Average precision is the VOC all-point AP with greedy matching: predictions
+# are walked from the highest score, each is assigned to the reference bbox
+# it overlaps most, and only the first prediction reaching the IoU threshold
+# on a reference bbox counts as a true positive.
+
+import numpy as np
+
+from Geometry import iou_matrix
+
+# sums accumulated per IoU cut by image_stats
+stat_names = ['precision_sum', 'precision_num', 'recall_sum', 'recall_num',\
+                'degeneracy_sum', 'degeneracy_num']
+
+## Grading sums of an image
+#
+# \pr{ious, numpy array, Reference-by-prediction IoU matrix of shape (n, m).}
+# \pr{IoU_cuts, array like, IoU cuts.}
+# \rt{stats, numpy array, Sums of shape (len(IoU_cuts), len(stat_names)).}
+def image_stats(ious, IoU_cuts):
+    iNum, jNum = ious.shape
+    hits = ious[np.newaxis] >= np.asarray(IoU_cuts, dtype=np.float64)[:,np.newaxis,np.newaxis]
+    degeneracies = np.count_nonzero(hits, axis=2)
+    fn = np.count_nonzero(degeneracies==0, axis=1)
+    tp = np.count_nonzero(hits.any(axis=1), axis=1)
+
+    stats = np.zeros(shape=(len(hits), len(stat_names)))
+    # no precision when nothing is predicted
+    if jNum != 0:
+        stats[:,0] = tp/jNum
+        stats[:,1] = 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats[:,2] = tp/(tp+fn)
+    stats[:,3] = 1
+    stats[:,4] = degeneracies.sum(axis=1)
+    stats[:,5] = iNum
+    return stats
+
+## Average precisions of an image
+#
+# \pr{ious, numpy array, Reference-by-prediction IoU matrix of shape (n, m).}
+# \pr{scores, numpy array, Scores of the m predictions.}
+# \pr{thresholds, array like, IoU thresholds of the APs.}
+# \rt{aps, numpy array, AP at every threshold; 0 if nothing is predicted.}
+def image_aps(ious, scores, thresholds):
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    iNum, jNum = ious.shape
+    if jNum == 0 or iNum == 0:
+        return np.zeros(len(thresholds))
+
+    # walk predictions from the highest score
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    best_ref = ious[:, order].argmax(axis=0)
+    best_iou = ious[best_ref, order]
+
+    # the first candidate on a reference bbox is a true positive
+    candidates = best_iou[np.newaxis] >= thresholds[:,np.newaxis]
+    on_ref = candidates[:,:,np.newaxis] & (best_ref[:,np.newaxis] == np.arange(iNum))[np.newaxis]
+    tp = (np.cumsum(on_ref, axis=1) == 1) & on_ref
+    tp = tp.any(axis=2)
+
+    ctp = np.cumsum(tp, axis=1)
+    precision = ctp/np.arange(1, jNum+1)
+    recall = ctp/iNum
+
+    # area under the monotone precision envelope
+    zeros = np.zeros(shape=(len(thresholds), 1))
+    precision = np.concatenate([zeros, precision, zeros], axis=1)
+    recall = np.concatenate([zeros, recall, zeros+1], axis=1)
+    envelope = np.flip(np.maximum.accumulate(np.flip(precision, axis=1), axis=1), axis=1)
+    return np.sum((recall[:,1:]-recall[:,:-1])*envelope[:,1:], axis=1)
+
+class Evaluator:
+    """ Accumulates detection metrics over images
+
+    # Constructor parameters
+        IoU_cuts (list) -- IoU cuts of precision, recall and degeneracy
+        ap_thresholds (list) -- IoU thresholds of the average precisions
+
+    summary() gives per-cut precision (mean over images with predictions),
+    recall (mean over images), degeneracy (mean over reference bboxes) and
+    the per-threshold AP averaged over images. A metric without any image
+    to average over is nan.
+    """
+    def __init__(self, IoU_cuts, ap_thresholds):
+        self.IoU_cuts = list(IoU_cuts)
+        self.ap_thresholds = list(ap_thresholds)
+        self.stats = np.zeros(shape=(len(self.IoU_cuts), len(stat_names)))
+        self.aps = np.zeros(len(self.ap_thresholds))
+        self.imgNum = 0
+
+    def add(self, ref_bboxes, pred_bboxes, scores, ious=None):
+        if ious is None:
+            ious = iou_matrix(ref_bboxes, pred_bboxes)
+        self.stats += image_stats(ious, self.IoU_cuts)
+        self.aps += image_aps(ious, scores, self.ap_thresholds)
+        self.imgNum += 1
+
+    def summary(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {'precision': self.stats[:,0]/self.stats[:,1],\
+                    'recall': self.stats[:,2]/self.stats[:,3],\
+                    'degeneracy': self.stats[:,4]/self.stats[:,5],\
+                    'ap': self.aps/self.imgNum if self.imgNum != 0 else self.aps*np.nan}
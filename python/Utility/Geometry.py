@@ -1,3 +1,5 @@
+import numpy as np
+
 
 def union(rec_a, rec_b, intersection):
     area_a = (rec_a[1]-rec_a[0])*(rec_a[3]-rec_a[2])
@@ -16,3 +18,23 @@ def iou(rec_a, rec_b):
     overlap = intersection(rec_a, rec_b)
     sum_val = union(rec_a, rec_b, overlap)
     return overlap/float(sum_val)
+
+def intersection_matrix(recs_a, recs_b):
+    # recs_a(b) should be arrays of (xmin, xmax, ymin, ymax) with shape (n, 4)
+    recs_a = np.asarray(recs_a, dtype=np.float64).reshape(-1, 4)
+    recs_b = np.asarray(recs_b, dtype=np.float64).reshape(-1, 4)
+    w = np.minimum(recs_a[:,None,1], recs_b[None,:,1]) - np.maximum(recs_a[:,None,0], recs_b[None,:,0])
+    h = np.minimum(recs_a[:,None,3], recs_b[None,:,3]) - np.maximum(recs_a[:,None,2], recs_b[None,:,2])
+    return np.clip(w, 0, None)*np.clip(h, 0, None)
+
+def iou_matrix(recs_a, recs_b):
+    # returns a (len(recs_a), len(recs_b)) IoU matrix; pairs without overlap score 0
+    recs_a = np.asarray(recs_a, dtype=np.float64).reshape(-1, 4)
+    recs_b = np.asarray(recs_b, dtype=np.float64).reshape(-1, 4)
+    overlap = intersection_matrix(recs_a, recs_b)
+    area_a = (recs_a[:,1]-recs_a[:,0])*(recs_a[:,3]-recs_a[:,2])
+    area_b = (recs_b[:,1]-recs_b[:,0])*(recs_b[:,3]-recs_b[:,2])
+    sum_val = area_a[:,None] + area_b[None,:] - overlap
+    result = np.zeros_like(overlap)
+    np.divide(overlap, sum_val, out=result, where=overlap>0)
+    return result
@@ -5,9 +5,6 @@ from collections import Counter
 
 import numpy as np
 
-from sqlalchemy import *
-from sqlalchemy.orm import sessionmaker
-
 util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Database import *
@@ -22,67 +19,108 @@ class Stochastic:
         self.db_iter = iter(db_files)
 
         self.current_db = None
-        self.session = None
+        self.table = None
         self.__update_db()
 
-        self.ptcls = None
-        self.ptcl_iter = None
-        self.__make_ptcl_iter()
-
-    def __connect_db(self):
-        engine = create_engine('sqlite:///'+str(self.current_db))
-        Session = sessionmaker(bind=engine) # session factory
-        session = Session() # session object
-        self.session = session
+        self.eligible = None
+        self.cursor = 0
+        self.__find_eligible()
 
     def __update_db(self):
         self.current_db = next(self.db_iter)
-        self.__connect_db()
-
-    def __find_ptcls(self):
-        ptcls = self.session.query(Particle).all()
-        self.ptcls = ptcls
-
-    def __make_ptcl_iter(self):
-        self.__find_ptcls()
-        self.ptcl_iter = iter(self.ptcls)
-
-    def generate(self, mode='eval'):
-        trackNum = int(self.dist.rvs(size=1))
-        trackFoundNum = 0
-        tracks = {}
-        hits = {}
-
-        while trackFoundNum < trackNum:
-            try:
-                ptcl = next(self.ptcl_iter)
-            except:
+        self.table = load_tracks(self.current_db)
+
+    # rows of particles that can be a major track, in database order
+    def __find_eligible(self):
+        table = self.table
+        mask = (table.digi_count >= self.hitNumCut) & (table.particles['pdgId'] == 11)
+        self.eligible = np.flatnonzero(mask)
+        self.cursor = 0
+
+    # take the next num eligible particles, moving on to the next databases
+    def __take(self, num):
+        chunks = []
+        while num > 0:
+            if self.cursor == len(self.eligible):
                 sys.stdout.write('\n')
                 sys.stdout.flush()
                 pinfo('Run out of particles')
                 pinfo('Connecting to the next track database')
                 self.__update_db()
-                self.__make_ptcl_iter()
-                ptcl = next(self.ptcl_iter)
-
-            strawHit_qrl = self.session.query(StrawDigiMC).filter(StrawDigiMC.particle==ptcl.id)
-            hitNum = strawHit_qrl.count()
-
-            if (hitNum >= self.hitNumCut) and (ptcl.pdgId == 11):
-                tracks[ptcl.id] = []
-                track = tracks[ptcl.id]
+                self.__find_eligible()
+                continue
+            takeNum = min(num, len(self.eligible)-self.cursor)
+            chunks.append((self.table, self.eligible[self.cursor:self.cursor+takeNum]))
+            self.cursor += takeNum
+            num -= takeNum
+        return chunks
+
+    ## Generate several windows at once
+    #
+    # \pr{n, int, Number of windows.}
+    # \rt{batch, dict, Flat per-hit arrays 'hit_id', 'x', 'y', 'z', 'track_id'}
+    # and 'pdgId' for all windows, and 'window_offsets' such that the hits
+    # of the i-th window are window_offsets[i]:window_offsets[i+1].
+    def generate_batch(self, n):
+        trackNums = np.maximum(self.dist.rvs(size=n).astype(np.int64), 0)
+
+        columns = {'hit_id':[], 'x':[], 'y':[], 'z':[], 'track_id':[], 'pdgId':[]}
+        hitNums = []
+        for table, ptcls in self.__take(int(trackNums.sum())):
+            counts = table.digi_count[ptcls]
+            starts = table.digi_offsets[ptcls]
+            # row indexes of all hits of the selected particles
+            rows = np.repeat(starts-np.cumsum(counts)+counts, counts)\
+                    + np.arange(counts.sum())
+            columns['hit_id'].append(table.digis['id'][rows])
+            columns['x'].append(table.digis['x'][rows])
+            columns['y'].append(table.digis['y'][rows])
+            columns['z'].append(table.digis['z'][rows])
+            columns['track_id'].append(np.repeat(table.particles['id'][ptcls], counts))
+            columns['pdgId'].append(np.repeat(table.particles['pdgId'][ptcls], counts))
+            hitNums.append(counts)
+
+        batch = {}
+        for name, arrays in columns.items():
+            if len(arrays) != 0:
+                batch[name] = np.concatenate(arrays)
+            elif name in ['x', 'y', 'z']:
+                batch[name] = np.zeros(0, dtype=np.float64)
+            else:
+                batch[name] = np.zeros(0, dtype=np.int64)
 
-                strawHits = strawHit_qrl.all()
-                for hit in strawHits:
-                    track.append(hit.id)
-                    hits[hit.id] = (hit.x, hit.y, hit.z)
+        hitNums = np.concatenate(hitNums) if len(hitNums) != 0 else np.zeros(0, dtype=np.int64)
+        track_offsets = np.concatenate([[0], np.cumsum(hitNums)])
+        window_tracks = np.concatenate([[0], np.cumsum(trackNums)])
+        batch['window_offsets'] = track_offsets[window_tracks]
+        return batch
 
-                pdgId = self.session.query(Particle.pdgId).filter(Particle.id==ptcl.id).one_or_none()[0]
-                track.append(pdgId)
-                trackFoundNum += 1
-            else:
-                continue
+    def generate(self, mode='eval'):
+        hits, tracks = window_dicts(self.generate_batch(1), 0)
         if mode == 'eval':
             return hits, tracks
         else:
             return hits
+
+## Convert a window of a batch to the dictionaries of Stochastic.generate
+#
+# \pr{batch, dict, A batch made by Stochastic.generate_batch.}
+# \pr{i, int, Index of the window.}
+# \rt{hits, dict, {hit id: (x, y, z)}.}
+# \rt{tracks, dict, {track id: [hit ids..., pdgId]}.}
+def window_dicts(batch, i):
+    rows = slice(batch['window_offsets'][i], batch['window_offsets'][i+1])
+    hit_ids = batch['hit_id'][rows].tolist()
+    track_ids = batch['track_id'][rows].tolist()
+    pdgIds = batch['pdgId'][rows].tolist()
+    hits = dict(zip(hit_ids, zip(batch['x'][rows].tolist(),\
+                                batch['y'][rows].tolist(),\
+                                batch['z'][rows].tolist())))
+    tracks = {}
+    track_pdgIds = {}
+    for hit_id, track_id, pdgId in zip(hit_ids, track_ids, pdgIds):
+        tracks.setdefault(track_id, []).append(hit_id)
+        track_pdgIds[track_id] = pdgId
+    for track_id, track in tracks.items():
+        track.append(track_pdgIds[track_id])
+    return hits, tracks
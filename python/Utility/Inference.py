@@ -0,0 +1,179 @@
+## @package Inference
+#
+# Batched Faster R-CNN inference.
+#
+# Images go through the RPN a batch at a time. The proposals of a batch are
+# decoded and suppressed together and padded into one detector call. Rows
+# of the three output tables are collected in growing columnar buffers and
+# turned into DataFrames once at the end.
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+from Abstract import decode_rpn_outputs
+from NMS import pad_batch, batch_nms
+from DataGenerator import load_records, record_shape
+from Information import *
+
+class ColumnBuffer:
+    """ Growing set of equal-length numpy columns
+
+    # Constructor parameters
+        dtypes (dict) -- column name -> numpy dtype
+        capacity (int) -- initial number of rows
+
+    The capacity doubles when it runs out, so appending is amortized O(1)
+    per row instead of copying the whole table like DataFrame.append.
+    """
+    def __init__(self, dtypes, capacity=1024):
+        self.size = 0
+        self.columns = { name: np.empty(capacity, dtype=dtype) for name, dtype in dtypes.items() }
+
+    def __len__(self):
+        return self.size
+
+    def append(self, **columns):
+        num = len(next(iter(columns.values())))
+        capacity = len(next(iter(self.columns.values())))
+        if self.size+num > capacity:
+            capacity = max(2*capacity, self.size+num)
+            for name, column in self.columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.columns[name] = grown
+        for name, values in columns.items():
+            self.columns[name][self.size:self.size+num] = values
+        self.size += num
+
+    def get(self, name):
+        return self.columns[name][:self.size]
+
+class FrcnnPredictor:
+    """ Batched Faster R-CNN inference engine
+
+    # Constructor parameters
+        model_rpn -- Model mapping images to [feature maps, RPN scores, RPN deltas]
+        model_detector -- Model mapping [feature maps, RoIs] to [class scores, deltas]
+        anchors (numpy array) -- anchors made by Abstract.make_anchors
+        batch_size (int) -- number of images per RPN/detector call
+        max_output_size, iou_threshold, score_threshold, soft_nms_sigma --
+          NMS parameters for the RPN proposals
+        processes (int) -- worker processes for NMS; 0 runs NMS in this process
+
+    predict() returns three DataFrames with the columns
+    FileName, XMin, XMax, YMin, YMax, ClassName, Score:
+        RPN proposals after NMS (ClassName is empty),
+        proposals the detector does not call background,
+        and the same proposals moved by the detector deltas.
+    """
+    def __init__(self, model_rpn, model_detector, anchors, batch_size=8,\
+            max_output_size=2000, iou_threshold=0.7, score_threshold=0.0,\
+            soft_nms_sigma=0.0, processes=0):
+        self.model_rpn = model_rpn
+        self.model_detector = model_detector
+        self.anchors = anchors
+        self.batch_size = batch_size
+        self.nms_params = {'max_output_size': max_output_size,\
+                            'iou_threshold': iou_threshold,\
+                            'score_threshold': score_threshold,\
+                            'soft_nms_sigma': soft_nms_sigma,\
+                            'processes': processes}
+
+    @staticmethod
+    def __new_table():
+        dtypes = {'img': np.int64, 'XMin': np.float32, 'XMax': np.float32,\
+                    'YMin': np.float32, 'YMax': np.float32, 'Score': np.float32}
+        return ColumnBuffer(dtypes)
+
+    @staticmethod
+    def __to_frame(table, img_names, class_name):
+        frame = pd.DataFrame({'FileName': np.asarray(img_names, dtype=str)[table.get('img')],\
+                            'XMin': table.get('XMin'),\
+                            'XMax': table.get('XMax'),\
+                            'YMin': table.get('YMin'),\
+                            'YMax': table.get('YMax'),\
+                            'ClassName': class_name,\
+                            'Score': table.get('Score')})
+        return frame
+
+    ## Propose RoIs for a batch of RPN outputs
+    #
+    # \rt{rois, numpy array, Padded (x, y, w, h) RoIs of shape (batch, max RoIs, 4).}
+    # \rt{bboxes, numpy array, Padded [xmin, xmax, ymin, ymax] of the same RoIs.}
+    # \rt{scores, numpy array, Padded RPN scores of shape (batch, max RoIs).}
+    # \rt{num_rois, numpy array, Number of real RoIs of every image.}
+    def propose(self, rpn_scores, rpn_deltas):
+        scores, bboxes, offsets = decode_rpn_outputs(self.anchors, rpn_scores, rpn_deltas)
+        batch_bboxes, batch_scores, counts = pad_batch(bboxes, scores, offsets)
+        selected_indices, selected_scores, num_rois =\
+            batch_nms(batch_bboxes, batch_scores, counts, **self.nms_params)
+
+        # trim the padding to the largest number of RoIs in this batch
+        width = max(int(num_rois.max()), 1)
+        selected_indices = np.maximum(selected_indices[:,:width], 0)
+        bboxes = np.take_along_axis(batch_bboxes, selected_indices[:,:,np.newaxis], axis=1)
+        valid = np.arange(width)[np.newaxis,:] < num_rois[:,np.newaxis]
+        bboxes[~valid] = 0
+
+        # (x, y, w, h) with x = xmin and y = ymax
+        xmins, xmaxs, ymins, ymaxs = np.moveaxis(bboxes, -1, 0)
+        rois = np.stack([xmins, ymaxs, xmaxs-xmins, ymaxs-ymins], axis=-1)
+        return rois, bboxes, selected_scores[:,:width], num_rois
+
+    ## Predict all images of a record source
+    #
+    # \pr{records, list or store reader, Input images made by DataGenerator.open_records.}
+    # \pr{img_names, list, Name of every image, in record order.}
+    # \rt{frames, tuple, RPN, classified and regressed prediction DataFrames.}
+    def predict(self, records, img_names):
+        imgNum = len(records)
+        batch_input = np.empty(shape=(self.batch_size,)+record_shape(records), dtype=np.float32)
+        rpn_table, cls_table, rgr_table = self.__new_table(), self.__new_table(), self.__new_table()
+
+        for start in range(0, imgNum, self.batch_size):
+            stop = min(start+self.batch_size, imgNum)
+            sys.stdout.write(t_info(f'Processing images {stop}/{imgNum}', '\r'))
+            if stop == imgNum:
+                sys.stdout.write('\n')
+            sys.stdout.flush()
+
+            x = load_records(records, np.arange(start, stop), out=batch_input[:stop-start])
+            ftr_maps, rpn_scores, rpn_deltas = self.model_rpn.predict_on_batch(x)
+            rpn_scores = np.asarray(rpn_scores)
+            rpn_deltas = np.asarray(rpn_deltas)
+
+            rois, bboxes, scores, num_rois = self.propose(rpn_scores, rpn_deltas)
+            valid = np.arange(rois.shape[1])[np.newaxis,:] < num_rois[:,np.newaxis]
+            img_idx = np.nonzero(valid)[0] + start
+            rpn_table.append(img=img_idx,\
+                    XMin=bboxes[valid][:,0], XMax=bboxes[valid][:,1],\
+                    YMin=bboxes[valid][:,2], YMax=bboxes[valid][:,3],\
+                    Score=scores[valid])
+
+            labels, deltas = self.model_detector.predict_on_batch([ftr_maps, rois])
+            labels = np.asarray(labels)
+            deltas = np.asarray(deltas).reshape(labels.shape+(4,))
+
+            # only want proposals which are not background
+            classes = np.argmax(labels, axis=-1)
+            selected = valid & (classes != 0)
+            img_idx = np.nonzero(selected)[0] + start
+            frcnn_bboxes = bboxes[selected]
+            frcnn_scores = np.amax(labels[selected], axis=-1)
+            cls_table.append(img=img_idx,\
+                    XMin=frcnn_bboxes[:,0], XMax=frcnn_bboxes[:,1],\
+                    YMin=frcnn_bboxes[:,2], YMax=frcnn_bboxes[:,3],\
+                    Score=frcnn_scores)
+
+            # deltas of the winning class are (x, y, w, h) of the moved box
+            d = np.take_along_axis(deltas[selected], classes[selected][:,np.newaxis,np.newaxis], axis=1)[:,0]
+            rgr_table.append(img=img_idx,\
+                    XMin=np.maximum(d[:,0], 0), XMax=np.minimum(d[:,0]+d[:,2], 1),\
+                    YMin=np.maximum(d[:,1]-d[:,3], 0), YMax=np.minimum(d[:,1], 1),\
+                    Score=frcnn_scores)
+
+        return self.__to_frame(rpn_table, img_names, np.nan),\
+                self.__to_frame(cls_table, img_names, 11),\
+                self.__to_frame(rgr_table, img_names, 11)
@@ -147,24 +147,45 @@ class RPN_to_RoI(Layer):
 
 
 class RoIPooling(Layer):
-    """ Implements Region Of Interest Max Pooling
-    for channel-first images and relative bounding box coordinates
+    """ Implements Region Of Interest Max Pooling (or RoIAlign)
+    for channel-last images and relative bounding box coordinates
 
     # Constructor parameters
         pooled_height, pooled_width (int) --
           specify height and width of layer outputs
+        sampling_ratio (int) --
+          number of samples per output bin along each axis; None pools
+          every pixel of every bin (2 samples for RoIAlign)
+        align (bool) --
+          False: RoI max pooling on the integer grid of the feature map
+          True: RoIAlign, bilinear samples averaged over each bin
+
+    By default RoI max pooling is exact: bins are the integer bins of the
+    per-RoI implementation, regions smaller than the output are nearest
+    upsampled first, and every bin is max pooled over all of its pixels.
+    The bin rows and then the bin columns of all RoIs are gathered one
+    offset at a time into a running maximum, so the layer needs the static
+    height and width of the feature map.
+
+    With a sampling_ratio, or with align, all RoIs are instead cropped by
+    one crop_and_resize gather onto a (pooled_height*sampling_ratio,
+    pooled_width*sampling_ratio) grid, which is then reduced by one pooling
+    op. Bins wider than sampling_ratio pixels are then max pooled over the
+    sampled pixels only.
 
     Shape of inputs
-        [(batch_size, pooled_height, pooled_width, n_channels),
+        [(batch_size, height, width, n_channels),
          (batch_size, num_rois, 4)]
 
     Shape of output
         (batch_size, num_rois, pooled_height, pooled_width, n_channels)
     """
-    def __init__(self, pooled_height, pooled_width, **kwargs):
+    def __init__(self, pooled_height, pooled_width, sampling_ratio=None, align=False, **kwargs):
 
         self.pooled_height = pooled_height
         self.pooled_width = pooled_width
+        self.sampling_ratio = sampling_ratio
+        self.align = align
 
         super(RoIPooling, self).__init__(**kwargs)
 
@@ -183,98 +204,132 @@ class RoIPooling(Layer):
         """ Maps the input tensor of the RoI layer to its output
                 # Parameters
                     x[0] -- Convolutional feature map tensor,
-                            shape (batch_size, pooled_height, pooled_width, n_channels)
+                            shape (batch_size, height, width, n_channels)
                     x[1] -- Tensor of region of interests from candidate bounding boxes,
                             shape (batch_size, num_rois, 4)
                             Each region of interest is defined by four relative
                             coordinates (x_min, y_max, width, height) between 0 and 1
                 # Output
-                    pooled_areas -- Tensoir with the poooled region of interest, shape
+                    pooled_areas -- Tensor with the pooled region of interest, shape
                         (batch_size, num_rois, pooled_height, pooled_width, n_channels)
         """
-        def curried_pool_rois(x):
-            return RoIPooling._pool_rois(x[0], x[1],
-                                                self.pooled_height,
-                                                self.pooled_width)
-
-        pooled_areas = tf.map_fn(curried_pool_rois, x, dtype=tf.float32)
-
-        inf_val = tf.math.reduce_sum(tf.cast(tf.math.is_inf(pooled_areas), dtype=tf.int32))
-        if inf_val > 0:
-            print_tensor('Found inf')
-
+        feature_map, rois = x
+        rois = tf.cast(rois, tf.float32)
+        if (self.sampling_ratio is None) and (not self.align):
+            return self._pool_exact(feature_map, rois)
+        sampling_ratio = self.sampling_ratio if self.sampling_ratio is not None else 2
+
+        batch_size = tf.shape(rois)[0]
+        n_rois = tf.shape(rois)[1]
+        n_channels = feature_map.shape[3]
+        height = tf.cast(tf.shape(feature_map)[1], tf.float32)
+        width = tf.cast(tf.shape(feature_map)[2], tf.float32)
+
+        # change from (x, y, w, h) to pixel edges of the region
+        xs, ys, ws, hs = tf.unstack(tf.reshape(rois, (-1, 4)), axis=1)
+        top = height*(1-ys)
+        bottom = height*(1-(ys-hs))
+        left = width*xs
+        right = width*(xs+ws)
+        if not self.align:
+            # RoI pooling works on whole pixels and keeps at least one
+            top, bottom = tf.math.floor(top), tf.math.floor(bottom)
+            left, right = tf.math.floor(left), tf.math.floor(right)
+            bottom = tf.math.maximum(bottom, top+1)
+            right = tf.math.maximum(right, left+1)
+
+        # centers of the first and the last samples, normalized for crop_and_resize
+        crop_height = self.pooled_height*sampling_ratio
+        crop_width = self.pooled_width*sampling_ratio
+        y_half = (bottom-top)/(2*crop_height)
+        x_half = (right-left)/(2*crop_width)
+        y1 = tf.clip_by_value(top+y_half-0.5, 0, height-1)/(height-1)
+        y2 = tf.clip_by_value(bottom-y_half-0.5, 0, height-1)/(height-1)
+        x1 = tf.clip_by_value(left+x_half-0.5, 0, width-1)/(width-1)
+        x2 = tf.clip_by_value(right-x_half-0.5, 0, width-1)/(width-1)
+        boxes = tf.stack([y1, x1, y2, x2], axis=1)
+        box_indices = tf.repeat(tf.range(batch_size), n_rois)
+
+        method = 'bilinear' if self.align else 'nearest'
+        crops = tf.image.crop_and_resize(feature_map, boxes, box_indices,\
+                    (crop_height, crop_width), method=method)
+
+        window = (sampling_ratio, sampling_ratio)
+        if self.align:
+            pooled = tf.nn.avg_pool2d(crops, window, window, padding='VALID')
+        else:
+            pooled = tf.nn.max_pool2d(crops, window, window, padding='VALID')
+
+        pooled_areas = tf.reshape(pooled, (batch_size, n_rois, self.pooled_height,\
+                            self.pooled_width, n_channels))
         return pooled_areas
 
     @staticmethod
-    def _pool_rois(feature_map, rois, pooled_height, pooled_width):
-        """ Applies ROI pooling for a single imgae and varios RoIs
+    def _bin_edges(length, pooled, small):
+        """ First pixel and pixel number of every bin of regions of the given lengths
         """
-        def curried_pool_roi(roi):
-            return RoIPooling._pool_roi(feature_map, roi,
-                                                pooled_height, pooled_width)
-        pooled_areas = tf.map_fn(curried_pool_roi, rois, dtype=tf.float32)
-        return pooled_areas
-
-    @staticmethod
-    def _pool_roi(feature_map, roi, pooled_height, pooled_width):
-        """ Applies ROI Pooling to a single image and a sinmgle RoI
+        i = tf.range(pooled)[tf.newaxis,:]
+        length = length[:,tf.newaxis]
+        small = small[:,tf.newaxis]
+        step = length//pooled
+        # an upsampled pixel r comes from pixel floor((r+0.5)/pooled)
+        lo = tf.where(small, (2*i*length+1)//(2*pooled), i*step)
+        hi = tf.where(small, (2*(i+1)*length-1)//(2*pooled)+1,\
+                tf.where(i+1 < pooled, (i+1)*step, length))
+        return lo, hi-lo
+
+    def _pool_exact(self, feature_map, rois):
+        """ Exact RoI max pooling of all RoIs of all images
         """
-
-        # Compute the region of interest
-        feature_map_height = int(feature_map.shape[0])
-        feature_map_width = int(feature_map.shape[1])
-
-        # change from (x, y, w, h)
-        # to (xmin, xmax, ymin, ymax)
-        x = roi[0]
-        y = roi[1]
-        w = roi[2]
-        h = roi[3]
-        bbox = (x, x+w, y-h, y)
-
-        w_start = tf.cast(feature_map_width*bbox[0], 'int32')
-        w_end = tf.cast(feature_map_width*bbox[1], 'int32')
-        h_start = tf.cast(feature_map_height*(1-bbox[3]), 'int32')
-        h_end = tf.cast(feature_map_height*(1-bbox[2]), 'int32')
-
-        region = feature_map[h_start:h_end, w_start:w_end, :]
-
-        # Divide the region into non overlapping areas
-        region_height = h_end - h_start
-        region_width  = w_end - w_start
-
-        # in case the feature area is smaller than the pooled area
-        if (region_height < pooled_height) or (region_width < pooled_width):
-            region = tf.image.resize(region,[region_height*pooled_height, region_width*pooled_width],method='nearest')
-            region_height = region_height*pooled_height
-            region_width = region_width*pooled_width
-
-
-        h_step = tf.cast( region_height / pooled_height, 'int32')
-        w_step = tf.cast( region_width  / pooled_width , 'int32')
-
-        areas = [[(
-                    i*h_step,
-                    j*w_step,
-                    (i+1)*h_step if i+1 < pooled_height else region_height,
-                    (j+1)*w_step if j+1 < pooled_width else region_width
-                   )
-                   for j in range(pooled_width)]
-                  for i in range(pooled_height)]
-
-        # take the maximum of each area and stack the result
-        def pool_area(x):
-          return tf.math.reduce_max(region[x[0]:x[2], x[1]:x[3], :], axis=[0,1])
-
-        pooled_features = tf.stack([[pool_area(x) for x in row] for row in areas])
-
-        return pooled_features
+        height = feature_map.shape[1]
+        width = feature_map.shape[2]
+        batch_size = tf.shape(rois)[0]
+        n_rois = tf.shape(rois)[1]
+        n_channels = feature_map.shape[3]
+
+        # change from (x, y, w, h) to whole pixels [top, bottom) and [left, right),
+        # truncated like slicing the feature map; a region keeps at least one pixel
+        xs, ys, ws, hs = tf.unstack(tf.reshape(rois, (-1, 4)), axis=1)
+        top = tf.clip_by_value(tf.cast(height*(1-ys), tf.int32), 0, height-1)
+        bottom = tf.clip_by_value(tf.cast(height*(1-(ys-hs)), tf.int32), top+1, height)
+        left = tf.clip_by_value(tf.cast(width*xs, tf.int32), 0, width-1)
+        right = tf.clip_by_value(tf.cast(width*(xs+ws), tf.int32), left+1, width)
+
+        # regions smaller than the output are upsampled by the pooled size
+        small = tf.logical_or(bottom-top < self.pooled_height, right-left < self.pooled_width)
+        row_lo, row_num = self._bin_edges(bottom-top, self.pooled_height, small)
+        col_lo, col_num = self._bin_edges(right-left, self.pooled_width, small)
+        row_lo = row_lo+top[:,tf.newaxis]
+        col_lo = col_lo+left[:,tf.newaxis]
+
+        # no bin is longer than these; short bins repeat their last pixel
+        max_rows = height//self.pooled_height+self.pooled_height+1
+        max_cols = width//self.pooled_width+self.pooled_width+1
+
+        box_indices = tf.broadcast_to(tf.repeat(tf.range(batch_size), n_rois)[:,tf.newaxis],\
+                        tf.shape(row_lo))
+        rows = None
+        for k in range(max_rows):
+            indices = tf.stack([box_indices, row_lo+tf.minimum(k, row_num-1)], axis=-1)
+            sample = tf.gather_nd(feature_map, indices)
+            rows = sample if rows is None else tf.maximum(rows, sample)
+
+        pooled = None
+        for k in range(max_cols):
+            sample = tf.gather(rows, col_lo+tf.minimum(k, col_num-1), axis=2, batch_dims=1)
+            pooled = sample if pooled is None else tf.maximum(pooled, sample)
+
+        pooled_areas = tf.reshape(pooled, (batch_size, n_rois, self.pooled_height,\
+                            self.pooled_width, n_channels))
+        return pooled_areas
 
     def get_config(self):
 
         config = super().get_config().copy()
         config.update({
             'pooled_height': self.pooled_height,
-            'pooled_width': self.pooled_width
+            'pooled_width': self.pooled_width,
+            'sampling_ratio': self.sampling_ratio,
+            'align': self.align
         })
         return config
@@ -14,7 +14,8 @@ from tensorflow.keras.losses import (
     CategoricalCrossentropy,
     Huber,
     MeanSquaredError,
-    Reduction
+    Reduction,
+    SparseCategoricalCrossentropy
 )
 from tensorflow.keras.backend import print_tensor
 
@@ -239,6 +240,58 @@ def top2_weighted_cce(y_real, y_predict):
 
     return score
 
+def _class_indices(y_real, y_predict):
+    # class-index truths (0 blank, 1 bg, 2 major) as an int32 map of y_predict's pixels
+    return tf.cast(tf.reshape(y_real, tf.shape(y_predict)[:-1]), tf.int32)
+
+def sparse_weighted_cce(y_real, y_predict):
+
+    labels = _class_indices(y_real, y_predict)
+
+    # pixel numbers of blank, bg and major
+    numArr = tf.math.bincount(tf.reshape(labels, [-1]), minlength=3, maxlength=3)
+    sum = tf.reduce_sum(numArr)
+    numArr = tf.where(tf.equal(numArr,0), sum, numArr)
+    weights = sum/numArr
+    weights = tf.cast(weights, tf.float32)
+
+    scce = SparseCategoricalCrossentropy(reduction=Reduction.NONE)
+
+    score = scce(labels, y_predict) * tf.gather(weights, labels)
+    score = tf.math.reduce_sum(score)
+    N = tf.size(y_predict[0])
+    N = tf.cast(N, tf.float32)
+
+    return score/N
+
+def sparse_top2_weighted_cce(y_real, y_predict):
+
+    labels = _class_indices(y_real, y_predict)
+    major_mask = tf.equal(labels, 2)
+    bg_mask = tf.equal(labels, 1)
+
+    major_indices = tf.where(major_mask)
+    bg_indices = tf.where(bg_mask)
+
+    majorNum = tf.cast(tf.size(major_indices), tf.float32)
+    bgNum = tf.cast(tf.size(bg_indices), tf.float32)
+
+    numArr = [majorNum, bgNum]
+    sum = majorNum+bgNum
+    numArr = tf.where(tf.equal(numArr,0), sum, numArr)
+    weights = tf.reduce_min(numArr)/numArr
+    weights = tf.cast(weights, tf.float32)
+
+    scce = SparseCategoricalCrossentropy(reduction=Reduction.NONE)
+    pixel_score = scce(labels, y_predict)
+
+    score_major = tf.math.reduce_sum(tf.boolean_mask(pixel_score, major_mask)) * weights[0]
+    score_bg = tf.math.reduce_sum(tf.boolean_mask(pixel_score, bg_mask)) * weights[1]
+
+    score = (score_major+score_bg)/(majorNum+bgNum)
+
+    return score
+
 def WeightedCCE(Y):
     num_class = Y.shape[-1]
 
@@ -292,6 +345,38 @@ def categorical_focal_loss(alpha, gamma=2.):
         return score/N
 
     return categorical_focal_loss_fixed
+
+def sparse_categorical_focal_loss(alpha, gamma=2.):
+
+    # alpha is ordered [major, bg, blank] as in categorical_focal_loss;
+    # reorder it to be indexed by class index
+    alpha = np.array(alpha, dtype=np.float32)[[2,1,0]]
+
+    def sparse_categorical_focal_loss_fixed(y_real, y_predict):
+
+        # Clip the prediction value to prevent NaN's and Inf's
+        epsilon = 1e-6
+        y_predict = tf.clip_by_value(y_predict, epsilon, 1. - epsilon)
+
+        labels = _class_indices(y_real, y_predict)
+        # predicted probability of the true class of every pixel
+        p_real = tf.gather(y_predict, labels, batch_dims=3)
+
+        scce = SparseCategoricalCrossentropy(reduction=Reduction.NONE)
+
+        score = scce(labels, y_predict)
+        # like categorical_focal_loss, blank pixels get no focal factor
+        focal = tf.math.pow(1-p_real, gamma)
+        score = score * tf.where(tf.equal(labels, 0), tf.ones_like(focal), focal)
+        score = score * tf.gather(alpha, labels)
+        score = tf.math.reduce_sum(score)
+
+        N = tf.size(y_predict[0])
+        N = tf.cast(N, tf.float32)
+
+        return score/N
+
+    return sparse_categorical_focal_loss_fixed
 # test benches
 def test_rpn_class_loss():
     # test tensorship is (1,3,3,1)
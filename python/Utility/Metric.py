@@ -85,6 +85,21 @@ def top2_categorical_accuracy(y_real, y_predict):
 
     return (score_major+score_bg)/sum*100
 
+def sparse_top2_categorical_accuracy(y_real, y_predict):
+
+    # class-index truths: 0 blank, 1 bg, 2 major
+    labels = tf.cast(tf.reshape(y_real, tf.shape(y_predict)[:-1]), tf.int64)
+    mask = labels >= 1
+
+    score_ew = tf.equal(tf.argmax(y_predict, axis=-1), labels)
+    score_ew = tf.cast(tf.boolean_mask(score_ew, mask), tf.float32)
+    score = tf.math.reduce_sum(score_ew)
+
+    N = tf.size(score_ew)
+    N = tf.cast(N, tf.float32)
+
+    return score/N*100
+
 def unmasked_IoU(t_r, t_p):
 
     mask = ~tf.math.is_nan(t_r)
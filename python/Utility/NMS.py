@@ -0,0 +1,141 @@
+## @package NMS
+#
+# Non-maximum suppression in NumPy.
+#
+# nms follows tf.image.non_max_suppression_with_scores: candidates need
+# score > score_threshold, hard NMS drops boxes whose IoU with a selected
+# box is > iou_threshold, and soft NMS (soft_nms_sigma > 0) decays scores by
+# exp(-0.5*IoU^2/soft_nms_sigma) instead. Boxes are [xmin, xmax, ymin, ymax]
+# as everywhere else in this repo, not TensorFlow's [y1, x1, y2, x2].
+# Nothing here imports TensorFlow, so it can run in worker processes.
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from Geometry import iou_matrix
+
+## NMS for the boxes of one image
+#
+# \pr{bboxes, numpy array, Boxes [xmin, xmax, ymin, ymax] of shape (n, 4).}
+# \pr{scores, numpy array, Scores of shape (n,).}
+# \pr{max_output_size, int, Maximum number of selected boxes.}
+# \pr{iou_threshold, float, Hard NMS drops boxes whose IoU with a selected box is larger.}
+# \pr{score_threshold, float, Boxes whose (decayed) score is not larger are dropped.}
+# \pr{soft_nms_sigma, float, Sigma of Gaussian soft NMS; 0 means hard NMS.}
+# \pr{ious, numpy array, Optional precomputed (n, n) IoU matrix of the boxes, e.g. shared by a parameter scan.}
+# \rt{selected_indices, numpy array, int64 indexes of the selected boxes in selection order.}
+# \rt{selected_scores, numpy array, float32 scores of the selected boxes.}
+def nms(bboxes, scores, max_output_size, iou_threshold=0.5,\
+        score_threshold=float('-inf'), soft_nms_sigma=0.0, ious=None):
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1,4)
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+
+    candidates = np.flatnonzero(scores > score_threshold)
+    if soft_nms_sigma > 0:
+        return _soft_nms(bboxes, scores, candidates, max_output_size,\
+                    score_threshold, soft_nms_sigma, ious)
+
+    # hard NMS: walk candidates from the highest score and drop their overlaps
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    boxes = bboxes[order]
+    alive = np.ones(len(order), dtype=bool)
+    selected = []
+    for i in range(len(order)):
+        if len(selected) == max_output_size:
+            break
+        if not alive[i]:
+            continue
+        selected.append(i)
+        if ious is None:
+            overlaps = iou_matrix(boxes[i], boxes[i+1:])[0]
+        else:
+            overlaps = ious[order[i], order[i+1:]]
+        alive[i+1:] &= overlaps <= iou_threshold
+
+    selected_indices = order[selected].astype(np.int64)
+    return selected_indices, scores[selected_indices]
+
+def _soft_nms(bboxes, scores, candidates, max_output_size, score_threshold, soft_nms_sigma, ious=None):
+    scale = -0.5/soft_nms_sigma
+    boxes = bboxes[candidates]
+    current = scores[candidates].astype(np.float32)
+    selected, selected_scores = [], []
+    while len(selected) < max_output_size and len(current) != 0:
+        # the first of equal scores wins, as in TensorFlow
+        best = int(np.argmax(current))
+        if not current[best] > score_threshold:
+            break
+        selected.append(best)
+        selected_scores.append(current[best])
+        if ious is None:
+            overlaps = iou_matrix(boxes[best], boxes)[0]
+        else:
+            overlaps = ious[candidates[best], candidates]
+        current = current*np.exp(scale*overlaps*overlaps).astype(np.float32)
+        current[selected] = -np.inf
+
+    selected_indices = candidates[selected].astype(np.int64)
+    return selected_indices, np.array(selected_scores, dtype=np.float32)
+
+## Pad per-image boxes into a batch
+#
+# \pr{bboxes, numpy array, Boxes of all images, shape (M, 4).}
+# \pr{scores, numpy array, Scores of all images, shape (M,).}
+# \pr{offsets, numpy array, Boxes of the n-th image are offsets[n]:offsets[n+1].}
+# \rt{batch_bboxes, numpy array, Padded boxes of shape (N, max_count, 4).}
+# \rt{batch_scores, numpy array, Padded scores of shape (N, max_count); padding is -inf.}
+# \rt{counts, numpy array, Number of real boxes of every image.}
+def pad_batch(bboxes, scores, offsets):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    imgNum = len(counts)
+    width = int(counts.max()) if imgNum != 0 else 0
+
+    img_idx = np.repeat(np.arange(imgNum), counts)
+    slot = np.arange(offsets[-1]) - offsets[img_idx]
+
+    batch_bboxes = np.zeros(shape=(imgNum, width, 4), dtype=np.float32)
+    batch_scores = np.full(shape=(imgNum, width), fill_value=-np.inf, dtype=np.float32)
+    batch_bboxes[img_idx, slot] = bboxes
+    batch_scores[img_idx, slot] = scores
+    return batch_bboxes, batch_scores, counts
+
+def _nms_star(args):
+    return nms(*args[:3], **args[3])
+
+## NMS for a padded batch of images
+#
+# \pr{bboxes, numpy array, Padded boxes of shape (N, m, 4).}
+# \pr{scores, numpy array, Padded scores of shape (N, m).}
+# \pr{counts, numpy array, Number of real boxes of every image; all m if None.}
+# \pr{max_output_size, int, Maximum number of selected boxes per image.}
+# \pr{processes, int, Number of worker processes; 0 runs in this process.}
+# \rt{selected_indices, numpy array, (N, max_output_size) indexes into each image; padding is -1.}
+# \rt{selected_scores, numpy array, (N, max_output_size) scores; padding is 0.}
+# \rt{num_selected, numpy array, Number of selected boxes of every image.}
+def batch_nms(bboxes, scores, counts, max_output_size, iou_threshold=0.5,\
+        score_threshold=float('-inf'), soft_nms_sigma=0.0, processes=0):
+    imgNum = len(bboxes)
+    if counts is None:
+        counts = np.full(imgNum, np.shape(scores)[1], dtype=np.int64)
+
+    kwargs = {'iou_threshold': iou_threshold,\
+                'score_threshold': score_threshold,\
+                'soft_nms_sigma': soft_nms_sigma}
+    jobs = [ (bboxes[n][:counts[n]], scores[n][:counts[n]], max_output_size, kwargs)\
+                for n in range(imgNum) ]
+    if processes > 0:
+        with Pool(processes) as pool:
+            results = pool.map(_nms_star, jobs)
+    else:
+        results = [_nms_star(job) for job in jobs]
+
+    selected_indices = np.full(shape=(imgNum, max_output_size), fill_value=-1, dtype=np.int64)
+    selected_scores = np.zeros(shape=(imgNum, max_output_size), dtype=np.float32)
+    num_selected = np.zeros(imgNum, dtype=np.int64)
+    for n, (indices, kept_scores) in enumerate(results):
+        num_selected[n] = len(indices)
+        selected_indices[n, :len(indices)] = indices
+        selected_scores[n, :len(indices)] = kept_scores
+    return selected_indices, selected_scores, num_selected
@@ -0,0 +1,90 @@
+## @package Preprocess
+#
+# Multi-process preprocessing of RPN training windows.
+#
+# Windows are handed to worker processes in chunks and come back in the
+# order of the image-bbox list, so the stores written from them do not
+# depend on the number of workers. Every window samples its label map with
+# its own generator seeded by the window id (Abstract.window_rng).
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from Abstract import score_anchors, make_label_map_by_scores, sample_label_map,\
+                        make_delta_map_by_scores, window_rng
+from Raster import image_index, open_images, read_image
+
+# state of a worker process, set once by _init_worker
+_worker = {}
+
+def _init_worker(img_dir, anchors, lim_lo, lim_up, posCut, nWant, seed):
+    _worker['img_dir'] = img_dir
+    _worker['images'] = open_images(img_dir)
+    _worker['anchors'] = anchors
+    _worker['limits'] = (lim_lo, lim_up)
+    _worker['sample'] = (posCut, nWant)
+    _worker['seed'] = seed
+
+## Make the RPN targets of a window
+#
+# \pr{anchors, numpy array, Normalized anchors made by \c make_anchors.}
+# \pr{bboxes, numpy array, Normalized bboxes of the window.}
+# \pr{lim_lo, float, Lower label limit of the RPN.}
+# \pr{lim_up, float, Upper label limit of the RPN.}
+# \pr{posCut, int, See \c sample_label_map.}
+# \pr{nWant, int, See \c sample_label_map.}
+# \pr{rng, numpy Generator, Random generator of the window, see \c window_rng.}
+# \rt{label_map, numpy array, The sampled label map.}
+# \rt{delta_map, numpy array, The delta map of shape (iNum, jNum, kNum*4).}
+def rpn_targets(anchors, bboxes, lim_lo, lim_up, posCut, nWant, rng):
+    score_map, bbox_map = score_anchors(anchors, bboxes)
+    raw_label_map = make_label_map_by_scores(score_map, lim_lo, lim_up)
+    sampled_label_map = sample_label_map(raw_label_map, posCut, nWant, rng=rng)
+    delta_map = make_delta_map_by_scores(score_map, bbox_map, lim_up, anchors)
+    return sampled_label_map, delta_map
+
+def _make_window(job):
+    img_name, bbox_list = job
+    lim_lo, lim_up = _worker['limits']
+    posCut, nWant = _worker['sample']
+
+    rng = window_rng(image_index(img_name), _worker['seed'])
+    sampled_label_map, delta_map = rpn_targets(_worker['anchors'], bbox_list,\
+                                        lim_lo, lim_up, posCut, nWant, rng)
+
+    # Check if both label and delta map have trainable data
+    labels_trainable = bool((~np.isnan(sampled_label_map)).any())
+    deltas_trainable = bool((~np.isnan(delta_map)).any())
+    if labels_trainable and deltas_trainable:
+        input = read_image(_worker['img_dir'], img_name, _worker['images'])
+    else:
+        input = None
+    return img_name, input, sampled_label_map, delta_map, labels_trainable, deltas_trainable
+
+## Make RPN inputs and targets of windows
+#
+# \pr{img_dir, Path object, A directory of PNG files or a sharded image store.}
+# \pr{img_bbox_list, list, [img_name, bboxes] pairs from \c make_img_bbox_arrays.}
+# \pr{anchors, numpy array, Normalized anchors made by \c make_anchors.}
+# \pr{lim_lo, float, Lower label limit of the RPN.}
+# \pr{lim_up, float, Upper label limit of the RPN.}
+# \pr{posCut, int, See \c sample_label_map.}
+# \pr{nWant, int, See \c sample_label_map.}
+# \pr{seed, int, Seed shared by all windows.}
+# \pr{processes, int, Number of worker processes; 0 runs in this process.}
+# \pr{chunksize, int, Number of windows sent to a worker at a time.}
+# \rt{windows, generator, Yields (img_name, input, label_map, delta_map,}
+# labels_trainable, deltas_trainable) in the order of img_bbox_list. The input
+# is the uint8 RGBA image, or None when the window is not trainable.
+def rpn_windows(img_dir, img_bbox_list, anchors, lim_lo, lim_up, posCut, nWant,\
+                    seed=0, processes=0, chunksize=8):
+    initargs = (img_dir, anchors, lim_lo, lim_up, posCut, nWant, seed)
+    if processes > 0:
+        with Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+            for window in pool.imap(_make_window, img_bbox_list, chunksize=chunksize):
+                yield window
+    else:
+        _init_worker(*initargs)
+        for job in img_bbox_list:
+            yield _make_window(job)
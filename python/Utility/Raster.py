@@ -0,0 +1,163 @@
+## @package Raster
+#
+# Renders hits straight into image arrays.
+#
+# The images used to be drawn by matplotlib with
+#   plt.figure(figsize=(8,8), dpi=resolution/8, frameon=False)
+#   plt.scatter(xs, ys, c='b', s=1)
+#   plt.xlim([-810, 810]); plt.ylim([-810, 810])
+# and saved as PNG. hit_raster reproduces that picture without a figure:
+# a transparent white background, blue anti-aliased round markers whose
+# diameter is the marker size plus its 1 pt edge, and the same
+# x, y -> pixel mapping (row 0 is y = +extent). With channels=1 only the
+# opacity is kept: it carries all of the hit information, as the color of
+# every marker is the same, and the image is 4 times smaller.
+#
+# density_raster histograms hits into the density photos of the track
+# extractor and keeps which hits fell into every pixel.
+
+import numpy as np
+
+from Storage import is_shard_store, ShardReader
+
+## Radius of a scatter marker in pixels
+#
+# \pr{size, float, Marker area in points^2, as the s argument of plt.scatter.}
+# \pr{resolution, int, Image side in pixels; the figure is 8 inches wide.}
+# \pr{linewidth, float, Width of the marker edge in points.}
+# \rt{radius, float, The marker radius in pixels.}
+def marker_radius(size, resolution, linewidth=1.0):
+    dpi = resolution/8
+    return (np.sqrt(size)+linewidth)*dpi/72/2
+
+## Render hits into an RGBA image
+#
+# \pr{xs, array like, x of hits in mm.}
+# \pr{ys, array like, y of hits in mm.}
+# \pr{resolution, int, Side of the square image in pixels.}
+# \pr{extent, float, Half width of the drawn area in mm.}
+# \pr{size, float, Marker area in points^2.}
+# \pr{alpha, float, Opacity of a single marker.}
+# \pr{color, tuple, RGB of the markers.}
+# \pr{channels, int, 4 for an RGBA image or 1 for the hit occupancy only.}
+# \rt{img, numpy array, uint8 array of shape (resolution, resolution, channels).}
+def hit_raster(xs, ys, resolution=512, extent=810.0, size=1.0, alpha=1.0, color=(0,0,255), channels=4):
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    ys = np.asarray(ys, dtype=np.float64).ravel()
+
+    # continuous pixel coordinates of hits
+    scale = resolution/(2.0*extent)
+    cols = (xs+extent)*scale
+    rows = (extent-ys)*scale
+
+    # every pixel whose center is within radius+0.5 of a hit
+    radius = marker_radius(size, resolution)
+    reach = int(np.ceil(radius+0.5))
+    offsets = np.arange(-reach, reach+1)
+    col_idx = np.floor(cols)[:,None,None].astype(np.int64) + offsets[None,None,:]
+    row_idx = np.floor(rows)[:,None,None].astype(np.int64) + offsets[None,:,None]
+    col_idx, row_idx = np.broadcast_arrays(col_idx, row_idx)
+    dist = np.hypot(col_idx+0.5-cols[:,None,None], row_idx+0.5-rows[:,None,None])
+
+    # pixel coverage of a marker, with a one pixel wide anti-aliased edge
+    coverage = np.clip(radius+0.5-dist, 0.0, 1.0)*alpha
+    inside = (coverage > 0) & (col_idx >= 0) & (col_idx < resolution)\
+                & (row_idx >= 0) & (row_idx < resolution)
+
+    # markers are composited with "over": 1-alpha multiplies
+    pixels = row_idx[inside]*resolution + col_idx[inside]
+    transparency = np.minimum(coverage[inside], 1.0-1e-7)
+    log_t = np.bincount(pixels, weights=np.log1p(-transparency),\
+                        minlength=resolution*resolution)
+    opacity = np.rint((1.0-np.exp(log_t))*255).astype(np.uint8)
+    if channels == 1:
+        return opacity.reshape(resolution, resolution, 1)
+
+    img = np.empty(shape=(resolution*resolution, 4), dtype=np.uint8)
+    img[:,:3] = 255
+    img[opacity > 0, :3] = color
+    img[:,3] = opacity
+    return img.reshape(resolution, resolution, 4)
+
+## Save an RGBA or single-channel image as PNG
+#
+# \pr{img, numpy array, uint8 image of shape (rows, columns, 4 or 1).}
+# \pr{file, Path object, Destination PNG file.}
+def save_png(img, file):
+    import PIL.Image
+    if img.shape[-1] == 1:
+        PIL.Image.fromarray(img[:,:,0], 'L').save(file)
+    else:
+        PIL.Image.fromarray(img, 'RGBA').save(file)
+
+## Histogram hits into a density photo
+#
+# Column c holds the hits with xbins[c] \f$\le\f$ x < xbins[c+1], and the
+# bins of ybins fill the photo from its bottom row up, as binning_objects
+# did row by row and column by column. Hits outside the bins are dropped.
+#
+# \pr{xs, array like, x of hits.}
+# \pr{ys, array like, y of hits.}
+# \pr{xbins, array like, Left/right boundaries of the columns.}
+# \pr{ybins, array like, Lower/upper boundaries of the rows.}
+# \pr{shape, tuple, (rows, columns) of the photo; one pixel per bin by default.}
+# \rt{density, numpy array, float32 number of hits in every pixel.}
+# \rt{hit_idx, numpy array, Hit indices sorted by their row-major pixel.}
+# \rt{offsets, numpy array, The hits of pixel p are hit_idx[offsets[p]:offsets[p+1]].}
+def density_raster(xs, ys, xbins, ybins, shape=None):
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    ys = np.asarray(ys, dtype=np.float64).ravel()
+    xbins = np.sort(np.asarray(xbins, dtype=np.float64))
+    ybins = np.sort(np.asarray(ybins, dtype=np.float64))
+    if shape is None:
+        shape = (len(ybins)-1, len(xbins)-1)
+    rowNum, colNum = shape
+
+    cols = np.searchsorted(xbins, xs, side='right')-1
+    rows = np.searchsorted(ybins, ys, side='right')-1
+    inside = (cols >= 0) & (cols < min(len(xbins)-1, colNum))\
+                & (rows >= 0) & (rows < min(len(ybins)-1, rowNum))
+
+    # row 0 of the photo is the highest y bin
+    pixels = (rowNum-rows[inside]-1)*colNum + cols[inside]
+    order = np.argsort(pixels, kind='stable')
+    hit_idx = np.flatnonzero(inside)[order]
+
+    counts = np.bincount(pixels, minlength=rowNum*colNum)
+    offsets = np.zeros(rowNum*colNum+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    density = counts.reshape(shape).astype(np.float32)
+    return density, hit_idx, offsets
+
+## Index of an image record in a sharded image store
+#
+# Images are named by their 1-based window number, e.g. 00001.png.
+#
+# \pr{img_name, str, Image name in the bbox table.}
+# \rt{index, int, The record index in the store.}
+def image_index(img_name):
+    return int(img_name.split('.')[0])-1
+
+## Open an image directory
+#
+# \pr{img_dir, Path object, A directory of PNG files or a sharded image store.}
+# \rt{images, ShardReader or None, The store, or None for a PNG directory.}
+def open_images(img_dir):
+    if is_shard_store(img_dir):
+        return ShardReader(img_dir)
+    return None
+
+## Read an image by its name in the bbox table
+#
+# \pr{img_dir, Path object, A directory of PNG files or a sharded image store.}
+# \pr{img_name, str, Image name in the bbox table.}
+# \pr{images, ShardReader, Optional store opened by \c open_images.}
+# \rt{img, numpy array, uint8 RGBA or single-channel image with a channel axis.}
+def read_image(img_dir, img_name, images=None):
+    if images is not None:
+        return np.array(images[image_index(img_name)])
+    import cv2
+    img = cv2.imread(str(img_dir.joinpath(img_name)), cv2.IMREAD_UNCHANGED)
+    if img.ndim == 2:
+        return img[:,:,np.newaxis]
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
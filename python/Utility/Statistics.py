@@ -0,0 +1,191 @@
+## @package Statistics
+#
+# Streaming statistics of datasets.
+#
+# A dataset is a directory of .npy/PNG records or a store made by
+# Storage.ShardWriter or Storage.SparseWriter. Its records are read a chunk
+# at a time by a thread pool, and every chunk is reduced to a few numbers:
+# the count, mean and sum of squared deviations of its values, which are
+# merged by the parallel form of Welford's algorithm, and optionally
+# per-class pixel counts and a histogram. Memory is bounded by the chunks
+# being read, not by the size of the dataset.
+#
+# Results are cached in an .npz file next to the dataset directory. The
+# cache records a manifest of the directory, the name, size and
+# modification time of every file in it, and is recomputed when the
+# manifest or the requested statistics change.
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+import numpy as np
+
+from Storage import is_shard_store, open_store
+
+stats_version = 1
+
+class RunningStats:
+    """ Mean and variance of a stream of values
+
+    Chunks are reduced to (count, mean, M2) in float64 and merged with
+    Chan et al.'s pairwise update of Welford's algorithm, so the result
+    does not suffer from the cancellation of sum(x^2) - sum(x)^2.
+    NaN values, e.g. the fill of sparse maps, are skipped.
+    """
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        mean = values.mean()
+        self.merge(RunningStats(len(values), mean, np.sum((values-mean)**2)))
+        return self
+
+    def merge(self, other):
+        count = self.count+other.count
+        if count == 0:
+            return self
+        delta = other.mean-self.mean
+        self.mean += delta*other.count/count
+        self.m2 += other.m2+delta**2*self.count*other.count/count
+        self.count = count
+        return self
+
+    @property
+    def var(self):
+        return self.m2/self.count if self.count != 0 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+## Count the pixels of every class in truth maps
+#
+# \pr{y, numpy array, Integer class-index maps or one-hot maps with the classes on the last axis.}
+# \pr{num_classes, int, Number of classes.}
+# \rt{counts, numpy array, Pixel number of every class; one-hot pixels count only if exactly one-hot.}
+def class_counts(y, num_classes):
+    if np.issubdtype(y.dtype, np.integer):
+        return np.bincount(y.ravel(), minlength=num_classes)[:num_classes].astype(np.int64)
+    y = y.reshape(-1, y.shape[-1])
+    onehot = (y==1) & (np.count_nonzero(y, axis=1)==1)[:,np.newaxis]
+    return np.count_nonzero(onehot, axis=0).astype(np.int64)
+
+def _open(data_dir):
+    if is_shard_store(data_dir):
+        return open_store(data_dir)
+    return sorted(data_dir.iterdir())
+
+def _read(records, indexes):
+    if not isinstance(records, list):
+        return records.take(indexes)
+    arrs = []
+    for k in indexes:
+        file = records[k]
+        if file.suffix == '.npy':
+            arrs.append(np.load(file))
+        else:
+            import PIL.Image
+            with PIL.Image.open(file) as img:
+                arrs.append(np.array(img))
+    return np.stack(arrs)
+
+def _chunk_stats(records, indexes, num_classes, bins):
+    arr = _read(records, indexes)
+    stats = RunningStats().add(arr)
+    counts = class_counts(arr, num_classes) if num_classes is not None else None
+    hist = np.histogram(arr[~np.isnan(arr)] if arr.dtype.kind == 'f' else arr, bins)[0]\
+                if bins is not None else None
+    return stats, counts, hist
+
+## Manifest of a dataset directory
+#
+# \pr{data_dir, Path object, A dataset directory.}
+# \rt{manifest, str, Digest of the name, size and modification time of every file.}
+def dataset_manifest(data_dir):
+    digest = hashlib.sha1()
+    for entry in sorted(os.scandir(data_dir), key=lambda entry: entry.name):
+        stat = entry.stat()
+        digest.update(f'{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+## Path of the statistics cache of a dataset directory
+def stats_file(data_dir):
+    data_dir = Path(data_dir)
+    return data_dir.with_name(data_dir.name+'.stats.npz')
+
+def _request_key(num_classes, bins):
+    edges = np.asarray(bins, dtype=np.float64).tobytes() if bins is not None else b''
+    return hashlib.sha1(f'{stats_version}\0{num_classes}\0'.encode()+edges).hexdigest()
+
+def _read_cache(file, manifest, key):
+    if not file.exists():
+        return None
+    with np.load(file) as data:
+        if str(data['manifest']) != manifest or str(data['key']) != key:
+            return None
+        return { name: data[name] for name in data.files if name not in ['manifest', 'key'] }
+
+def _write_cache(file, manifest, key, result):
+    tmp_file = file.with_name(file.name+'.tmp.npz')
+    arrays = { name: value for name, value in result.items() if value is not None }
+    np.savez(tmp_file, manifest=manifest, key=key, **arrays)
+    os.replace(tmp_file, file)
+
+## Statistics of a dataset
+#
+# \pr{data_dir, Path object, A directory of .npy/PNG records or a store.}
+# \pr{num_classes, int, If given, count the pixels of every class (see \c class_counts).}
+# \pr{bins, array like, If given, histogram edges of the values.}
+# \pr{workers, int, Number of reading threads.}
+# \pr{chunk, int, Number of records reduced at a time by a thread.}
+# \pr{use_cache, bool, Read and write the cache next to the directory.}
+# \rt{stats, dict, 'count', 'mean', 'var' and 'std' of all values, plus}
+# 'class_counts' and 'hist'/'bin_edges' when requested.
+def dataset_stats(data_dir, num_classes=None, bins=None, workers=4, chunk=64, use_cache=True):
+    data_dir = Path(data_dir)
+    if bins is not None:
+        bins = np.asarray(bins, dtype=np.float64)
+    key = _request_key(num_classes, bins)
+    if use_cache:
+        manifest = dataset_manifest(data_dir)
+        result = _read_cache(stats_file(data_dir), manifest, key)
+        if result is not None:
+            return result
+
+    records = _open(data_dir)
+    chunks = [ np.arange(start, min(start+chunk, len(records)))\
+                for start in range(0, len(records), chunk) ]
+    def reduce(indexes):
+        return _chunk_stats(records, indexes, num_classes, bins)
+
+    stats = RunningStats()
+    counts = np.zeros(num_classes, dtype=np.int64) if num_classes is not None else None
+    hist = np.zeros(len(bins)-1, dtype=np.int64) if bins is not None else None
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        # partial results are merged in chunk order, so the result does not
+        # depend on the number of workers
+        for chunk_stats, chunk_counts, chunk_hist in pool.map(reduce, chunks):
+            stats.merge(chunk_stats)
+            if counts is not None:
+                counts += chunk_counts
+            if hist is not None:
+                hist += chunk_hist
+
+    result = {'count': np.int64(stats.count),\
+                'mean': np.float64(stats.mean),\
+                'var': np.float64(stats.var),\
+                'std': np.float64(stats.std),\
+                'class_counts': counts,\
+                'hist': hist,\
+                'bin_edges': bins}
+    if use_cache:
+        _write_cache(stats_file(data_dir), manifest, key, result)
+    return { name: value for name, value in result.items() if value is not None }
@@ -0,0 +1,292 @@
+## @package Storage
+#
+# Sharded, memory-mapped containers for fixed-shape training records.
+#
+# A store is a directory holding a few large .npy shards and an index file.
+# Records are appended in order, so the i-th record written is the i-th
+# record read. Shards are opened by np.load(mmap_mode='r'), which means a
+# single record is a zero-copy view and only the touched pages are read.
+#
+# Two compact forms keep training sets small enough for the page cache:
+# a dense store may hold scaled integers, e.g. uint8 images, that readers
+# turn back into float32, and a sparse store keeps only the entries of
+# mostly-NaN records such as RPN label and delta maps.
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+index_name = 'index.json'
+store_version = 1
+
+## Tell if a directory is a sharded store
+#
+# \pr{store_dir, Path object, A directory.}
+# \rt{is_store, bool, True if store_dir has a shard index.}
+def is_shard_store(store_dir):
+    return Path(store_dir).joinpath(index_name).exists()
+
+class ShardWriter:
+    """ Appends fixed-shape records to a sharded store
+
+    # Constructor parameters
+        store_dir (Path) -- directory of the store; it is created if missing
+        record_shape (tuple) -- shape of every record
+        dtype -- numpy dtype of the records
+        shard_bytes (int) -- approximate size of a shard on disk
+        scale (float) -- if given, records are integers already scaled by
+          scale, e.g. raw uint8 images with 255, that are read back as
+          float32 record/scale; both dtype and the appended records must be
+          integer, so normalized floats are never truncated silently
+
+    The index is written by close(), so a store that was not closed is
+    never mistaken for a complete one.
+    """
+    def __init__(self, store_dir, record_shape, dtype=np.float32, shard_bytes=2**28, scale=None):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.store_dir.joinpath(index_name).unlink(missing_ok=True)
+
+        self.record_shape = tuple(int(n) for n in record_shape)
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+        if scale is not None:
+            assert np.issubdtype(self.dtype, np.integer), \
+                '[ERROR]: A scaled store holds integer records'
+        record_bytes = max(1, int(np.prod(self.record_shape))*self.dtype.itemsize)
+        self.shard_size = max(1, shard_bytes//record_bytes)
+
+        self.count = 0
+        self.shards = []
+        self.current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __new_shard(self):
+        name = f'shard_{str(len(self.shards)).zfill(5)}.npy'
+        self.current = np.lib.format.open_memmap(self.store_dir.joinpath(name),\
+            mode='w+', dtype=self.dtype, shape=(self.shard_size,)+self.record_shape)
+        self.shards.append(name)
+
+    def append(self, record):
+        if self.scale is not None:
+            assert np.issubdtype(np.asarray(record).dtype, np.integer), \
+                '[ERROR]: Records of a scaled store are appended as scaled integers'
+        offset = self.count % self.shard_size
+        if offset == 0:
+            self.__flush()
+            self.__new_shard()
+        self.current[offset] = record
+        self.count += 1
+        return self.count-1
+
+    def __flush(self):
+        if self.current is not None:
+            self.current.flush()
+            self.current = None
+
+    def close(self):
+        # trim the last shard so that it only holds written records
+        filled = self.count % self.shard_size
+        if self.current is not None and filled != 0:
+            last_file = self.store_dir.joinpath(self.shards[-1])
+            last = np.array(self.current[:filled])
+            self.current = None
+            np.save(last_file, last)
+        self.__flush()
+
+        index = {'version': store_version,\
+                'record_shape': list(self.record_shape),\
+                'dtype': self.dtype.str,\
+                'shard_size': self.shard_size,\
+                'scale': self.scale,\
+                'count': self.count,\
+                'shards': self.shards}
+        with open(self.store_dir.joinpath(index_name), 'w') as f:
+            json.dump(index, f)
+        return
+
+class ShardReader:
+    """ Reads records from a sharded store written by ShardWriter
+
+    reader[i] is a read-only view into a memory-mapped shard;
+    reader.take(indexes) gathers several records into one new array.
+    Records of a scaled store are returned as float32 copies instead.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir.joinpath(index_name)) as f:
+            index = json.load(f)
+
+        assert index['version'] == store_version, \
+            f'[ERROR]: Unsupported shard store version {index["version"]}'
+        assert index.get('format', 'dense') == 'dense', \
+            f'[ERROR]: {self.store_dir} is a sparse store; open it with SparseReader'
+
+        self.record_shape = tuple(index['record_shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.scale = index.get('scale')
+        if self.scale is not None:
+            self.dtype = np.dtype(np.float32)
+        self.shard_size = index['shard_size']
+        self.count = index['count']
+        self.shards = [np.load(self.store_dir.joinpath(name), mmap_mode='r')\
+                            for name in index['shards']]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError(f'record {idx} is out of range')
+        record = self.shards[idx//self.shard_size][idx%self.shard_size]
+        if self.scale is not None:
+            record = np.divide(record, self.scale, dtype=np.float32)
+        return record
+
+    def take(self, indexes, out=None):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if out is None:
+            out = np.empty(shape=(len(indexes),)+self.record_shape, dtype=self.dtype)
+        shard_idx = indexes//self.shard_size
+        offsets = indexes%self.shard_size
+        for s in np.unique(shard_idx):
+            mask = shard_idx == s
+            out[mask] = self.shards[s][offsets[mask]]
+        if self.scale is not None:
+            np.divide(out, self.scale, out=out)
+        return out
+
+class SparseWriter:
+    """ Appends mostly-empty fixed-shape records to a sparse store
+
+    # Constructor parameters
+        store_dir (Path) -- directory of the store; it is created if missing
+        record_shape (tuple) -- shape of every record
+        dtype -- numpy dtype of the kept values
+        fill_value (float) -- value of the entries that are not kept
+
+    Only entries different from fill_value are kept, as the flat indices
+    and values of all records concatenated and per-record offsets.
+    """
+    def __init__(self, store_dir, record_shape, dtype=np.float32, fill_value=np.nan):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.store_dir.joinpath(index_name).unlink(missing_ok=True)
+
+        self.record_shape = tuple(int(n) for n in record_shape)
+        self.dtype = np.dtype(dtype)
+        self.fill_value = float(fill_value)
+        self.indices = []
+        self.values = []
+        self.offsets = [0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def append(self, record):
+        record = np.asarray(record).reshape(-1)
+        if np.isnan(self.fill_value):
+            kept = np.flatnonzero(~np.isnan(record))
+        else:
+            kept = np.flatnonzero(record != self.fill_value)
+        self.indices.append(kept.astype(np.int32))
+        self.values.append(record[kept].astype(self.dtype))
+        self.offsets.append(self.offsets[-1]+len(kept))
+        return len(self)-1
+
+    def close(self):
+        np.save(self.store_dir.joinpath('indices.npy'),\
+                    np.concatenate(self.indices+[np.zeros(0, dtype=np.int32)]))
+        np.save(self.store_dir.joinpath('values.npy'),\
+                    np.concatenate(self.values+[np.zeros(0, dtype=self.dtype)]))
+        np.save(self.store_dir.joinpath('offsets.npy'), np.array(self.offsets, dtype=np.int64))
+
+        index = {'version': store_version,\
+                'format': 'sparse',\
+                'record_shape': list(self.record_shape),\
+                'dtype': self.dtype.str,\
+                'fill_value': None if np.isnan(self.fill_value) else self.fill_value,\
+                'count': len(self)}
+        with open(self.store_dir.joinpath(index_name), 'w') as f:
+            json.dump(index, f)
+        return
+
+class SparseReader:
+    """ Reads records from a sparse store written by SparseWriter
+
+    reader[i] and reader.take(indexes) expand records into float32 arrays
+    filled with the fill value of the store.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(self.store_dir.joinpath(index_name)) as f:
+            index = json.load(f)
+
+        assert index['version'] == store_version, \
+            f'[ERROR]: Unsupported shard store version {index["version"]}'
+        assert index.get('format') == 'sparse', \
+            f'[ERROR]: {self.store_dir} is not a sparse store'
+
+        self.record_shape = tuple(index['record_shape'])
+        self.dtype = np.dtype(np.float32)
+        self.fill_value = np.nan if index['fill_value'] is None else index['fill_value']
+        self.count = index['count']
+        self.indices = np.load(self.store_dir.joinpath('indices.npy'), mmap_mode='r')
+        self.values = np.load(self.store_dir.joinpath('values.npy'), mmap_mode='r')
+        self.offsets = np.load(self.store_dir.joinpath('offsets.npy'))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError(f'record {idx} is out of range')
+        return self.take([idx])[0]
+
+    def take(self, indexes, out=None):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if out is None:
+            out = np.empty(shape=(len(indexes),)+self.record_shape, dtype=self.dtype)
+        flat = out.reshape(len(indexes), -1)
+        flat[:] = self.fill_value
+
+        # positions of the kept entries of every requested record
+        starts = self.offsets[indexes]
+        counts = self.offsets[indexes+1]-starts
+        rows = np.repeat(np.arange(len(indexes)), counts)
+        positions = np.arange(counts.sum()) + np.repeat(starts-np.cumsum(counts)+counts, counts)
+        flat[rows, self.indices[positions]] = self.values[positions]
+
+        if not np.shares_memory(flat, out):
+            out[...] = flat.reshape(out.shape)
+        return out
+
+## Open a dense or sparse store
+#
+# \pr{store_dir, Path object, A directory made by ShardWriter or SparseWriter.}
+# \rt{reader, ShardReader or SparseReader, The reader of the store.}
+def open_store(store_dir):
+    with open(Path(store_dir).joinpath(index_name)) as f:
+        index = json.load(f)
+    if index.get('format', 'dense') == 'sparse':
+        return SparseReader(store_dir)
+    return ShardReader(store_dir)
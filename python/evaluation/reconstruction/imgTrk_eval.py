@@ -30,7 +30,7 @@ from Information import *
 from Configuration import extractor_config
 from Layers import *
 from Architectures import FC_DenseNet
-from HitGenerators import Stochastic
+from HitGenerators import Stochastic, window_dicts
 
 ### Using a specific pair of CPU and GPU
 # I pick the first GPU because it is faster
@@ -128,12 +128,15 @@ if __name__ == "__main__":
     iou_values = []
 
 
+    # draw all windows at once
+    batch = gen.generate_batch(windowNum)
+
     for i in range(windowNum):
         sys.stdout.write(t_info(f'Processing window: {i+1}/{windowNum}', '\r'))
         if i+1 == windowNum:
             sys.stdout.write('\n')
         sys.stdout.flush()
-        hit_dict, trks_ref = gen.generate(mode='eval')
+        hit_dict, trks_ref = window_dicts(batch, i)
         bboxes = track_detection(hit_dict, nms)
         trks_pred = track_extraction(hit_dict, bboxes)
 
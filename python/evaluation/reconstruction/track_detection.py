@@ -13,8 +13,6 @@ from datetime import datetime
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvas
 
 import tensorflow as tf
 from tensorflow.keras.regularizers import l2
@@ -29,7 +27,9 @@ from Abstract import make_anchors
 from Information import *
 from Configuration import frcnn_config
 from Layers import *
+from DataGenerator import open_records, load_records
 from HitGenerators import Stochastic
+from Raster import hit_raster, save_png
 
 
 ### load configuration object
@@ -45,46 +45,19 @@ C.rpn_model_name = 'rpn_mc_00'
 C.detector_model_name = 'detector_mc_RCNN_dr=0.0'
 
 ### plot hits
-layout = {'pad':0, 'h_pad':0, 'w_pad':0, 'rect':(0,0,1,1) }
-
 def plot_in_disk(hit_dict, resolution):
     hits = [ it for k, it in hit_dict.items()]
-    xs = []
-    ys = []
-    for hit in hits:
-        xs.append(hit[0])
-        ys.append(hit[1])
-    plt.figure(figsize=(8,8), dpi=resolution/8, frameon=False, tight_layout=layout)
-    plt.scatter(xs, ys, c='b', s=1)
-    plt.axis('scaled')
-    plt.axis('off')
-    plt.xlim([-810, 810])
-    plt.ylim([-810, 810])
+    xs = [hit[0] for hit in hits]
+    ys = [hit[1] for hit in hits]
     img_file = Path.cwd().joinpath('tmp_pic.png')
-    plt.savefig(img_file, bbox_inches='tight', pad_inches=0)
-    plt.close()
+    save_png(hit_raster(xs, ys, resolution, channels=C.input_shape[-1]), img_file)
     return img_file
 
 def plot_in_RAM(hit_dict, resolution):
     hits = [ it for k, it in hit_dict.items()]
-    xs = []
-    ys = []
-    for hit in hits:
-        xs.append(hit[0])
-        ys.append(hit[1])
-
-    fig = Figure(figsize=(8,8), dpi=resolution/8, frameon=False, tight_layout=layout)
-    canvas = FigureCanvas(fig)
-    ax = fig.subplots()
-    ax.scatter(xs, ys, c='b', s=1)
-    ax.set_aspect('equal', adjustable='datalim')
-    ax.set_axis_off()
-    ax.set_xlim([-810, 810])
-    ax.set_ylim([-810, 810])
-    # Force a draw so we can grab the pixel buffer
-    canvas.draw()
-    # grab the pixel buffer and dump it into a numpy array
-    x = np.array(canvas.renderer.buffer_rgba())
+    xs = [hit[0] for hit in hits]
+    ys = [hit[1] for hit in hits]
+    x = hit_raster(xs, ys, resolution, channels=C.input_shape[-1])
     return np.array([x/255.0], dtype=np.float32)
 
 mean = 5.0
@@ -153,7 +126,8 @@ def diagonal_to_xywh(diagonals):
     heights = tf.math.subtract(ymaxs, ymins)
     return tf.stack([xmins, ymaxs, widths, heights], axis=1)
 
-anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios)
+anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios,\
+            cache_dir=cwd.joinpath('anchors'))
 acs = tf.constant(anchors, dtype=tf.float32)
 
 labels_spec = tf.TensorSpec(shape=(32,32,18), dtype=tf.float32)
@@ -271,23 +245,20 @@ def track_detection(hits, nms):
 ### below is the test bench
 # construct data generator
 def gen_fn(dir, batch_size=1):
-    f_list = [child for child in dir.iterdir()]
+    records = open_records(dir)
 
-    indexes_all = np.arange(len(f_list))
+    indexes_all = np.arange(len(records))
 
-    iterNum = int(np.floor(len(f_list) / batch_size))
+    iterNum = int(np.floor(len(records) / batch_size))
 
     for index in range(iterNum):
         indexes = indexes_all[index*batch_size:(index+1)*batch_size]
-        f_list_slice = [f_list[k] for k in indexes]
-
-        arr = [np.load(f) for f in f_list_slice]
-        yield np.array(arr, dtype=np.float32)
+        yield load_records(records, indexes)
 
 gen = gen_fn(C.train_img_inputs_npy)
 
 # prepare input data for prediction
-iterNum = len([f for f in C.train_img_inputs_npy.glob('*')])
+iterNum = len(open_records(C.train_img_inputs_npy))
 df_r = pd.read_csv(C.train_bbox_reference_file, index_col=None)
 imgNames = df_r['FileName'].unique().tolist()
 colNames = list(df_r.columns.values)
@@ -1,23 +1,20 @@
 import sys
 from pathlib import Path
-from copy import deepcopy
 
 import numpy as np
 from scipy.stats import norm
 import pandas as pd
 from matplotlib import pyplot as plt
 
-import PIL
-from PIL import Image
-
 util_dir = Path.cwd().parent.parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
-from Abstract import binning_objects
+from Abstract import bin_indices
+from Raster import density_raster
 from Information import *
 from Configuration import extractor_config
 from Layers import *
 from Architectures import FC_DenseNet
-from HitGenerators import Stochastic
+from HitGenerators import Stochastic, window_dicts
 
 
 from track_detection import define_nms_fn
@@ -35,65 +32,36 @@ extractor_model.load_weights(str(Path.cwd().joinpath(weight_file_name)), by_name
 def select_hits_in_bbox(hits, bbox):
     x_bins = [-810, bbox[0]-1, bbox[1]+1, 810]
     y_bins = [-810, bbox[2]-1, bbox[3]+1, 810]
-    xs, ys = [], []
-    for id, pos in hits.items():
-        xs.append(pos[0])
-        ys.append(pos[1])
-    hit_selected_by_x = binning_objects(hits, xs, x_bins)[2]
-    hit_selected_by_y = binning_objects(hits, ys, y_bins)[2]
-    selected_hits = list(set(hit_selected_by_x).intersection(hit_selected_by_y))
-    return hits
+    if len(hits) == 0:
+        return {}
+    poses = np.array(list(hits.values()), dtype=np.float64)
+    in_bbox = (bin_indices(poses[:,0], x_bins)==2) & (bin_indices(poses[:,1], y_bins)==2)
+    selected_hits = { id: pos for (id, pos), inside in zip(hits.items(), in_bbox) if inside }
+    return selected_hits
 
 def make_density_photo(hits, resolution=256):
-    selected_mcs_x, selected_mcs_y = [], []
-    for key, pos in hits.items():
-        selected_mcs_x.append(pos[0])
-        selected_mcs_y.append(pos[1])
-
-    sorted_selected_mcs_x = deepcopy(selected_mcs_x)
-    sorted_selected_mcs_x.sort()
-
-    sorted_selected_mcs_y = deepcopy(selected_mcs_y)
-    sorted_selected_mcs_y.sort()
-
-    # create the blank input photo by resolution and the xy ratio
-    xmin = sorted_selected_mcs_x[0]
-    xmax = sorted_selected_mcs_x[-1]
-    ymin = sorted_selected_mcs_y[0]
-    ymax = sorted_selected_mcs_y[-1]
+    ids = np.array(list(hits.keys()))
+    poses = np.array(list(hits.values()), dtype=np.float64)
+    xs, ys = poses[:,0], poses[:,1]
+
+    # create the blank input photo by resolution
+    xmin, xmax = xs.min(), xs.max()
+    ymin, ymax = ys.min(), ys.max()
     x_delta = xmax - xmin
     y_delta = ymax - ymin
-    ratio = y_delta/x_delta
-
     xpixel, ypixel = resolution, resolution
-    density_photo = np.zeros(shape=(ypixel,xpixel), dtype=np.uint8)
-    id_photo = [ [ [] for _ in range(xpixel) ] for _ in range(ypixel)]
 
     # setup the x and y grids that are for sorting particles
     xstep = x_delta/xpixel
     ystep = y_delta/ypixel
-    xbins = [xmin + i*xstep for i in range(xpixel+1)]
+    xbins = xmin + np.arange(xpixel+1)*xstep
     xbins[-1] = xbins[-1]+1
-    ybins = [ymin + i*ystep for i in range(ypixel+1)]
+    ybins = ymin + np.arange(ypixel+1)*ystep
     ybins[-1] = ybins[-1]+1
 
-    # fill the density in the blank photo and truth
-    bins_by_row = binning_objects(hits, selected_mcs_y, ybins)[1:]
-    for row, bin in enumerate(bins_by_row):
-        x_bin_flatten = [ hits[id][0] for id in bin]
-        squares_by_column = binning_objects(bin, x_bin_flatten, xbins)[1:]
-        for col, square in enumerate(squares_by_column):
-            density = len(square)#number density
-            density_photo[ypixel-row-1][col] = density
-            if density!=0:
-                for id in square:
-                    id_photo[ypixel-row-1][col].append(id)
-
-    # convert density photo from uint8 to float32
-    im_in = Image.fromarray(density_photo)
-    density_photo = np.array(im_in, dtype=np.float32)
-
-    return density_photo, id_photo
+    # fill the density in the blank photo and map pixels to hit ids
+    density_photo, hit_idx, offsets = density_raster(xs, ys, xbins, ybins)
+    return density_photo, ids[hit_idx], offsets
 
 ### define a process-oriented function
 def track_extraction(hit_dict, bboxes):
@@ -117,7 +85,7 @@ def track_extraction(hit_dict, bboxes):
             continue
         # otherwise, grouping hits into tracks
         else:
-            density_photo, id_photo=make_density_photo(hits_s)
+            density_photo, pixel_ids, offsets = make_density_photo(hits_s)
 
         # predict the probality that a cell contains a track hit
         density_photo = np.expand_dims(density_photo, axis=0)
@@ -129,14 +97,11 @@ def track_extraction(hit_dict, bboxes):
         masks = maxIndices==2
 
         # move hits to a track list
-        for i, row in enumerate(masks):
-            for j, mask in enumerate(row):
-                if mask==True:
-                    cell = id_photo[i][j]
-                    if len(cell)!=0:
-                        for id in cell:
-                            track.append(id)
-                            hit_ids.remove(id)
+        pixels = np.flatnonzero(masks)
+        for pixel in pixels:
+            track += pixel_ids[offsets[pixel]:offsets[pixel+1]].tolist()
+        taken = set(track)
+        hit_ids = [id for id in hit_ids if id not in taken]
 
         # append this track to the summary of tracks
         tracks.append(track)
@@ -165,11 +130,14 @@ if __name__ == "__main__":
     nms = define_nms_fn(max_output_size=3000,\
             iou_threshold=.7, score_threshold=.5, soft_nms_sigma=1400.0)
 
+    # draw all windows at once
+    batch = gen.generate_batch(windowNum)
+
     for i in range(windowNum):
         sys.stdout.write(t_info(f'Processing window: {i+1}/{windowNum}', '\r'))
         if i+1 == windowNum:
             sys.stdout.write('\n')
         sys.stdout.flush()
-        hit_dict, trks_ref = gen.generate(mode='eval')
+        hit_dict, trks_ref = window_dicts(batch, i)
         bboxes = track_detection(hit_dict, nms)
         trks_pred = track_extraction(hit_dict, bboxes)
@@ -9,12 +9,11 @@ import pandas as pd
 util_dir = Path.cwd().parent.parent.parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Abstract import *
-from Geometry import iou
+from BboxTable import load_bbox_index
+from Evaluation import Evaluator
 from Information import *
 from Configuration import frcnn_config
 
-from mean_average_precision import MetricBuilder
-
 # Load configuration object
 cwd = Path.cwd()
 pickle_path = cwd.joinpath('frcnn.test.config.pickle')
@@ -27,152 +26,36 @@ performance_dir.mkdir(parents=True, exist_ok=True)
 
 ### object detection analysis function
 # return common metrics: precision, recall, degeneracy, and mAPs
-def od_analysis(ref_df, pred_df, IoU_cuts):
-    ### preparing the result dataframe
-
-    columns = ['Metric/IoU_cuts']+IoU_cuts
-    result_df = pd.DataFrame(columns = columns)
-    precision_row = ['precision']
-    recall_row = ['recall']
-    degeneracy_row = ['duplicity']
-    ap_row = ['AP']
-
-
-    grading_grids = []
-    imgs = ref_df['FileName'].unique()
-    ap_cols = [ [] for i in IoU_cuts] # every sub [] contains aps for every IoU
+def od_analysis(ref_index, pred_index, IoU_cuts):
+    evaluator = Evaluator(IoU_cuts, ap_thresholds=IoU_cuts)
 
+    imgs = ref_index.names.tolist()
     for img_idx, img in enumerate(imgs):
         sys.stdout.write(t_info(f"Parsing image: {img_idx+1}/{len(imgs)}", '\r'))
         if img_idx+1 == len(imgs):
             sys.stdout.write('\n')
         sys.stdout.flush()
 
-        ref_slice = ref_df[ref_df['FileName']==img]
-        pred_slice = pred_df[pred_df['FileName']==img]
-
-        ref_bboxes = [ [row['XMin'], row['XMax'], row['YMin'], row['YMax']] for index, row in ref_slice.iterrows() ]
-        pred_bboxes = [ [row['XMin'], row['XMax'], row['YMin'], row['YMax'], row['Score']] for index, row in pred_slice.iterrows() ]
-
-
-
-        gt = np.array([ [r['XMin'], r['YMin'], r['XMax'], r['YMax'], 0, 0, 0] for index,r in ref_slice.iterrows()])
-        preds = np.array([ [b[0], b[2], b[1], b[3], 0, b[4]]\
-                    for b in pred_bboxes])
+        evaluator.add(ref_index.get(img), pred_index.get(img), pred_index.get(img, 'Score'))
 
-        if len(pred_bboxes)==0:
-            for ap_col in ap_cols:
-                ap_col.append(0)
-        else:
-            # create metric_fn
-            metric_fn = MetricBuilder.build_evaluation_metric("map_2d", async_mode=True, num_classes=1)
-            # add some samples to evaluation
-            metric_fn.add(preds, gt)
-            for col_idx, iou_val in enumerate(IoU_cuts):
-                ap_cols[col_idx].append(metric_fn.value(iou_thresholds=iou_val)['mAP'])
-
-        # calculate precision, recall, and degeneracy
-        iNum = len(ref_bboxes)
-        jNum = len(pred_bboxes)
-        grading_grid = np.zeros(shape=(iNum, jNum))
-
-        for i, j in np.ndindex(iNum, jNum):
-            grading_grid[i,j] = iou(ref_bboxes[i], pred_bboxes[j])
-
-        grading_grids.append(grading_grid)
-
-    for ap_col in ap_cols:
-        ap_row.append(np.array(ap_col).mean())
-
-
-
-
-
-    ### Grading the RPN prediction after NMS
-    for iou_idx, iou_limit in enumerate(IoU_cuts):
-        sys.stdout.write(t_info(f"Processing iou cuts: {iou_idx+1}/{len(IoU_cuts)}", '\r'))
-        if iou_idx+1 == len(IoU_cuts):
-            sys.stdout.write('\n')
-        sys.stdout.flush()
-
-
-        precisions = []
-        recalls = []
-        degeneracies = []
-
-        for grading_grid in grading_grids:
-            iNum, jNum = grading_grid.shape
-
-            tp = 0
-            fp = 0
-            fn = 0
-
-            for i in range(iNum):
-                row = grading_grid[i]
-                if np.any(row>=iou_limit):
-                    degeneracy = np.count_nonzero(row>=iou_limit)
-                    degeneracies.append(degeneracy)
-
-                else:
-                    degeneracies.append(0)
-                    fn += 1
-
-            for j in range(jNum):
-                col = grading_grid[:,j]
-                if np.any(col>=iou_limit):
-                    tp += 1
-                else:
-                    fp += 1
-
-            dom1 = tp+fp
-
-            # dom1 == 0 when no ROI is proposed
-            if dom1!=0:
-                precision = tp/dom1
-                precisions.append(precision)
-
-            recall = tp/(tp+fn)
-            recalls.append(recall)
-
-        if len(precisions)!=0:
-            precision_entry = np.array(precisions).mean()
-            precision_row.append(precision_entry)
-        else:
-            precision_row.append([])
-
-        if len(recalls)!=0:
-            recall_entry = np.array(recalls).mean()
-            recall_row.append(recall_entry)
-        else:
-            recall_row.append([])
-
-        if len(degeneracies)!=0:
-            degeneracy_entry = np.array(degeneracies).mean()
-            degeneracy_row.append(degeneracy_entry)
-        else:
-            degeneracy_row.append([])
-
-
-    precision_df = pd.DataFrame([precision_row], columns=columns)
-    recall_df = pd.DataFrame([recall_row], columns=columns)
-    degeneracy_df = pd.DataFrame([degeneracy_row], columns=columns)
-    ap_df = pd.DataFrame([ap_row], columns=columns)
-
-    result_df = result_df.append(precision_df, ignore_index=True)
-    result_df = result_df.append(recall_df, ignore_index=True)
-    result_df = result_df.append(degeneracy_df, ignore_index=True)
-    result_df = result_df.append(ap_df, ignore_index=True)
+    ### preparing the result dataframe
+    summary = evaluator.summary()
+    columns = ['Metric/IoU_cuts']+IoU_cuts
+    result_df = pd.DataFrame([ ['precision']+summary['precision'].tolist(),\
+                                ['recall']+summary['recall'].tolist(),\
+                                ['duplicity']+summary['degeneracy'].tolist(),\
+                                ['AP']+summary['ap'].tolist() ], columns=columns)
 
     return result_df
 
 # load real bboxes and predicted bboxes
 IoU_cuts = [0.5, 0.55, 0.60, 0.65, 0.70, 0.75, 0.80, 0.85, 0.90, 0.95]
-ref_df = pd.read_csv(C.train_bbox_reference_file, index_col=0)
+ref_index = load_bbox_index(C.train_bbox_reference_file)
 
 pred_files = [f for f in prediction_dir.glob('*.csv')]
 for i, pred_file in enumerate(pred_files):
     pinfo(f'Evaluating predictions {i+1}/{len(pred_files)}: {pred_file.name}')
-    pred_df = pd.read_csv(pred_file, index_col=0)
+    pred_index = load_bbox_index(pred_file)
     fileName = pred_file.name[::-1].split('_',1)[1][::-1]+'_performance.csv'
     file = performance_dir.joinpath(fileName)
 
@@ -180,7 +63,7 @@ for i, pred_file in enumerate(pred_files):
         read_df = pd.read_csv(file, index_col=0)
         print(read_df)
     else:
-        rs_df = od_analysis(ref_df, pred_df, IoU_cuts)
+        rs_df = od_analysis(ref_index, pred_index, IoU_cuts)
         rs_df.to_csv(file)
         print(rs_df)
 
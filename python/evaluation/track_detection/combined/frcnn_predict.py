@@ -24,6 +24,8 @@ from Abstract import make_anchors
 from Information import *
 from Configuration import frcnn_config
 from Layers import *
+from DataGenerator import open_records
+from Inference import FrcnnPredictor
 
 ### Using a specific pair of CPU and GPU
 # I pick the first GPU because it is faster
@@ -57,68 +59,9 @@ model_rpn.load_weights(\
 model_rpn.load_weights(\
         str(cwd.joinpath(C.detector_model_name+'.h5')), by_name=True)
 
-### build an RPN-to_RoI function
-@tf.function(experimental_relax_shapes=True)
-def delta_to_roi(acs, dts):
-    txs, tys, tws, ths = tf.unstack(dts, axis=1)
-    xmins, xmaxs, ymins, ymaxs = tf.unstack(acs, axis=1)
-    xas = tf.math.divide(tf.math.add(xmins,xmaxs), 2.0) # center xs
-    yas = tf.math.divide(tf.math.add(ymins,ymaxs), 2.0) # center ys
-    was = tf.math.subtract(xmaxs,xmins) # widths
-    has = tf.math.subtract(ymaxs,ymins) # heightss
-
-    xs = tf.math.add(\
-            tf.math.multiply(txs,was), xas)
-    ys = tf.math.add(\
-            tf.math.multiply(tys,has), yas)
-    ws = tf.math.multiply(\
-            tf.math.exp(tws), was)
-    hs = tf.math.multiply(\
-            tf.math.exp(ths), has)
-
-    xmins = tf.math.subtract(xs, tf.math.divide(ws, 2.0))
-    xmaxs = tf.math.add(xs, tf.math.divide(ws, 2.0))
-    ymins = tf.math.subtract(ys, tf.math.divide(hs, 2.0))
-    ymaxs = tf.math.add(ys, tf.math.divide(hs, 2.0))
-    rois = tf.stack([ymaxs, xmins, ymins, xmaxs], axis=1)
-    rois = tf.clip_by_value(t=rois, clip_value_min=0, clip_value_max=1)
-    return rois
-
-
-@tf.function(experimental_relax_shapes=True)
-def diagonal_to_xywh(diagonals):
-    # diagonal: (ymaxs, xmins, ymins, xmaxs)
-    # xywh: (xmins, ymaxs, widths, heights)
-    ymaxs, xmins, ymins, xmaxs = tf.unstack(diagonals, axis=1)
-    widths = tf.math.subtract(xmaxs, xmins)
-    heights = tf.math.subtract(ymaxs, ymins)
-    return tf.stack([xmins, ymaxs, widths, heights], axis=1)
-
-anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios)
-acs = tf.constant(anchors, dtype=tf.float32)
-
-labels_spec = tf.TensorSpec(shape=(32,32,18), dtype=tf.float32)
-deltas_spec = tf.TensorSpec(shape=(32,32,72), dtype=tf.float32)
-@tf.function(input_signature=[labels_spec, deltas_spec])
-def rpn_to_roi(lbs, dts):
-    h,w,d = lbs.shape
-    dts_flat = tf.reshape(dts, shape=(h,w,d,4))
-    indices = tf.where(tf.math.greater(lbs,0.5))
-    scores = tf.gather_nd(params=lbs, indices=indices)
-    acs_want = tf.gather_nd(params=acs, indices=indices)
-    dts_want = tf.gather_nd(params=dts_flat, indices=indices)
-
-    rois = delta_to_roi(acs_want, dts_want)
-
-    selected_indices, selected_scores =\
-    non_max_suppression_with_scores(rois, scores,\
-                max_output_size=2000,\
-                iou_threshold=0.7, score_threshold=0.0,\
-                soft_nms_sigma=0.0)
-
-    rois_want = tf.gather(params=rois, indices=selected_indices)
-    rois_xywh = diagonal_to_xywh(rois_want)
-    return rois_xywh, selected_scores
+### anchors of the RPN
+anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios,\
+            cache_dir=cwd.joinpath('anchors'))
 
 # rebuild detector
 detector_fetch = Input(shape=(32, 32, 512), name='base_to_detector')
@@ -141,126 +84,12 @@ model_detector.load_weights(\
 
 
 
-# construct data generator
-def gen_fn(dir, batch_size=1):
-    f_list = [child for child in dir.iterdir()]
-
-    indexes_all = np.arange(len(f_list))
-
-    iterNum = int(np.floor(len(f_list) / batch_size))
-
-    for index in range(iterNum):
-        indexes = indexes_all[index*batch_size:(index+1)*batch_size]
-        f_list_slice = [f_list[k] for k in indexes]
-
-        arr = [np.load(f) for f in f_list_slice]
-        yield np.array(arr, dtype=np.float32)
-
-gen = gen_fn(C.train_img_inputs_npy)
-
-# prepare input data for prediction
-iterNum = len([f for f in C.train_img_inputs_npy.glob('*')])
+# predict by frcnn, a batch of images at a time
+predictor = FrcnnPredictor(model_rpn, model_detector, anchors, batch_size=8,\
+                max_output_size=2000, iou_threshold=0.7, score_threshold=0.0)
 df_r = pd.read_csv(C.train_bbox_reference_file, index_col=None)
 imgNames = df_r['FileName'].unique().tolist()
-colNames = list(df_r.columns.values)
-colName_dict = {cn:[] for i,cn in enumerate(colNames) if i>0}
-colName_dict['Score'] = []
-# prepare output data frame
-df_o0 = pd.DataFrame.from_dict(colName_dict)
-df_o1 = pd.DataFrame.from_dict(colName_dict)
-df_o2 = pd.DataFrame.from_dict(colName_dict)
-
-
-def delta_to_bbox(d):
-    # proposal t = (x, y, w, h) as indicated in the original paper
-    # (x,y) is the left upper corner
-    p = [d[0], d[0]+d[2], d[1]-d[3], d[1]]
-    if p[0] < 0:
-        p[0] = 0
-    if p[1] > 1:
-        p[1] = 1
-    if p[2] < 0:
-        p[2] = 0
-    if p[3] > 0:
-        p[3] = 1
-    return p
-
-@tf.function(experimental_relax_shapes=True)
-def xywh_to_bbox(xywhs):
-    # xywh: (xmins, ymaxs, widths, heights)
-    # bbox: (xmins, xmaxs, ymins, ymaxs)
-    xmins, ymaxs, widths, heights = tf.unstack(xywhs, axis=1)
-    xmaxs = tf.math.add(xmins,widths)
-    ymins = tf.math.subtract(ymaxs,heights)
-    return tf.stack([xmins, xmaxs, ymins, ymaxs], axis=1)
-
-# manually iterate to predict by frcnn
-for i in range(iterNum):
-    sys.stdout.write(t_info(f'Processing image {i+1}/{iterNum}', '\r'))
-    if i+1 == iterNum:
-        sys.stdout.write('\n')
-    sys.stdout.flush()
-
-    x = next(gen)
-
-    imgName = imgNames[i]
-
-    ftr_maps, rpn_score_maps, rpn_delta_maps = model_rpn.predict_on_batch(x)
-    rpn_scores = np.squeeze(rpn_score_maps, axis=0)
-    rpn_deltas = np.squeeze(rpn_delta_maps, axis=0)
-
-    rois, rpn_scores = rpn_to_roi(rpn_scores, rpn_deltas)
-    rpn_proposals = xywh_to_bbox(rois).numpy()
-    rpn_scores = rpn_scores.numpy()
-
-    for proposal, score in zip(rpn_proposals, rpn_scores):
-        o0= {'FileName':imgName,\
-            'XMin':proposal[0], 'XMax':proposal[1],\
-            'YMin':proposal[2], 'YMax':proposal[3],\
-            'Score':score}
-
-        df_o0 = df_o0.append(o0, ignore_index=True)
-
-    rois = np.expand_dims(rois, axis=0)
-    detector_label_maps, detector_delta_maps =\
-        model_detector.predict_on_batch([ftr_maps, rois])
-
-    detector_labels = np.squeeze(detector_label_maps, axis=0)
-    detector_deltas = np.squeeze(detector_delta_maps, axis=0)
-    detector_deltas = np.reshape(detector_deltas, (detector_deltas.shape[0],-1, 4))
-
-    maxIndexes = np.argmax(detector_labels, axis=1)
-    bg_mask = maxIndexes!=0 # only want bg_score < 0.5 proposals
-    frcnn_proposals = rpn_proposals[bg_mask]
-
-    ### calculate non-bg score
-    selected_labels = detector_labels[bg_mask]
-    frcnn_scores = np.amax(selected_labels, axis=1)
-
-    deltas_raws = detector_deltas[bg_mask]
-    oj_indexes = np.argmax(selected_labels, axis=1)
-    deltas = []
-    for j,oj_index in enumerate(oj_indexes):
-        deltas.append(deltas_raws[j,oj_index,:])
-    deltas = np.array(deltas, dtype=np.float32)
-
-    # print(deltas.shape)
-    for proposal, score, delta in zip(frcnn_proposals, frcnn_scores, deltas):
-        o1 = {'FileName':imgName,\
-            'XMin':proposal[0], 'XMax':proposal[1],\
-            'YMin':proposal[2], 'YMax':proposal[3],\
-            'Score':score,\
-            'ClassName':11}
-
-        proposal = delta_to_bbox(delta)
-        o2 = {'FileName':imgName,\
-            'XMin':proposal[0], 'XMax':proposal[1],\
-            'YMin':proposal[2], 'YMax':proposal[3],\
-            'Score':score,\
-            'ClassName':11}
-
-        df_o1 = df_o1.append(o1, ignore_index=True)
-        df_o2 = df_o2.append(o2, ignore_index=True)
+df_o0, df_o1, df_o2 = predictor.predict(open_records(C.train_img_inputs_npy), imgNames)
 
 pred_f0 = prediction_dir.joinpath('rpn_predictions.csv')
 pred_f1 = prediction_dir.joinpath('rpn+detector_cls_predictions.csv')
@@ -2,29 +2,116 @@
 import sys
 from pathlib import Path
 import pickle
-import cv2
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
-import tensorflow as tf
-from tensorflow.image import non_max_suppression_with_scores
-import matplotlib.pyplot as plt
 
 util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Abstract import *
-from Geometry import iou
+from Geometry import iou_matrix
+from NMS import nms
+from BboxTable import load_bbox_index
+from Evaluation import stat_names, image_stats, image_aps
 from Information import *
 from Configuration import frcnn_config
-
-from mean_average_precision import MetricBuilder
 ### import ends
 
+# IoU thresholds of mAP@.5, mAP@.75 and the ten of mAP@[.5,.95]
+ap_thresholds = np.concatenate([[0.5, 0.75], np.arange(0.5, 1.0, 0.05)])
+
+### Load reference and prediction bboxes grouped by image
+def load_images(reference_file, prediction_file):
+    ref_index = load_bbox_index(reference_file)
+    pred_index = load_bbox_index(prediction_file)
+    images = [ (ref_index.get(img), pred_index.get(img), pred_index.get(img, 'Score'))\
+                    for img in ref_index.names.tolist() ]
+    return images
+
+### Grade all NMS parameter points on one image
+# The IoU matrices of the image are computed once and shared by all points.
+# Returns stats of shape (pointNum, cutNum, len(stat_names)) and
+# maps of shape (pointNum, 3).
+def grade_image(ref_bboxes, pred_bboxes, scores, points, IoU_cuts, max_output_size):
+    pred_ious = iou_matrix(pred_bboxes, pred_bboxes)
+    ref_ious = iou_matrix(ref_bboxes, pred_bboxes)
+
+    stats = np.zeros(shape=(len(points), len(IoU_cuts), len(stat_names)))
+    maps = np.zeros(shape=(len(points), 3))
+    for p, (iou_threshold, score_threshold, soft_nms_sigma) in enumerate(points):
+        # NMS to reduce duplicity
+        selected_indices, selected_score =\
+        nms(pred_bboxes, scores,\
+                    max_output_size=max_output_size,\
+                    iou_threshold=iou_threshold, score_threshold=score_threshold,\
+                    soft_nms_sigma=soft_nms_sigma, ious=pred_ious)
+
+        grading_grid = ref_ious[:, selected_indices]
+        aps = image_aps(grading_grid, selected_score, ap_thresholds)
+        maps[p] = [aps[0], aps[1], aps[2:].mean()]
+
+        # calculate precision, recall, and degeneracy
+        stats[p] = image_stats(grading_grid, IoU_cuts)
+
+    return stats, maps
+
+def _grade_star(args):
+    return grade_image(*args)
+
+### Evaluate NMS parameter points over a whole set of images
+# points is a list of (iou_threshold, score_threshold, soft_nms_sigma).
+# Images are graded in parallel by worker processes; every worker computes
+# the IoU matrices of an image once for all points.
+# Returns a table with one row per (point, IoU cut).
+def grid_search(reference_file, prediction_file, points, IoU_cuts, max_output_size,\
+                    processes=0, chunksize=16):
+    images = load_images(reference_file, prediction_file)
+    jobs = [ (ref, pred, scores, points, IoU_cuts, max_output_size)\
+                for ref, pred, scores in images ]
+
+    stats = np.zeros(shape=(len(points), len(IoU_cuts), len(stat_names)))
+    maps = np.zeros(shape=(len(points), 3))
+    def accumulate(results):
+        for img_idx, (img_stats, img_maps) in enumerate(results):
+            sys.stdout.write(t_info(f"Parsing image: {img_idx+1}/{len(jobs)}", '\r'))
+            if img_idx+1 == len(jobs):
+                sys.stdout.write('\n')
+            sys.stdout.flush()
+            stats[:] += img_stats
+            maps[:] += img_maps
+
+    if processes > 0:
+        with Pool(processes) as pool:
+            accumulate(pool.imap(_grade_star, jobs, chunksize=chunksize))
+    else:
+        accumulate(map(_grade_star, jobs))
+
+    def mean(total, num):
+        return total/num if num!=0 else np.nan
+
+    maps /= max(len(jobs), 1)
+    rows = []
+    for p, (iou_threshold, score_threshold, soft_nms_sigma) in enumerate(points):
+        for c, iou_limit in enumerate(IoU_cuts):
+            s = stats[p,c]
+            rows.append({'IoU_threshold': iou_threshold,\
+                        'Score_threshold': score_threshold,\
+                        'Sigma': soft_nms_sigma,\
+                        'IoU_cut': iou_limit,\
+                        'Precision': mean(s[0], s[1]),\
+                        'Recall': mean(s[2], s[3]),\
+                        'Degeneracy': mean(s[4], s[5]),\
+                        'mAP@.5': maps[p,0],\
+                        'mAP@.75': maps[p,1],\
+                        'mAP@[.5,.95]': maps[p,2]})
+    return pd.DataFrame(rows)
+
 ### This function analysis the result of NMS given a SINGLE set of parameters
 def region_proposal_analysis(C, max_output_size, iou_threshold, score_threshold,\
  soft_nms_sigma, IoU_cuts=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]):
 
-    ### load reference and prediction bbox table to pandas framework
+    ### load reference and prediction bbox table
     # construct file object
     data_dir = C.sub_data_dir
     data_dir = data_dir.joinpath('NMS analysis nodes')
@@ -32,172 +119,17 @@ def region_proposal_analysis(C, max_output_size, iou_threshold, score_threshold,
     reference_file = data_dir.joinpath(C.validation_bbox_reference_file)
     prediction_file = data_dir.joinpath(C.validation_bbox_prediction_file)
 
-
-    # read csv to df
-    ref_df = pd.read_csv(reference_file, index_col=None)
-    pred_df = pd.read_csv(prediction_file, index_col=None)
+    ### Grading the RPN prediction after NMS
+    points = [(iou_threshold, score_threshold, soft_nms_sigma)]
+    grid_df = grid_search(reference_file, prediction_file, points, IoU_cuts, max_output_size)
 
     ### preparing the result dataframe
     columns = ['Metric/IoU_cuts']+IoU_cuts
-    result_df = pd.DataFrame(columns = columns)
-    precision_row = ['precision']
-    recall_row = ['recall']
-    degeneracy_row = ['degeneracy']
-    map1_row = ['mAP@.5']
-    map2_row = ['mAP@.75']
-    map3_row = ['mAP@[.5,.95]']
-
-    ### Grading the RPN prediction after NMS
-    grading_grids = []
-    imgs = ref_df['FileName'].unique()
-
-    map1s, map2s, map3s = [], [], []
-
-    for img_idx, img in enumerate(imgs):
-        sys.stdout.write(t_info(f"Parsing image: {img_idx+1}/{len(imgs)}", '\r'))
-        if img_idx+1 == len(imgs):
-            sys.stdout.write('\n')
-        sys.stdout.flush()
-
-
-        ref_slice = ref_df[ref_df['FileName']==img]
-        pred_slice = pred_df[pred_df['FileName']==img]
-
-        ref_bboxes = [ [row['XMin'], row['XMax'], row['YMin'], row['YMax']] for index, row in ref_slice.iterrows() ]
-        pred_bboxes_raw = [ [row['XMin'], row['XMax'], row['YMin'], row['YMax']] for index, row in pred_slice.iterrows() ]
-
-        # Preprocess for NMS
-        scores = [ row['Score'] for index, row in pred_slice.iterrows() ]
-        scores_tf = tf.constant(scores, dtype=tf.float32)
-        pred_bboxes_raw_tf = [ [ymax, xmin, ymin, xmax] for [xmin, xmax, ymin, ymax] in pred_bboxes_raw ]
-        pred_bboxes_raw_tf = tf.constant(pred_bboxes_raw_tf, dtype=tf.float32)
-
-        # NMS to reduce duplicity
-        selected_indices, selected_score =\
-        non_max_suppression_with_scores(pred_bboxes_raw_tf, scores_tf,\
-                    max_output_size=max_output_size,\
-                    iou_threshold=iou_threshold, score_threshold=score_threshold,\
-                    soft_nms_sigma=soft_nms_sigma)
-
-        selected_indices_list = selected_indices.numpy().tolist()
-        pred_bboxes = [ pred_bboxes_raw[index] for index in selected_indices_list ]
-
-        selected_score = selected_score.numpy().tolist()
-
-        gt = np.array([ [r['XMin'], r['YMin'], r['XMax'], r['YMax'], 0, 0, 0] for index,r in ref_slice.iterrows()])
-
-        preds = np.array([ [b[0], b[2], b[1], b[3], 0, score]\
-                    for b, score in zip(pred_bboxes, selected_score)])
-
-        if len(pred_bboxes)==0:
-            map1s.append(0)
-            map2s.append(0)
-            map3s.append(0)
-        else:
-            # create metric_fn
-            metric_fn = MetricBuilder.build_evaluation_metric("map_2d", async_mode=True, num_classes=1)
-            # add some samples to evaluation
-            metric_fn.add(preds, gt)
-
-            map1 = metric_fn.value(iou_thresholds=0.5)['mAP']
-            map2 = metric_fn.value(iou_thresholds=0.75)['mAP']
-            map3 = metric_fn.value(iou_thresholds=np.arange(0.5, 1.0, 0.05))['mAP']
-
-            map1s.append(map1)
-            map2s.append(map2)
-            map3s.append(map3)
-
-        # calculate precision, recall, and degeneracy
-        iNum = len(ref_bboxes)
-        jNum = len(pred_bboxes)
-        grading_grid = np.zeros(shape=(iNum, jNum))
-
-        for i, j in np.ndindex(iNum, jNum):
-            grading_grid[i,j] = iou(ref_bboxes[i], pred_bboxes[j])
-
-        grading_grids.append(grading_grid)
-
-
-    for iou_idx, iou_limit in enumerate(IoU_cuts):
-
-        sys.stdout.write(t_info(f"Processing iou cuts: {iou_idx+1}/{len(IoU_cuts)}", '\r'))
-        if iou_idx+1 == len(IoU_cuts):
-            sys.stdout.write('\n')
-        sys.stdout.flush()
-
-        precisions = []
-        recalls = []
-        degeneracies = []
-
-        for grading_grid in grading_grids:
-            iNum, jNum = grading_grid.shape
-
-            tp = 0
-            fp = 0
-            fn = 0
-
-            for i in range(iNum):
-                row = grading_grid[i]
-                if np.any(row>=iou_limit):
-                    degeneracy = np.count_nonzero(row>=iou_limit)
-                    degeneracies.append(degeneracy)
-
-                else:
-                    degeneracies.append(0)
-                    fn += 1
-
-            for j in range(jNum):
-                col = grading_grid[:,j]
-                if np.any(col>=iou_limit):
-                    tp += 1
-                else:
-                    fp += 1
-
-            dom1 = tp+fp
-
-            if dom1!=0:
-                precision = tp/dom1
-                precisions.append(precision)
-
-            recall = tp/(tp+fn)
-            recalls.append(recall)
-
-        if len(precisions)!=0:
-            precision_entry = np.array(precisions).mean()
-            precision_row.append(precision_entry)
-        else:
-            precision_row.append([])
-
-        if len(recalls)!=0:
-            recall_entry = np.array(recalls).mean()
-            recall_row.append(recall_entry)
-        else:
-            recall_row.append([])
-
-        if len(degeneracies)!=0:
-            degeneracy_entry = np.array(degeneracies).mean()
-            degeneracy_row.append(degeneracy_entry)
-        else:
-            degeneracy_row.append([])
-
-        map1_row.append(np.array(map1s).mean())
-        map2_row.append(np.array(map2s).mean())
-        map3_row.append(np.array(map3s).mean())
-
-
-    precision_df = pd.DataFrame([precision_row], columns=columns)
-    recall_df = pd.DataFrame([recall_row], columns=columns)
-    degeneracy_df = pd.DataFrame([degeneracy_row], columns=columns)
-    map1_df = pd.DataFrame([map1_row], columns=columns)
-    map2_df = pd.DataFrame([map2_row], columns=columns)
-    map3_df = pd.DataFrame([map3_row], columns=columns)
-
-    result_df = result_df.append(precision_df, ignore_index=True)
-    result_df = result_df.append(recall_df, ignore_index=True)
-    result_df = result_df.append(degeneracy_df, ignore_index=True)
-    result_df = result_df.append(map1_df, ignore_index=True)
-    result_df = result_df.append(map2_df, ignore_index=True)
-    result_df = result_df.append(map3_df, ignore_index=True)
+    metrics = [('precision', 'Precision'), ('recall', 'Recall'),\
+                ('degeneracy', 'Degeneracy'), ('mAP@.5', 'mAP@.5'),\
+                ('mAP@.75', 'mAP@.75'), ('mAP@[.5,.95]', 'mAP@[.5,.95]')]
+    result_df = pd.DataFrame([ [row_name]+grid_df[name].tolist() for row_name, name in metrics ],\
+                                columns=columns)
 
     result_file = data_dir.joinpath(f'NMS_analysis_IT={iou_threshold}_ST={score_threshold}_Sigma={soft_nms_sigma}')
     result_df.to_csv(result_file)
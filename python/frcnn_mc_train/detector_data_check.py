@@ -18,14 +18,14 @@ util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Database import *
 from Configuration import frcnn_config
-from Abstract import binning_objects
+from Abstract import binning_objects, make_img_bbox_arrays
 from Geometry import iou
 from Information import *
 
 def check_data(C, checkNum):
 
-    df = pd.read_csv(C.train_bbox_reference_file,index_col=None)
-    imgNames = df['FileName'].unique().tolist()
+    img_bbox_dict, img_class_dict, classes = make_img_bbox_arrays(C.train_bbox_reference_file)
+    imgNames = list(img_bbox_dict.keys())
     imgNum = len(imgNames)
     res = C.resolution
 
@@ -42,8 +42,7 @@ def check_data(C, checkNum):
         imgName = imgNames[idx]
         img = mpimg.imread(C.train_img_dir.joinpath(imgName))
 
-        slice = df[df['FileName']==imgName]
-        bboxes = [ [r['XMin'], r['XMax'], r['YMin'], r['YMax']] for z,r in slice.iterrows() ]
+        bboxes = img_bbox_dict[imgName].tolist()
 
 
 
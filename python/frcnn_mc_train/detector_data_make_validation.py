@@ -5,8 +5,6 @@ from pathlib import Path
 import shutil
 import timeit
 import pickle
-import random
-from copy import copy
 
 import numpy as np
 np.random.seed(0)
@@ -17,13 +15,17 @@ util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Database import *
 from Configuration import frcnn_config
-from Abstract import binning_objects
-from Geometry import iou
+from Abstract import make_detector_targets
+from BboxTable import load_bbox_index
 from Information import *
+from Storage import ShardWriter
 
 import tensorflow as tf
 
-def make_data(C,):
+def make_data(C, storage='npy'):
+
+    assert (storage in ['npy', 'shard']),\
+        t_error('Unsupported storage! Storage has to be either \'npy\' or \'shard\'')
 
     # initialize path objects
     cwd = Path.cwd()
@@ -41,71 +43,49 @@ def make_data(C,):
     shutil.rmtree(Y_regressor_dir, ignore_errors=True)
     Y_regressor_dir.mkdir(parents=True, exist_ok=True)
 
-    # load reference and prediction dataframes
-    df_r = pd.read_csv(C.validation_bbox_reference_file, index_col=0)
-    df_p = pd.read_csv(C.validation_bbox_proposal_file, index_col=0)
+    # load reference and prediction bboxes grouped by image
+    ref_index = load_bbox_index(C.validation_bbox_reference_file)
+    prop_index = load_bbox_index(C.validation_bbox_proposal_file)
 
     # one-hot encoder
     oneHotEncoder = C.oneHotEncoder
 
-    imgNames = df_r['FileName'].unique().tolist()
-    assert imgNames==df_p['FileName'].unique().tolist(),\
+    imgNames = ref_index.names.tolist()
+    assert imgNames==prop_index.names.tolist(),\
         perr('bbox_file\'s images do not agree with bbox_prediction_file\'s images')
 
     # calculate how many negative examples we want
     negThreshold = np.int(C.roiNum*C.negativeRate)
 
+    # open sharded stores; records are appended in the order of file_idx
+    if storage == 'shard':
+        roi_writer = ShardWriter(roi_dir, (C.roiNum, 4), np.float32)
+        Y_classifier_writer = ShardWriter(Y_classifier_dir, (C.roiNum, len(oneHotEncoder)), np.float32)
+        Y_regressor_writer = ShardWriter(Y_regressor_dir, (C.roiNum, len(oneHotEncoder)*4), np.float32)
+
+    classNum = len(oneHotEncoder)
+
     file_idx = 0
     for img_idx, img in enumerate(imgNames):
 
-        # register memory for input and output data
-        rois = np.zeros(shape=(C.roiNum, 4))
-        rois[:] = np.nan
-        outputs_classifier = np.zeros(shape=(C.roiNum, len(oneHotEncoder)), dtype=np.float32)
-        outputs_classifier[:] = np.nan
-        outputs_regressor = np.zeros(shape=(C.roiNum, len(oneHotEncoder)*4), dtype=np.float32)
-        outputs_regressor[:] = np.nan
-
         sys.stdout.write(t_info(f"Parsing image: {img_idx+1}/{len(imgNames)}", '\r'))
         if img_idx+1 == len(imgNames):
             sys.stdout.write('\n')
         sys.stdout.flush()
 
-        df_r_slice = df_r[df_r['FileName']==img]
-        df_p_slice = df_p[df_p['FileName']==img]
-
-        bbox_pdgId_pairs =\
-         [   [[r['XMin'], r['XMax'], r['YMin'], r['YMax']],\
-                        r['ClassName']] \
-                 for i, r in df_r_slice.iterrows()]
-        proposals = [ [r['XMin'], r['XMax'], r['YMin'], r['YMax']] for i, r in df_p_slice.iterrows()]
-
-        pos_tuples = []
-        neg_tuples = []
-
-        # iterate over proposed bboxes to sort them into positives and negatives
-        for proposal in proposals:
-            iou_highest=0
-            label = None
-            ref_bbox = None
-            for bbox, pdgId in bbox_pdgId_pairs:
-                iou_tmp = iou(bbox, proposal)
-                if iou_tmp > iou_highest:
-                    iou_highest = iou_tmp
-                    label = pdgId
-                    ref_bbox = bbox
-            if label == '-11':
-                continue
-            if iou_highest > 0.5:
-                pos_tuples.append((proposal, label, ref_bbox))
-            elif iou_highest > 0.0:
-                neg_tuples.append((proposal, 'bg', ref_bbox))
+        bboxes = ref_index.get(img)
+        pdgIds = ref_index.get(img, 'ClassName').tolist()
+        proposals = prop_index.get(img)
+        class_idx = np.array([np.argmax(oneHotEncoder[pdgId]) for pdgId in pdgIds], dtype=np.int64)
+        # proposals matched to these bboxes are neither positive nor negative
+        skip = np.array([pdgId == '-11' for pdgId in pdgIds], dtype=bool)
 
-        # calculate the number of positive example and negative example
-        posNum = len(pos_tuples)
+        rois, outputs_classifier, outputs_regressor, posNum =\
+            make_detector_targets(proposals, bboxes, class_idx, classNum,\
+                C.roiNum, negThreshold, pos_lim=0.5, neg_lim=0.0, skip=skip)
 
-        posNum = len(pos_tuples)
-        referenceNum = len(df_r_slice['ClassName'].tolist())
+        # calculate the number of positive example and negative example
+        referenceNum = len(bboxes)
 
         if posNum < referenceNum:
             sys.stdout.write('\n')
@@ -114,84 +94,27 @@ def make_data(C,):
             perr(f'Details: proposed: {posNum}, reference: {referenceNum}')
             sys.exit()
 
-        negNum = len(neg_tuples)
-        totNum = posNum + negNum
-
-        roiNum = C.roiNum
-
-        if totNum < roiNum:
-            tuples_combined = pos_tuples+neg_tuples # The original/whole sample
-            sampleNum = len(tuples_combined)
-
-            tuples_selected = copy(tuples_combined)
-            totNum = len(tuples_selected)
-            roiNeedNum = roiNum-totNum
-
-            while roiNeedNum != 0:
-
-                if sampleNum < roiNeedNum:
-                    tuples_selected += tuples_combined
-                    totNum = len(tuples_selected)
-                    roiNeedNum = roiNum - totNum
-                else:
-                    tuples_selected += random.sample(tuples_combined, roiNeedNum)
-                    totNum = len(tuples_selected)
-                    roiNeedNum = roiNum - totNum
-
-            assert len(tuples_selected)==roiNum, pdebug(len(tuples_selected))
-
+        # save data to disk
+        if storage == 'shard':
+            roi_writer.append(rois)
+            Y_classifier_writer.append(outputs_classifier)
+            Y_regressor_writer.append(outputs_regressor)
         else:
+            roi_file = roi_dir.joinpath(f'roi_{str(file_idx).zfill(7)}.npy')
+            Y_classifier_file = Y_classifier_dir.joinpath(f'y_classifier_{str(file_idx).zfill(7)}.npy')
+            Y_regressor_file = Y_regressor_dir.joinpath(f'y_regressor_{str(file_idx).zfill(7)}.npy')
 
-            if negNum < negThreshold:
-                negWant = negNum
-                posWant = roiNum - negWant
-            elif (negThreshold + posNum) >= roiNum:
-                negWant = negThreshold
-                posWant = roiNum - negThreshold
-            else:
-                posWant = posNum
-                negWant = roiNum - posWant
-
-            # randomly select RoIs for training
-            pos_selected = random.sample(pos_tuples, posWant)
-            neg_selected = random.sample(neg_tuples, negWant)
-
-            # combine negative examples and positive examples and shuffle
-            tuples_selected = pos_selected + neg_selected
-
-        random.shuffle(tuples_selected)
-
-        # copy the result to the registered memory
-        for i, tuple in enumerate(tuples_selected):
-            proposal, label, ref_bbox = tuple
-            # proposal t = (x, y, w, h) as indicated in the original paper
-            # (x,y) is the left upper corner
-            t = [ proposal[0], proposal[3],\
-                        (proposal[1]-proposal[0]), (proposal[3]-proposal[2]) ]
-            rois[i] = np.array(t, dtype=np.float32)
-
-            oneHotVector = oneHotEncoder[label]
-            outputs_classifier[i] = oneHotVector
-
-            # refernece bbox v = (x,y,w,h) as indicated in the original paper
-            # (x,y) is the left upper corner
-            v = [ ref_bbox[0], ref_bbox[3],\
-                        (ref_bbox[1]-ref_bbox[0]), (ref_bbox[3]-ref_bbox[2]) ]
-            record_start = np.where(oneHotVector==1)[0][0] *4
-            record_end = record_start + 4
-            outputs_regressor[i][record_start:record_end] = v
-
-        roi_file = roi_dir.joinpath(f'roi_{str(file_idx).zfill(7)}.npy')
-        Y_classifier_file = Y_classifier_dir.joinpath(f'y_classifier_{str(file_idx).zfill(7)}.npy')
-        Y_regressor_file = Y_regressor_dir.joinpath(f'y_regressor_{str(file_idx).zfill(7)}.npy')
-
-        # save data to disk
-        np.save(roi_file, rois)
-        np.save(Y_classifier_file, outputs_classifier)
-        np.save(Y_regressor_file, outputs_regressor)
+            np.save(roi_file, rois)
+            np.save(Y_classifier_file, outputs_classifier)
+            np.save(Y_regressor_file, outputs_regressor)
 
         file_idx += 1
 
+    if storage == 'shard':
+        roi_writer.close()
+        Y_classifier_writer.close()
+        Y_regressor_writer.close()
+
 
     # save file path to config and dump it
     C.set_detector_validation_data(roi_dir, Y_classifier_dir, Y_regressor_dir)
@@ -5,14 +5,11 @@
 import sys
 from pathlib import Path
 import pickle
-import random
-from copy import copy
 
 import numpy as np
 import pandas as pd
 
 import tensorflow as tf
-from tensorflow.image import non_max_suppression_with_scores
 from tensorflow.keras import Model
 from tensorflow.keras.layers import Input, Dense, Conv2D, Dropout, Flatten, Reshape, Softmax
 from tensorflow.keras.optimizers import Adam
@@ -21,6 +18,8 @@ from tensorflow.keras.metrics import CategoricalAccuracy
 util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Abstract import *
+from NMS import nms
+from BboxTable import load_bbox_index
 from Information import *
 from Configuration import frcnn_config
 from Layers import rpn, RoIPooling
@@ -32,75 +31,25 @@ from Information import *
 def rpn_to_roi(C, score_maps, delta_maps):
     ### pass output through nms
     # make anchors
-    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios)
-
-    # initialize parameters
-    bbox_idx = 0
-    dict_for_df={}
-
-
-    # prepare reference and prediction dataframes
-    df_r = pd.read_csv(C.bbox_reference_file, index_col=0)
-    imgNames = df_r['FileName'].unique().tolist()
-
-    for img_name, score_map, delta_map in zip(imgNames, score_maps, delta_maps):
-        score_bbox_pairs = propose_score_bbox_list(anchors, score_map, delta_map)
-
-        scores, bboxes_raw = [], []
-        for score_bbox in score_bbox_pairs:
-            scores.append(score_bbox[0])
-            bboxes_raw.append(score_bbox[1])
-
-        # trimming bboxes
-        for i, bbox in enumerate(bboxes_raw):
-            if bbox[0] < 0:
-                bboxes_raw[i][0] = 0
-            if bbox[1] > 1:
-                bboxes_raw[i][1] = 1
-            if bbox[2] < 0:
-                bboxes_raw[i][2] = 0
-            if bbox[3] > 1:
-                bboxes_raw[i][3] = 1
-
-        scores_tf = tf.constant(scores, dtype=tf.float32)
-        bboxes_raw_tf = [ [ymax, xmin, ymin, xmax] for [xmin, xmax, ymin, ymax] in bboxes_raw ]
-        bboxes_raw_tf = tf.constant(bboxes_raw_tf, dtype=tf.float32)
-        selected_indices, selected_scores =\
-            non_max_suppression_with_scores(bboxes_raw_tf, scores_tf,\
-                max_output_size=100,\
-                iou_threshold=0.7, score_threshold=0.9,\
-                soft_nms_sigma=0.0)
-
-        selected_indices_list = selected_indices.numpy().tolist()
-        bboxes = [ bboxes_raw[index] for index in selected_indices_list ]
-
-        for score, bbox in zip(scores, bboxes):
-            dict_for_df[bbox_idx] = {'FileName': str(img_name),\
-                                'XMin':bbox[0],\
-                                'XMax':bbox[1],\
-                                'YMin':bbox[2],\
-                                'YMax':bbox[3],\
-                                'Score':score}
-            bbox_idx += 1
+    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios,\
+                cache_dir=C.data_dir.joinpath('anchors'))
 
+    # prepare reference bboxes grouped by image
+    ref_index = load_bbox_index(C.bbox_reference_file)
+    imgNames = ref_index.names.tolist()
 
-    df_p = pd.DataFrame.from_dict(dict_for_df, "index")
-
+    # proposals of all images are decoded and trimmed at once
+    scores, bboxes_raw, offsets = decode_rpn_outputs(anchors, score_maps, delta_maps)
 
     ### make training data for detector
     # register memory for input and output data
     oneHotEncoder = C.oneHotEncoder
+    classNum = len(oneHotEncoder)
 
-    inputs = np.load(C.img_inputs_npy)
-    imgNum = inputs.shape[0]
-    rois = np.zeros(shape=(imgNum, C.roiNum, 4))
-    rois[:] = np.nan
-    outputs_classifier = np.zeros(shape=(imgNum, C.roiNum, len(oneHotEncoder)), dtype=np.float32)
-    outputs_classifier[:] = np.nan
-    outputs_regressor = np.zeros(shape=(imgNum, C.roiNum, len(oneHotEncoder)*4), dtype=np.float32)
-    outputs_regressor[:] = np.nan
-
-
+    imgNum = len(imgNames)
+    rois = np.zeros(shape=(imgNum, C.roiNum, 4), dtype=np.float32)
+    outputs_classifier = np.zeros(shape=(imgNum, C.roiNum, classNum), dtype=np.float32)
+    outputs_regressor = np.zeros(shape=(imgNum, C.roiNum, classNum*4), dtype=np.float32)
 
     # calculate how many negative examples we want
     negThreshold = np.int(C.roiNum*C.negativeRate)
@@ -112,102 +61,22 @@ def rpn_to_roi(C, score_maps, delta_maps):
             sys.stdout.write('\n')
         sys.stdout.flush()
 
-        df_r_slice = df_r[df_r['FileName']==img]
-        df_p_slice = df_p[df_p['FileName']==img]
-
-        bbox_pdgId_pairs =\
-         [   [[r['XMin'], r['XMax'], r['YMin'], r['YMax']],\
-                        r['ClassName']] \
-                 for i, r in df_r_slice.iterrows()]
-        proposals = [ [r['XMin'], r['XMax'], r['YMin'], r['YMax']] for i, r in df_p_slice.iterrows()]
-
-        pos_tuples = []
-        neg_tuples = []
-
-        # iterate over proposed bboxes to sort them into positives and negatives
-        for proposal in proposals:
-            iou_highest=0
-            label = None
-            ref_bbox = None
-            for bbox, pdgId in bbox_pdgId_pairs:
-                iou_tmp = iou(bbox, proposal)
-                if iou_tmp > iou_highest:
-                    iou_highest = iou_tmp
-                    label = pdgId
-                    ref_bbox = bbox
-            if iou_highest > 0.5:
-                pos_tuples.append((proposal, label, ref_bbox))
-            elif iou_highest > 0.1:
-                neg_tuples.append((proposal, 'bg', ref_bbox))
-
-        # calculate the number of positive example and negative example
-        posNum = len(pos_tuples)
-        negNum = len(neg_tuples)
-        totNum = posNum + negNum
-
-        roiNum = C.roiNum
-
-        if totNum < roiNum:
-            tuples_combined = pos_tuples+neg_tuples # The original/whole sample
-            sampleNum = len(tuples_combined)
-
-            tuples_selected = copy(tuples_combined)
-            totNum = len(tuples_selected)
-            roiNeedNum = roiNum-totNum
-
-            while roiNeedNum != 0:
-
-                if sampleNum < roiNeedNum:
-                    tuples_selected += tuples_combined
-                    totNum = len(tuples_selected)
-                    roiNeedNum = roiNum - totNum
-                else:
-                    tuples_selected += random.sample(tuples_combined, roiNeedNum)
-                    totNum = len(tuples_selected)
-                    roiNeedNum = roiNum - totNum
-
-            assert len(tuples_selected)==roiNum, pdebug(len(tuples_selected))
-
-        else:
-
-            if negNum < negThreshold:
-                negWant = negNum
-                posWant = roiNum - negWant
-            elif (negThreshold + posNum) >= roiNum:
-                negWant = negThreshold
-                posWant = roiNum - negThreshold
-            else:
-                posWant = posNum
-                negWant = roiNum - posWant
-
-            # randomly select RoIs for training
-            pos_selected = random.sample(pos_tuples, posWant)
-            neg_selected = random.sample(neg_tuples, negWant)
-
-            # combine negative examples and positive examples and shuffle
-            tuples_selected = pos_selected + neg_selected
-
-        random.shuffle(tuples_selected)
-
-        # copy the result to the registered memory
-        for i, tuple in enumerate(tuples_selected):
-            proposal, label, ref_bbox = tuple
-            # proposal t = (x, y, w, h) as indicated in the original paper
-            # (x,y) is the left upper corner
-            t = [ proposal[0], proposal[3],\
-                        (proposal[1]-proposal[0]), (proposal[3]-proposal[2]) ]
-            rois[img_idx][i] = np.array(t, dtype=np.float32)
-
-            oneHotVector = oneHotEncoder[label]
-            outputs_classifier[img_idx][i] = oneHotVector
-
-            # refernece bbox v = (x,y,w,h) as indicated in the original paper
-            # (x,y) is the left upper corner
-            v = [ ref_bbox[0], ref_bbox[3],\
-                        (ref_bbox[1]-ref_bbox[0]), (ref_bbox[3]-ref_bbox[2]) ]
-            record_start = np.where(oneHotVector==1)[0][0] *4
-            record_end = record_start + 4
-            outputs_regressor[img_idx][i][record_start:record_end] = v
+        img_bboxes = bboxes_raw[offsets[img_idx]:offsets[img_idx+1]]
+        img_scores = scores[offsets[img_idx]:offsets[img_idx+1]]
+        selected_indices, selected_scores =\
+            nms(img_bboxes, img_scores,\
+                max_output_size=100,\
+                iou_threshold=0.7, score_threshold=0.9,\
+                soft_nms_sigma=0.0)
+        proposals = img_bboxes[selected_indices]
+
+        bboxes = ref_index.get(img)
+        pdgIds = ref_index.get(img, 'ClassName').tolist()
+        class_idx = np.array([np.argmax(oneHotEncoder[pdgId]) for pdgId in pdgIds], dtype=np.int64)
+
+        rois[img_idx], outputs_classifier[img_idx], outputs_regressor[img_idx], posNum =\
+            make_detector_targets(proposals, bboxes, class_idx, classNum,\
+                C.roiNum, negThreshold, pos_lim=0.5, neg_lim=0.1)
 
     return rois, outputs_classifier, outputs_regressor
 
@@ -20,8 +20,6 @@ from collections import Counter
 import numpy as np
 np.random.seed(0)
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
 
 from sqlalchemy import *
 
@@ -29,10 +27,12 @@ util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Database import *
 from Configuration import frcnn_config
-from Abstract import binning_objects
+from Abstract import bin_objects, bin_indices
 from Information import *
+from Raster import hit_raster, save_png
+from Storage import ShardWriter
 
-def make_data_from_dp(track_dir, dp_name, window, resolution, mode='first'):
+def make_data_from_dp(track_dir, dp_name, window, resolution, mode='first', channels=4):
 
     # mode check
     assert (mode in ['first', 'append']),\
@@ -83,36 +83,28 @@ def make_data_from_dp(track_dir, dp_name, window, resolution, mode='first'):
     pinfo('Making images')
     hits = session.query(StrawDigiMC).all()
     hit_times = [hit.t_reco for hit in hits]
-    hit_groups = binning_objects(hits, hit_times, wds)
-    groupNum = len(hit_groups)
+    hit_order, group_offsets = bin_objects(hit_times, wds)
+    groupNum = len(group_offsets)-1
 
     # make image for each group
     img_list = []
-    for idx, group in enumerate(hit_groups):
+    for idx in range(groupNum):
+        group = [ hits[i] for i in hit_order[group_offsets[idx]:group_offsets[idx+1]] ]
         sys.stdout.write(t_info(f'Parsing windows {idx+1}/{groupNum}', special='\r'))
         if idx+1 == groupNum:
             sys.stdout.write('\n')
         sys.stdout.flush()
         xs = [hit.x_reco for hit in group]
         ys = [hit.y_reco for hit in group]
-        plt.figure(figsize=(8,8), dpi=resolution/200, frameon=False)
-        plt.scatter(xs, ys, c='b', s=0.2, alpha=0.3)
-        plt.axis('scaled')
-        plt.axis('off')
-        plt.xlim([-810, 810])
-        plt.ylim([-810, 810])
         img_name = str(idx+img_name_base+1).zfill(5)+'.png'
         img_list.append(img_name)
         img_file = img_dir.joinpath(img_name)
-        plt.savefig(img_file)
-        plt.close()
+        save_png(hit_raster(xs, ys, resolution, size=0.2, alpha=0.3, channels=channels), img_file)
 
 
     # make hit group dictionary for reference
-    hitId_groupIdx_dict = {}
-    for idx, group in enumerate(hit_groups):
-        for hit in group:
-            hitId_groupIdx_dict[hit.id] = idx
+    group_idx = bin_indices(hit_times, wds)
+    hitId_groupIdx_dict = { hit.id: idx for hit, idx in zip(hits, group_idx.tolist()) if idx < groupNum }
 
     ### Making bbox table
     pinfo('Making the bounding box table')
@@ -172,12 +164,14 @@ def make_data_from_dp(track_dir, dp_name, window, resolution, mode='first'):
 
     return bbox_file, img_dir
 
-def make_data_from_distribution(C):
+def make_data_from_distribution(C, storage='png'):
     track_dir = C.track_dir
     mean = C.trackNum_mean
     std = C.trackNum_std
     windowNum = C.window
     resolution = C.resolution
+    # old configurations have no input_channels and were made with RGBA images
+    channels = getattr(C, 'input_channels', 4)
 
     hitNumCut = 20
 
@@ -196,26 +190,26 @@ def make_data_from_distribution(C):
     shutil.rmtree(img_dir, ignore_errors=True)
     img_dir.mkdir(parents=True, exist_ok=True)
 
+    # images are either PNG files or records of a sharded store
+    assert storage in ['png', 'shard'],\
+        t_error(f'Unsupported storage {storage}! Storage has to be either \'png\' or \'shard\'')
+    if storage == 'shard':
+        img_writer = ShardWriter(img_dir, (resolution, resolution, channels), np.uint8)
+
     csv_name = "mc_bbox_proposal_train.csv"
     bbox_file = data_dir.joinpath(csv_name)
 
-    ### initialize sqlite session
-    # Connect to the database
-    pinfo('Connecting to the track database')
-    engine = create_engine('sqlite:///'+str(db_file))
-    # make session
-    from sqlalchemy.orm import sessionmaker
-    Session = sessionmaker(bind=engine) # session factory
-    session = Session() # session object
+    ### load the track database
+    pinfo('Loading the track database')
+    table = load_tracks(db_file)
 
     # get a distribution of integers
     floats = np.random.normal(loc=mean, scale=std, size=windowNum)
     float_type_ints = np.around(floats)
     track_numbers = float_type_ints.astype(int)
 
-    # get all particles
-    ptcls = session.query(Particle).all()
-    ptcl_iter = iter(ptcls)
+    # iterate over particle rows of the table
+    ptcl_iter = iter(range(len(table)))
 
     # get major tracks for each
     bbox_table_row_num = 0
@@ -234,7 +228,6 @@ def make_data_from_distribution(C):
 
         track_found_num = 0
 
-        rects = []
         while track_found_num < track_number:
             try:
                 ptcl = next(ptcl_iter)
@@ -244,41 +237,29 @@ def make_data_from_distribution(C):
                 pinfo('Run out of particles')
                 dp_name = next(dp_name_iter)
                 db_file = track_dir.joinpath(dp_name+".db")
-                pinfo('Connecting to the next track database')
-                engine = create_engine('sqlite:///'+str(db_file))
-                Session = sessionmaker(bind=engine) # session factory
-                session = Session() # session object
-                ptcls = session.query(Particle).all()
-                ptcl_iter = iter(ptcls)
+                pinfo('Loading the next track database')
+                table = load_tracks(db_file)
+                ptcl_iter = iter(range(len(table)))
                 ptcl = next(ptcl_iter)
-                track_box = [ptcl]
-                track_found_number = 1
 
-            strawHit_qrl = session.query(StrawDigiMC).filter(StrawDigiMC.particle==ptcl.id)
-            hitNum = strawHit_qrl.count()
-            if (hitNum >= hitNumCut) and (ptcl.pdgId == 11):
-                strawHits = strawHit_qrl.all()
-                xs = [hit.x for hit in strawHits]
-                ys = [hit.y for hit in strawHits]
-                x_all = x_all + xs
-                y_all = y_all + ys
-
-                xs = np.array(xs)
-                ys = np.array(ys)
+            hitNum = table.digi_count[ptcl]
+            pdgId = int(table.particles['pdgId'][ptcl])
+            if (hitNum >= hitNumCut) and (pdgId == 11):
+                rows = table.digi_slice(ptcl)
+                xs = table.digis['x'][rows]
+                ys = table.digis['y'][rows]
+                x_all = x_all + xs.tolist()
+                y_all = y_all + ys.tolist()
 
                 XMin = xs.min()
                 XMax = xs.max()
                 YMin = ys.min()
                 YMax = ys.max()
 
-                rect = Rectangle((XMin,YMin), XMax-XMin, YMax-YMin,linewidth=1,edgecolor='r',facecolor='none')
-                rects.append(rect)
-
                 xmin = XMin/1620 + 0.5 -0.01
                 xmax = XMax/1620 + 0.5 + 0.01
                 ymin = YMin/1620 + 0.5 -0.01
                 ymax = YMax/1620 + 0.5 +0.01
-                pdgId = session.query(Particle.pdgId).filter(Particle.id==ptcl.id).one_or_none()[0]
                 dict_for_df[bbox_table_row_num] = {'FileName':img_name,\
                                         'XMin':xmin,\
                                         'XMax':xmax,\
@@ -291,27 +272,22 @@ def make_data_from_distribution(C):
             else:
                 continue
 
-        x_all = np.array(x_all)
-        y_all = np.array(y_all)
-        layout = {'pad':0, 'h_pad':0, 'w_pad':0, 'rect':(0,0,1,1) }
-        plt.figure(figsize=(8,8), dpi=resolution/8, frameon=False, tight_layout=layout)
-        plt.scatter(x_all, y_all, c='b', s=1)
-        plt.axis('scaled')
-        plt.axis('off')
-        plt.xlim([-810, 810])
-        plt.ylim([-810, 810])
-        # for rect in rects:
-        #     plt.gca().add_patch(rect)
-        # plt.show()
-        plt.savefig(img_file, bbox_inches='tight', pad_inches=0)
-        plt.close()
+        img = hit_raster(x_all, y_all, resolution, channels=channels)
+        if storage == 'shard':
+            # the idx-th record is the image named str(idx+1).zfill(5)+'.png'
+            img_writer.append(img)
+        else:
+            save_png(img, img_file)
+
+    if storage == 'shard':
+        img_writer.close()
 
     train_df = pd.DataFrame.from_dict(dict_for_df, "index")
     train_df.to_csv(bbox_file)
 
     return bbox_file, img_dir
 
-def make_data(C, mode='dp'):
+def make_data(C, mode='dp', storage='png'):
 
     pstage('Make Raw Data')
 
@@ -331,7 +307,8 @@ def make_data(C, mode='dp'):
                 mode = 'first'
             else:
                 mode = 'append'
-            bbox_file, img_dir = make_data_from_dp(track_dir, dp_name, window, resolution, mode)
+            bbox_file, img_dir = make_data_from_dp(track_dir, dp_name, window, resolution, mode,\
+                                    channels=getattr(C, 'input_channels', 4))
 
     elif mode == "normal":
         track_dir = C.track_dir
@@ -339,7 +316,7 @@ def make_data(C, mode='dp'):
         std = C.trackNum_std
         windowNum = C.window
         resolution = C.resolution
-        bbox_file, img_dir = make_data_from_distribution(C)
+        bbox_file, img_dir = make_data_from_distribution(C, storage)
     else:
         perr(f"\"{mode}\" mode is not supported")
         sys.exit()
@@ -362,6 +339,7 @@ if __name__ == "__main__":
     # window = 20 # unit: ns
     window = 3000 # unit: number of windows
     resolution = 512
+    channels = 4 # 1 renders only the hit occupancy
     mode = 'normal'
     mean = 5
     std = 2
@@ -393,6 +371,7 @@ if __name__ == "__main__":
     C.set_distribution(mean, std)
     C.set_window(window)
     C.set_resolution(resolution)
+    C.set_input_channels(channels)
 
     # prepare raw tarining set with time measurement
     start = timeit.default_timer()
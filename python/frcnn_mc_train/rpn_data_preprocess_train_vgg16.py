@@ -2,7 +2,7 @@ import sys
 from pathlib import Path
 import shutil
 import pickle
-import cv2
+import os
 import timeit
 from math import sqrt
 
@@ -12,9 +12,12 @@ from Configuration import frcnn_config
 from Abstract import*
 from Architectures import VGG16
 from Information import*
+from Storage import ShardWriter, SparseWriter
+from Preprocess import rpn_windows
+from BboxTable import write_bbox_table
 
 
-def preprocess(C):
+def preprocess(C, storage='npy', processes=0, seed=0):
 
     pstage('Preprocess Data')
 
@@ -25,6 +28,9 @@ def preprocess(C):
     assert (C.label_limit_lower != None) and (C.label_limit_upper != None),\
         t_error('You have to setup rpn label limits before precrocessing data')
 
+    assert (storage in ['npy', 'shard', 'compact']),\
+        t_error('Unsupported storage! Storage has to be \'npy\', \'shard\' or \'compact\'')
+
     if C.has_preprocessed():
         pwarn('You have preprocessed the raw data before! The Untrainable data '
                 'has been removed and won\'t be shown this time.')
@@ -56,65 +62,83 @@ def preprocess(C):
     delta_dir.mkdir(parents=True)
 
     # Get anchors
-    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios) # anchors have been normalized
-
-    # Get bbox dicts. A bbox dict is {img_name: bboxes_list}
+    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios,\
+                cache_dir=C.data_dir.joinpath('anchors')) # anchors have been normalized
+
+    # open sharded stores; records are appended in the order of file_idx
+    # 'compact' keeps uint8 inputs and only the sampled entries of the maps
+    iNum, jNum, kNum = anchors.shape[:3]
+    if storage == 'shard':
+        input_writer = ShardWriter(input_dir, C.input_shape, np.float32)
+        label_writer = ShardWriter(label_dir, (iNum, jNum, kNum), np.float32)
+        delta_writer = ShardWriter(delta_dir, (iNum, jNum, kNum*4), np.float32)
+    elif storage == 'compact':
+        input_writer = ShardWriter(input_dir, C.input_shape, np.uint8, scale=255.0)
+        label_writer = SparseWriter(label_dir, (iNum, jNum, kNum), np.float16)
+        delta_writer = SparseWriter(delta_dir, (iNum, jNum, kNum*4), np.float32)
+
+    # Get bbox dicts. A bbox dict is {img_name: float32 bbox array}
     pinfo('Making the image-bbox dictionary')
-    img_bbox_dict = make_img_bbox_dict(C.train_img_dir, C.train_bbox_reference_file)
+    img_bbox_dict, img_class_dict, classes = make_img_bbox_arrays(C.train_bbox_reference_file)
 
     # loop through img_bbox list
     img_bbox_list = [ [img_name, bbox_list] for img_name, bbox_list in img_bbox_dict.items() ]
-    bbox_Num = len(pd.read_csv(C.train_bbox_reference_file, index_col=0).index)
+    bbox_Num = sum(len(bbox_list) for bbox_list in img_bbox_dict.values())
     bbox_idx = 0
     file_idx = 0
-    for img_name, bbox_list in img_bbox_list:
-        # get input
-        img_path_str = str(C.train_img_dir.joinpath(img_name))
-        input = cv2.imread(img_path_str, cv2.IMREAD_UNCHANGED)
-        input = cv2.cvtColor(input, cv2.COLOR_BGRA2RGBA)
-        if input.any() == None:
-            perr(f'{img_path_str} is invalid')
+    discards = []
+    windows = rpn_windows(C.train_img_dir, img_bbox_list, anchors, lim_lo, lim_up,\
+                    C.pos_lo_limit, C.tot_lo_limit, seed=seed, processes=processes)
+    for (img_name, bbox_list), window in zip(img_bbox_list, windows):
+        _, input, sampled_label_map, delta_map, labels_trainable, deltas_trainable = window
         # make truth table for RPN classifier
-        score_bbox_map = make_score_bbox_map(anchors)
-        for bbox in bbox_list:
-            bbox_idx += 1
-            sys.stdout.write(t_info(f'Scoring and labeling anchors by bbox: {bbox_idx}/{bbox_Num}', special='\r'))
-            if bbox_idx == bbox_Num:
-                sys.stdout.write('\n')
-            sys.stdout.flush()
-            score_bbox_map = update_score_bbox_map(score_bbox_map, bbox, anchors)
-
-        raw_label_map = make_label_map(score_bbox_map, lim_lo, lim_up)
-        sampled_label_map = sample_label_map(raw_label_map, C.pos_lo_limit, C.tot_lo_limit)
-        delta_map = make_delta_map(score_bbox_map, lim_up, anchors)
-        # Check if both label and delta map have trainable data
-        labels_trainable = (~np.isnan(sampled_label_map)).any()
-        deltas_trainable = (~np.isnan(delta_map)).any()
+        bbox_idx += len(bbox_list)
+        sys.stdout.write(t_info(f'Scoring and labeling anchors by bbox: {bbox_idx}/{bbox_Num}', special='\r'))
+        if bbox_idx == bbox_Num:
+            sys.stdout.write('\n')
+        sys.stdout.flush()
+
         trainable = labels_trainable and deltas_trainable
         if trainable:
             # save data to local
-            input = input/255.0
-
-            input_file = input_dir.joinpath(f'input_{ str(file_idx).zfill(7) }.npy')
-            label_file = label_dir.joinpath(f'label_{ str(file_idx).zfill(7) }.npy')
-            delta_file = delta_dir.joinpath(f'delta_{ str(file_idx).zfill(7) }.npy')
-
             if (np.count_nonzero(~np.isnan(delta_map))%4)!=0:
                 perr('I found the bug!')
                 sys.exit()
 
-            np.save(input_file, input)
-            np.save(label_file, sampled_label_map)
-            np.save(delta_file, delta_map)
+            if storage == 'compact':
+                input_writer.append(input)
+                label_writer.append(sampled_label_map)
+                delta_writer.append(delta_map)
+            elif storage == 'shard':
+                input_writer.append(input/255.0)
+                label_writer.append(sampled_label_map)
+                delta_writer.append(delta_map)
+            else:
+                input_file = input_dir.joinpath(f'input_{ str(file_idx).zfill(7) }.npy')
+                label_file = label_dir.joinpath(f'label_{ str(file_idx).zfill(7) }.npy')
+                delta_file = delta_dir.joinpath(f'delta_{ str(file_idx).zfill(7) }.npy')
+
+                np.save(input_file, input/255.0)
+                np.save(label_file, sampled_label_map)
+                np.save(delta_file, delta_map)
 
             file_idx += 1
 
         else:
             pwarn(f'{img_name} is discarded as it has untrainable data', special = '\n')
             pwarn(f'Details: labels_trainable:{labels_trainable}, deltas_trainable:{deltas_trainable}')
-            df = pd.read_csv(C.train_bbox_reference_file, index_col=0)
-            df = df[df['FileName']!=img_name]
-            df.to_csv(C.train_bbox_reference_file)
+            discards.append(img_name)
+
+    # remove discarded images from the reference table at once
+    if len(discards) != 0:
+        df = pd.read_csv(C.train_bbox_reference_file, index_col=0)
+        df = df[~df['FileName'].isin(discards)]
+        write_bbox_table(df, C.train_bbox_reference_file)
+
+    if storage != 'npy':
+        input_writer.close()
+        label_writer.close()
+        delta_writer.close()
 
     # setup configuration
     C.set_rpn_training_data(input_dir, label_dir, delta_dir)
@@ -152,7 +176,7 @@ if __name__ == "__main__":
 
 
     start = timeit.default_timer()
-    preprocess(C)
+    preprocess(C, processes=os.cpu_count())
     total_time = timeit.default_timer()-start
     print('\n')
     pinfo(f'Elapsed time: {total_time}(sec)')
@@ -9,7 +9,6 @@ import pandas as pd
 import numpy as np
 
 import tensorflow as tf
-from tensorflow.image import non_max_suppression_with_scores
 from tensorflow.keras import Model
 from tensorflow.keras.layers import Input, Concatenate
 from tensorflow.keras.optimizers import Adam
@@ -18,16 +17,62 @@ util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Configuration import frcnn_config
 from DataGenerator import DataGeneratorV2
-from Abstract import make_anchors, normalize_anchor, propose_score_bbox_list
+from Abstract import make_anchors, normalize_anchor, decode_rpn_outputs
 from Layers import rpn
+from NMS import batch_nms, pad_batch
 from Information import *
 ### import ends
 
+## Decode, trim and optionally NMS the RPN outputs of all images
+#
+# \pr{anchors, numpy array, Normalized anchors from \c make_anchors.}
+# \pr{img_names, list, Image names in the order of the RPN outputs.}
+# \pr{score_maps, numpy array, RPN scores of all images.}
+# \pr{delta_maps, numpy array, RPN deltas of all images.}
+# \pr{nms, bool, Whether to run NMS on the proposals of every image.}
+# \rt{output_df, pandas DataFrame, One row per proposed bbox.}
+def propose_rois(anchors, img_names, score_maps, delta_maps, nms=True):
+    # decode all bboxes whose objective score is > 0.5 and trim them to the image
+    pinfo('Decoding bounding boxes')
+    scores_all, bboxes_all, offsets = decode_rpn_outputs(anchors, score_maps, delta_maps)
+
+    inverted = (bboxes_all[:,1] < bboxes_all[:,0]) | (bboxes_all[:,3] < bboxes_all[:,2])
+    if inverted.any():
+        pwarn(f"{np.count_nonzero(inverted)} bboxes have XMax < XMin or YMax < YMin")
+
+    # NMS
+    if nms == True:
+        pinfo('Suppressing overlapping bounding boxes')
+        batch_bboxes, batch_scores, counts = pad_batch(bboxes_all, scores_all, offsets)
+        selected_indices, selected_scores, num_selected =\
+            batch_nms(batch_bboxes, batch_scores, counts,\
+                    max_output_size=2000,\
+                    iou_threshold=0.7, score_threshold=0.0,\
+                    soft_nms_sigma=0.0)
+        selected = np.arange(selected_indices.shape[1])[np.newaxis,:] < num_selected[:,np.newaxis]
+        img_idx = np.nonzero(selected)[0]
+        rows = (offsets[:-1,np.newaxis] + selected_indices)[selected]
+        scores = selected_scores[selected]
+    else:
+        img_idx = np.repeat(np.arange(len(img_names)), np.diff(offsets))
+        rows = np.arange(len(scores_all))
+        scores = scores_all
+
+    bboxes = bboxes_all[rows]
+    output_df = pd.DataFrame({'FileName': np.array(img_names, dtype=str)[img_idx],\
+                            'XMin': bboxes[:,0],\
+                            'XMax': bboxes[:,1],\
+                            'YMin': bboxes[:,2],\
+                            'YMax': bboxes[:,3],\
+                            'Score': scores})
+    return output_df
+
 def rpn_predict_RoI(C, nms=True):
 
     pstage('RPN is predicting Regions of Interest (RoIs) with NMS')
     #input_shape, ratio, anchor_scales, anchor_ratios
-    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios)
+    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios,\
+                cache_dir=C.data_dir.joinpath('anchors'))
 
     row_num, col_num = C.input_shape[:2]
     input_shape = [row_num, col_num]
@@ -68,82 +113,17 @@ def rpn_predict_RoI(C, nms=True):
     score_maps = outputs_raw[0]
     delta_maps = outputs_raw[1]
 
-    ### filter out negative anchors and adjust positive anchors
-    all_bbox = []
-    img_idx = 0
-    bbox_idx = 0
-    dict_for_df={}
-
     bbox_df = pd.read_csv(C.train_bbox_reference_file, index_col=0)
     img_names = bbox_df['FileName'].unique().tolist()
-    imgNum = len(img_names)
 
     if len(img_names) != len(score_maps):
         perr('Number of images is inconsistent with the number of outputs')
         sys.exit()
 
-    for img_name, score_map, delta_map in zip(img_names, score_maps, delta_maps):
-
-        sys.stdout.write(t_info(f'Proposing bounding boxes for image: {img_idx+1}/{imgNum}','\r'))
-        if img_idx+1 == imgNum:
-            sys.stdout.write('\n')
-        sys.stdout.flush()
-
-        # select all bbox whose objective score is >= 0.5 and put them in a list
-        score_bbox_pairs = propose_score_bbox_list(anchors, score_map, delta_map)
-
-        scores, bboxes_raw = [], []
-        for score_bbox in score_bbox_pairs:
-            scores.append(score_bbox[0])
-            bboxes_raw.append(score_bbox[1])
-
-        # trimming bboxes
-        for i, bbox in enumerate(bboxes_raw):
-            if bbox[0] < 0:
-                bboxes_raw[i][0] = 0
-            if bbox[1] > 1:
-                bboxes_raw[i][1] = 1
-            if bbox[2] < 0:
-                bboxes_raw[i][2] = 0
-            if bbox[3] > 1:
-                bboxes_raw[i][3] = 1
-            if bbox[1] < bbox[0]:
-                pwarn(f"bbox {i} XMax is less than XMin")
-            if bbox[3] < bbox[2]:
-                pwarn(f"bbox {i} YMax is less than YMin")
-
-        # NMS
-        if nms == True:
-            scores_tf = tf.constant(scores, dtype=tf.float32)
-            bboxes_raw_tf = [ [ymax, xmin, ymin, xmax] for [xmin, xmax, ymin, ymax] in bboxes_raw ]
-            bboxes_raw_tf = tf.constant(bboxes_raw_tf, dtype=tf.float32)
-            selected_indices, selected_scores =\
-                non_max_suppression_with_scores(bboxes_raw_tf, scores_tf,\
-                        max_output_size=2000,\
-                        iou_threshold=0.7, score_threshold=0.0,\
-                        soft_nms_sigma=0.0)
-
-            selected_indices_list = selected_indices.numpy().tolist()
-            bboxes = [ bboxes_raw[index] for index in selected_indices_list ]
-            scores = selected_scores.numpy().tolist()
-        else:
-            bboxes = bboxes_raw
-            scores = scores
-
-        # save parameters to dict
-        for score, bbox in zip(scores, bboxes):
-            dict_for_df[bbox_idx] = {'FileName': str(img_name),\
-                                'XMin':bbox[0],\
-                                'XMax':bbox[1],\
-                                'YMin':bbox[2],\
-                                'YMax':bbox[3],\
-                                'Score':score}
-            bbox_idx += 1
-
-        img_idx += 1
+    ### filter out negative anchors and adjust positive anchors
+    output_df = propose_rois(anchors, img_names, score_maps, delta_maps, nms)
 
     # save proposed bboxes to local
-    output_df = pd.DataFrame.from_dict(dict_for_df, "index")
     output_file = C.train_img_dir.parent.joinpath("mc_RoI_prediction_NMS_train.csv")
     output_df.to_csv(output_file)
 
@@ -175,82 +155,17 @@ def rpn_predict_RoI(C, nms=True):
     score_maps = outputs_raw[0]
     delta_maps = outputs_raw[1]
 
-    ### filter out negative anchors and adjust positive anchors
-    all_bbox = []
-    img_idx = 0
-    bbox_idx = 0
-    dict_for_df={}
-
     bbox_df = pd.read_csv(C.validation_bbox_reference_file, index_col=0)
     img_names = bbox_df['FileName'].unique().tolist()
-    imgNum = len(img_names)
 
     if len(img_names) != len(score_maps):
         perr('Number of images is inconsistent with the number of outputs')
         sys.exit()
 
-    for img_name, score_map, delta_map in zip(img_names, score_maps, delta_maps):
-
-        sys.stdout.write(t_info(f'Proposing bounding boxes for image: {img_idx+1}/{imgNum}','\r'))
-        if img_idx+1 == imgNum:
-            sys.stdout.write('\n')
-        sys.stdout.flush()
-
-        # select all bbox whose objective score is >= 0.5 and put them in a list
-        score_bbox_pairs = propose_score_bbox_list(anchors, score_map, delta_map)
-
-        scores, bboxes_raw = [], []
-        for score_bbox in score_bbox_pairs:
-            scores.append(score_bbox[0])
-            bboxes_raw.append(score_bbox[1])
-
-        # trimming bboxes
-        for i, bbox in enumerate(bboxes_raw):
-            if bbox[0] < 0:
-                bboxes_raw[i][0] = 0
-            if bbox[1] > 1:
-                bboxes_raw[i][1] = 1
-            if bbox[2] < 0:
-                bboxes_raw[i][2] = 0
-            if bbox[3] > 1:
-                bboxes_raw[i][3] = 1
-            if bbox[1] < bbox[0]:
-                pwarn(f"bbox {i} XMax is less than XMin")
-            if bbox[3] < bbox[2]:
-                pwarn(f"bbox {i} YMax is less than YMin")
-
-        # NMS
-        if nms == True:
-            scores_tf = tf.constant(scores, dtype=tf.float32)
-            bboxes_raw_tf = [ [ymax, xmin, ymin, xmax] for [xmin, xmax, ymin, ymax] in bboxes_raw ]
-            bboxes_raw_tf = tf.constant(bboxes_raw_tf, dtype=tf.float32)
-            selected_indices, selected_scores =\
-                non_max_suppression_with_scores(bboxes_raw_tf, scores_tf,\
-                        max_output_size=2000,\
-                        iou_threshold=0.7, score_threshold=0.0,\
-                        soft_nms_sigma=0.0)
-
-            selected_indices_list = selected_indices.numpy().tolist()
-            bboxes = [ bboxes_raw[index] for index in selected_indices_list ]
-            scores = selected_scores.numpy().tolist()
-        else:
-            bboxes = bboxes_raw
-            scores = scores
-
-        # save parameters to dict
-        for score, bbox in zip(scores, bboxes):
-            dict_for_df[bbox_idx] = {'FileName': str(img_name),\
-                                'XMin':bbox[0],\
-                                'XMax':bbox[1],\
-                                'YMin':bbox[2],\
-                                'YMax':bbox[3],\
-                                'Score':score}
-            bbox_idx += 1
-
-        img_idx += 1
+    ### filter out negative anchors and adjust positive anchors
+    output_df = propose_rois(anchors, img_names, score_maps, delta_maps, nms)
 
     # save proposed bboxes to local
-    output_df = pd.DataFrame.from_dict(dict_for_df, "index")
     output_file = C.train_img_dir.parent.joinpath("mc_RoI_prediction_NMS_validation.csv")
     output_df.to_csv(output_file)
 
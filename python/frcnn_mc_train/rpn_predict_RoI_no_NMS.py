@@ -17,7 +17,7 @@ util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Configuration import frcnn_config
 from DataGenerator import DataGeneratorV2
-from Abstract import make_anchors, normalize_anchor, propose_score_bbox_list
+from Abstract import make_anchors, normalize_anchor, decode_rpn_outputs
 from Layers import rpn
 from Information import *
 ### import ends
@@ -26,7 +26,8 @@ def rpn_propose_RoI(C):
 
     pstage('RPN is predicting Regions of Interest (RoIs) without NMS')
     #input_shape, ratio, anchor_scales, anchor_ratios
-    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios)
+    anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios,\
+                cache_dir=C.data_dir.joinpath('anchors'))
 
     row_num, col_num = C.input_shape[:2]
     input_shape = [row_num, col_num]
@@ -67,65 +68,27 @@ def rpn_propose_RoI(C):
     score_maps = outputs_raw[0]
     delta_maps = outputs_raw[1]
 
-    ### filter out negative anchors and adjust positive anchors
-    all_bbox = []
-    img_idx = 0
-    bbox_idx = 0
-
-    dict_for_df={}
-
     bbox_df = pd.read_csv(C.train_bbox_reference_file, index_col=0)
     img_names = bbox_df['FileName'].unique().tolist()
-    imgNum = len(img_names)
 
     if len(img_names) != len(score_maps):
         perr('Number of images is inconsistent with the number of outputs')
         sys.exit()
 
-    for img_name, score_map, delta_map in zip(img_names, score_maps, delta_maps):
-
-        sys.stdout.write(t_info(f'Proposing bounding boxes for image: {img_idx+1}/{imgNum}','\r'))
-        if img_idx+1 == imgNum:
-            sys.stdout.write('\n')
-        sys.stdout.flush()
-
-        # select all bbox whose objective score is >= 0.5 and put them in a list
-        score_bbox_pairs = propose_score_bbox_list(anchors, score_map, delta_map)
-
-        scores, bbox_raws = [], []
-        for score_bbox in score_bbox_pairs:
-            scores.append(score_bbox[0])
-            bbox_raws.append(score_bbox[1])
-
-        # trimming bboxes
-        for i, bbox in enumerate(bbox_raws):
-            if bbox[0] < 0:
-                bbox_raws[i][0] = 0
-            if bbox[1] > 1:
-                bbox_raws[i][1] = 1
-            if bbox[2] < 0:
-                bbox_raws[i][2] = 0
-            if bbox[3] > 1:
-                bbox_raws[i][3] = 1
-            if bbox[1] < bbox[0]:
-                pwarn(f"bbox {i} XMax is less than XMin")
-            if bbox[3] < bbox[2]:
-                pwarn(f"bbox {i} YMax is less than YMin")
-
-        # save parameters to dict
-        for score, bbox in zip(scores, bbox_raws):
-            dict_for_df[bbox_idx] = {'FileName': str(img_name),\
-                                'XMin':bbox[0],\
-                                'XMax':bbox[1],\
-                                'YMin':bbox[2],\
-                                'YMax':bbox[3],\
-                                'Score':score}
-            bbox_idx += 1
-
-        img_idx += 1
+    ### filter out negative anchors and adjust positive anchors
+    pinfo('Decoding bounding boxes')
+    scores, bboxes, offsets = decode_rpn_outputs(anchors, score_maps, delta_maps)
+    inverted = (bboxes[:,1] < bboxes[:,0]) | (bboxes[:,3] < bboxes[:,2])
+    if inverted.any():
+        pwarn(f"{np.count_nonzero(inverted)} bboxes have XMax < XMin or YMax < YMin")
 
     # save proposed bboxes to local
-    output_df = pd.DataFrame.from_dict(dict_for_df, "index")
+    output_df = pd.DataFrame({'FileName': np.repeat(img_names, np.diff(offsets)),\
+                            'XMin': bboxes[:,0],\
+                            'XMax': bboxes[:,1],\
+                            'YMin': bboxes[:,2],\
+                            'YMax': bboxes[:,3],\
+                            'Score': scores})
     output_file = C.sub_data_dir.joinpath("mc_RoI_prediction_no_NMS_train.csv")
     output_df.to_csv(output_file)
 
@@ -152,64 +115,27 @@ def rpn_propose_RoI(C):
     score_maps = outputs_raw[0]
     delta_maps = outputs_raw[1]
 
-    ### filter out negative anchors and adjust positive anchors
-    all_bbox = []
-    img_idx = 0
-    bbox_idx = 0
-    dict_for_df={}
-
     bbox_df = pd.read_csv(C.validation_bbox_reference_file, index_col=0)
     img_names = bbox_df['FileName'].unique().tolist()
-    imgNum = len(img_names)
 
     if len(img_names) != len(score_maps):
         perr('Number of images is inconsistent with the number of outputs')
         sys.exit()
 
-    for img_name, score_map, delta_map in zip(img_names, score_maps, delta_maps):
-
-        sys.stdout.write(t_info(f'Proposing bounding boxes for image: {img_idx+1}/{imgNum}','\r'))
-        if img_idx+1 == imgNum:
-            sys.stdout.write('\n')
-        sys.stdout.flush()
-
-        # select all bbox whose objective score is >= 0.5 and put them in a list
-        score_bbox_pairs = propose_score_bbox_list(anchors, score_map, delta_map)
-
-        scores, bbox_raws = [], []
-        for score_bbox in score_bbox_pairs:
-            scores.append(score_bbox[0])
-            bbox_raws.append(score_bbox[1])
-
-        # trimming bboxes
-        for i, bbox in enumerate(bbox_raws):
-            if bbox[0] < 0:
-                bbox_raws[i][0] = 0
-            if bbox[1] > 1:
-                bbox_raws[i][1] = 1
-            if bbox[2] < 0:
-                bbox_raws[i][2] = 0
-            if bbox[3] > 1:
-                bbox_raws[i][3] = 1
-            if bbox[1] < bbox[0]:
-                pwarn(f"bbox {i} XMax is less than XMin")
-            if bbox[3] < bbox[2]:
-                pwarn(f"bbox {i} YMax is less than YMin")
-
-        # save parameters to dict
-        for score, bbox in zip(scores, bbox_raws):
-            dict_for_df[bbox_idx] = {'FileName': str(img_name),\
-                                'XMin':bbox[0],\
-                                'XMax':bbox[1],\
-                                'YMin':bbox[2],\
-                                'YMax':bbox[3],\
-                                'Score':score}
-            bbox_idx += 1
-
-        img_idx += 1
+    ### filter out negative anchors and adjust positive anchors
+    pinfo('Decoding bounding boxes')
+    scores, bboxes, offsets = decode_rpn_outputs(anchors, score_maps, delta_maps)
+    inverted = (bboxes[:,1] < bboxes[:,0]) | (bboxes[:,3] < bboxes[:,2])
+    if inverted.any():
+        pwarn(f"{np.count_nonzero(inverted)} bboxes have XMax < XMin or YMax < YMin")
 
     # save proposed bboxes to local
-    output_df = pd.DataFrame.from_dict(dict_for_df, "index")
+    output_df = pd.DataFrame({'FileName': np.repeat(img_names, np.diff(offsets)),\
+                            'XMin': bboxes[:,0],\
+                            'XMax': bboxes[:,1],\
+                            'YMin': bboxes[:,2],\
+                            'YMax': bboxes[:,3],\
+                            'Score': scores})
     output_file = C.sub_data_dir.joinpath("mc_RoI_prediction_no_NMS_validation.csv")
     output_df.to_csv(output_file)
 
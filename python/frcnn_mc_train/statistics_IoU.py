@@ -10,7 +10,8 @@ util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Information import *
 from Configuration import frcnn_config
-from Geometry import iou
+from Geometry import iou_matrix
+from Abstract import make_img_bbox_arrays
 
 pbanner()
 psystem('Faster R-CNN Object Detection System')
@@ -20,28 +21,14 @@ cwd = Path.cwd()
 pickle_path = cwd.joinpath('frcnn.train.config.pickle')
 C = pickle.load(open(pickle_path,'rb'))
 
-df = pd.read_csv(C.train_bbox_reference_file, index_col=None)
-
-imgNames = df['FileName'].unique().tolist()
+img_bbox_dict, img_class_dict, classes = make_img_bbox_arrays(C.train_bbox_reference_file)
 
 maxIoUs = []
 
-for imgName in imgNames:
-    slice = df[df['FileName']==imgName]
-    bboxes = [ [r['XMin'], r['XMax'], r['YMin'], r['YMax'] ] for index, r in slice.iterrows() ]
-
-    bboxNum = len(bboxes)
-    maxIoU = 0
-
-    for i in range(bboxNum):
-        bbox1 = bboxes[i]
-
-        for j in range(1,bboxNum-i):
-            bbox2 = bboxes[i+j]
-            iou_val = iou(bbox1, bbox2)
-
-            if iou_val > maxIoU:
-                maxIoU = iou_val
+for imgName, bboxes in img_bbox_dict.items():
+    # highest IoU between two different bboxes of the image
+    ious = np.triu(iou_matrix(bboxes, bboxes), k=1)
+    maxIoU = ious.max() if ious.size != 0 else 0
 
     maxIoUs.append(maxIoU)
 
@@ -20,11 +20,11 @@ def anchor_statistics(C):
     anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios)
     anchors_arr = np.array(anchors)
 
-    img_bbox_dict = make_img_bbox_dict(C.img_dir, C.bbox_reference_file)
+    img_bbox_dict, img_class_dict, classes = make_img_bbox_arrays(C.bbox_reference_file)
     img_bbox_list = [ [img_name, bbox_list] for img_name, bbox_list in img_bbox_dict.items() ]
     all_img_name = [img_name for img_name, bbox_list in img_bbox_list]
 
-    bbox_Num = len(pd.read_csv(C.bbox_reference_file, index_col=0).index)
+    bbox_Num = sum(len(bbox_list) for bbox_list in img_bbox_dict.values())
     bbox_idx = 0
 
     all_track_number = []
@@ -26,18 +26,31 @@ sys.path.insert(1, str(util_dir))
 from Layers import rpn
 from Information import *
 from Configuration import frcnn_config
-from DataGenerator import DataGeneratorV2
+from Abstract import make_anchors
+from DataGenerator import DataGeneratorV2, RpnTargetGenerator
 from Loss import *
 from Metric import *
 
 ### imports ends
 
-def rpn_train(C, alternative=False):
+def rpn_train(C, alternative=False, on_the_fly=False):
     pstage("Start Training")
 
     # prepare data generator
-    train_generator = DataGeneratorV2(C.train_img_inputs_npy, C.train_labels_npy, C.train_deltas_npy, batch_size=8)
-    val_generator = DataGeneratorV2(C.validation_img_inputs_npy, C.validation_labels_npy, C.validation_deltas_npy, batch_size=8)
+    if on_the_fly:
+        # make RPN targets from the raw images and bbox tables at batch time
+        anchors = make_anchors(C.input_shape, C.base_net.ratio, C.anchor_scales, C.anchor_ratios,\
+                    cache_dir=C.data_dir.joinpath('anchors'))
+        target_params = (anchors, C.label_limit_lower, C.label_limit_upper, C.pos_lo_limit, C.tot_lo_limit)
+        train_generator = RpnTargetGenerator(C.train_img_dir, C.train_bbox_reference_file,\
+                            *target_params, batch_size=8, workers=4, depth=8)
+        val_generator = RpnTargetGenerator(C.validation_img_dir, C.validation_bbox_reference_file,\
+                            *target_params, batch_size=8, shuffle=False, resample=False, workers=2)
+    else:
+        train_generator = DataGeneratorV2(C.train_img_inputs_npy, C.train_labels_npy, C.train_deltas_npy,\
+                            batch_size=8, workers=4, depth=8)
+        val_generator = DataGeneratorV2(C.validation_img_inputs_npy, C.validation_labels_npy, C.validation_deltas_npy,\
+                            batch_size=8, workers=2)
 
     # outputs
     cwd = Path.cwd()
@@ -116,12 +129,15 @@ def rpn_train(C, alternative=False):
 
 
     # initialize fit parameters
+    # the generators shuffle themselves every epoch; batches must be requested
+    # in order for the read-ahead to hit
     model.fit(x=train_generator,
                 validation_data=val_generator,\
-                shuffle=True,\
+                shuffle=False,\
                 callbacks = [CsvCallback, ModelCallback, earlyStopCallback, tensorboard_callback],\
                 epochs=200)
-
+    pinfo(f"Training loader: {train_generator.prefetcher.stats()}")
+    pinfo(f"Validation loader: {val_generator.prefetcher.stats()}")
 
     model.save_weights(model_weights_file, overwrite=True)
     pinfo(f"Weights are saved to {str(model_weights_file)}")
@@ -14,25 +14,14 @@ import numpy as np
 util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Configuration import extractor_config as Config
+from Statistics import dataset_stats
 from Information import *
 ### import ends
 def calc_weights(Y_dir):
     pinfo('Calculating class weights by median frequency')
-    Y_list = [child for child in C.Y_train_dir.iterdir()]
-    BlankNum = 0
-    BgNum = 0
-    MajorNum = 0
-    fileNum = len(Y_list)
-    for i, file in enumerate(Y_list):
-        sys.stdout.write(t_info(f'Parsing windows {i+1}/{fileNum}', special='\r'))
-        y = np.load(file)
-        blankNum = np.count_nonzero( (y==np.array([1,0,0])).all(axis=2) )
-        bgNum = np.count_nonzero( (y==np.array([0,1,0])).all(axis=2) )
-        majorNum = np.count_nonzero( (y==np.array([0,0,1])).all(axis=2) )
-
-        BlankNum += blankNum
-        BgNum += bgNum
-        MajorNum += majorNum
+    # pixel numbers of blank, bg and major, streamed and cached next to Y_dir
+    stats = dataset_stats(Y_dir, num_classes=3)
+    BlankNum, BgNum, MajorNum = stats['class_counts']
 
     pinfo(f'Frequency: major {MajorNum}, bg {BgNum}, blank {BlankNum}')
     numArr = np.array([MajorNum, BgNum, BlankNum])
@@ -54,6 +43,6 @@ if __name__ == "__main__":
     pickle_path = cwd.joinpath('photographic.train.config.pickle')
     C = pickle.load(open(pickle_path,'rb'))
 
-    weights = calc_weights(C)
+    weights = calc_weights(C.Y_train_dir)
     C.set_weights(weights)
     pickle.dump(C, open(pickle_path, 'wb'))
@@ -26,11 +26,13 @@ from PIL import Image
 util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Configuration import extractor_config
-from Abstract import binning_objects
+from Abstract import bin_indices
+from Raster import density_raster
 from Database import *
 from Information import *
+from Storage import ShardWriter
 
-def make_data_from_distribution(C):
+def make_data_from_distribution(C, storage='npy'):
 
     track_dir = C.track_dir
     mean = C.trackNum_mean
@@ -69,6 +71,18 @@ def make_data_from_distribution(C):
     photo_train_in_dir.mkdir(parents=True, exist_ok=True)
     photo_train_out_dir.mkdir(parents=True, exist_ok=True)
 
+    ### truths are one-hot float maps or uint8 class indices (0 blank, 1 bg, 2 major)
+    index_target = getattr(C, 'target_format', 'onehot') == 'index'
+
+    ### sharded stores; records are appended in the order of index
+    if storage == 'shard':
+        res = C.resolution
+        x_writer = ShardWriter(photographic_train_x_dir, (res, res), np.float32)
+        if index_target:
+            y_writer = ShardWriter(photographic_train_y_dir, (res, res), np.uint8)
+        else:
+            y_writer = ShardWriter(photographic_train_y_dir, (res, res, 3), np.float32)
+
     ### pixel truth labels
     is_blank = np.array([1,0,0], dtype=np.float32)
     is_bg = np.array([0,1,0], dtype=np.float32)
@@ -160,9 +174,8 @@ def make_data_from_distribution(C):
             y_bins = [-810, bbox[2]-1, bbox[3]+1, 810]
 
             # get position tuples in the bounding box
-            pos_selected_by_x = binning_objects(mcs_pos_flatten, xs_flatten, x_bins)[2]
-            pos_selected_by_y = binning_objects(mcs_pos_flatten, ys_flatten, y_bins)[2]
-            selected_mcs_pos = list(set(pos_selected_by_x).intersection(pos_selected_by_y))
+            in_bbox = (bin_indices(xs_flatten, x_bins)==2) & (bin_indices(ys_flatten, y_bins)==2)
+            selected_mcs_pos = list(set( pos for pos, inside in zip(mcs_pos_flatten, in_bbox) if inside ))
             selected_mcs_x = [ x for [x,y,z] in selected_mcs_pos ]
             sorted_selected_mcs_x = deepcopy(selected_mcs_x)
             sorted_selected_mcs_x.sort()
@@ -201,46 +214,21 @@ def make_data_from_distribution(C):
 
             ### fill the density in the blank photo and truth
             # first index is row
-            bins_by_row = binning_objects(selected_mcs_pos, selected_mcs_y, ybins)[1:]
-
-            majorDetected = 0
-            for row, bin in enumerate(bins_by_row):
-                x_bin_flatten = [ x for (x,y,z) in bin]
-                squares_by_column = binning_objects(bin, x_bin_flatten, xbins)[1:]
-                for col, square in enumerate(squares_by_column):
-                    density = len(square)#number density
-                    input_photo[ypixel-row-1][col] = density
-                    if density != 0 :
-                        has_major = False
-                        for pos in square:
-                            if pos in mcs_pos[i]:
-                                has_major = True
-                                majorDetected+=1
-                                break
-                        if has_major == True:
-                            output_truth[ypixel-row-1][col] = is_major
-
-                        else:
-                            output_truth[ypixel-row-1][col] = is_bg
-
+            selected_xys = np.array([ (x,y) for (x,y,z) in selected_mcs_pos ])
+            density = density_raster(selected_xys[:,0], selected_xys[:,1],\
+                                            xbins, ybins, shape=input_photo.shape)[0]
+            major_pos = set(mcs_pos[i])
+            majors = np.array([ pos in major_pos for pos in selected_mcs_pos ])
+            major_density = density_raster(selected_xys[majors,0], selected_xys[majors,1],\
+                                            xbins, ybins, shape=input_photo.shape)[0]
+            input_photo[:] = density
+            output_truth[density!=0] = is_bg
+            output_truth[major_density!=0] = is_major
 
             if len(np.where(input_photo!=0)[0]) == 0:
-                pdebug(bins_by_row)
-                ptcl_found = False
-                for row, bin in enumerate(bins_by_row):
-                    x_bin_flatten = [ x for (x,y,z) in bin]
-                    squares_by_column = binning_objects(bin, x_bin_flatten, xbins)[1:]
-                    for square in squares_by_column:
-                        if len(square)!= 0:
-                            ptcl_found = True
-                            break
-                    if ptcl_found:
-                        pdebug(squares_by_column,f'{799-row}th row')
-                    elif len(bin)!=0 :
-                        pdebug(bin,'bin')
-                        pdebug(x_bin_flatten, 'xbin_flatten')
-                        pdebug(xbins, 'xbins')
-                        pdebug(binning_objects(bin, x_bin_flatten, xbins))
+                pdebug(selected_mcs_pos, 'selected positions')
+                pdebug(xbins, 'xbins')
+                pdebug(ybins, 'ybins')
                 pdebug('Empty input photo!')
                 sys.exit()
 
@@ -278,9 +266,14 @@ def make_data_from_distribution(C):
 
                 x = np.array(x, dtype=np.float32)
                 y = np.array(y, dtype=np.float32)
+                y_out = np.argmax(y, axis=2).astype(np.uint8) if index_target else y
 
-                np.save(input_file, x)
-                np.save(output_file, y)
+                if storage == 'shard':
+                    x_writer.append(x)
+                    y_writer.append(y_out)
+                else:
+                    np.save(input_file, x)
+                    np.save(output_file, y_out)
 
                 x_max = int(x.max())
                 ratio = 255/x_max
@@ -305,10 +298,14 @@ def make_data_from_distribution(C):
                 index += 1
 
 
+    if storage == 'shard':
+        x_writer.close()
+        y_writer.close()
+
     return photographic_train_x_dir, photographic_train_y_dir
 
 
-def make_data(C, mode):
+def make_data(C, mode, storage='npy'):
     """
     This function helps determine which mode should be used when preparing training data.
     If mode is "normal", track number would fit a Gaussian distribution whose parameters were specificed in the configuration object before called.
@@ -318,7 +315,7 @@ def make_data(C, mode):
 
 
     if mode == "normal":
-        train_x_dir, train_y_dir = make_data_from_distribution(C)
+        train_x_dir, train_y_dir = make_data_from_distribution(C, storage)
 
     C.set_train_dir(train_x_dir, train_y_dir)
     cwd = Path.cwd()
@@ -345,6 +342,7 @@ if __name__ == "__main__":
     mean = 5
     std = 2
     resolution = 256
+    target_format = 'onehot' # 'index' stores uint8 class-index truths and trains with the sparse loss
 
     dp_list = ["dig.mu2e.CeEndpoint.MDC2018b.001002_00000011.art",\
                 "dig.mu2e.CeEndpoint.MDC2018b.001002_00000012.art",\
@@ -358,6 +356,7 @@ if __name__ == "__main__":
     C.set_distribution(mean, std)
     C.set_window(window)
     C.set_resolution(resolution)
+    C.set_target_format(target_format)
 
     start = timeit.default_timer()
     make_data(C, mode)
@@ -61,10 +61,13 @@ def photographic_train(C):
     # setup loss
     weights = C.weights
 
-    cce = categorical_focal_loss(alpha=weights, gamma=2)
-
-    # setup metric
-    ca = top2_categorical_accuracy
+    # class-index truths need the sparse loss and metric
+    if getattr(C, 'target_format', 'onehot') == 'index':
+        cce = sparse_categorical_focal_loss(alpha=weights, gamma=2)
+        ca = sparse_top2_categorical_accuracy
+    else:
+        cce = categorical_focal_loss(alpha=weights, gamma=2)
+        ca = top2_categorical_accuracy
 
     # setup optimizer
     lr_schedule = tf.keras.optimizers.schedules.ExponentialDecay(
@@ -76,10 +79,10 @@ def photographic_train(C):
     # setup callback
     CsvCallback = tf.keras.callbacks.CSVLogger(str(record_file), separator=",", append=False)
 
-    earlyStopCallback = tf.keras.callbacks.EarlyStopping(monitor='val_top2_categorical_accuracy', patience=10)
+    earlyStopCallback = tf.keras.callbacks.EarlyStopping(monitor='val_'+ca.__name__, patience=10)
 
     ModelCallback = tf.keras.callbacks.ModelCheckpoint(model_weights_file,\
-                        monitor='val_top2_categorical_accuracy', verbose=1,\
+                        monitor='val_'+ca.__name__, verbose=1,\
                         save_weights_only=True,\
                         save_best_only=True, mode='auto', save_freq='epoch')
 
@@ -93,14 +96,18 @@ def photographic_train(C):
 
 
 
-    train_generator = Generator(C.X_train_dir, C.Y_train_dir, batch_size=1)
-    val_generator = Generator(C.X_val_dir, C.Y_val_dir, batch_size=1)
+    train_generator = Generator(C.X_train_dir, C.Y_train_dir, batch_size=1, workers=4, depth=8)
+    val_generator = Generator(C.X_val_dir, C.Y_val_dir, batch_size=1, workers=2)
 
+    # the generators shuffle themselves every epoch; batches must be requested
+    # in order for the read-ahead to hit
     model.fit(x=train_generator,\
-            shuffle=True,\
+            shuffle=False,\
             validation_data=val_generator,\
             callbacks = [CsvCallback,earlyStopCallback, ModelCallback, tensorboard_callback],\
             epochs=150)
+    pinfo(f"Training loader: {train_generator.prefetcher.stats()}")
+    pinfo(f"Validation loader: {val_generator.prefetcher.stats()}")
     model.save(model_weights_file)
 
     pcheck_point('Finished Training')
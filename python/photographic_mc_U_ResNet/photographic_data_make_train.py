@@ -23,7 +23,8 @@ from PIL import Image
 util_dir = Path.cwd().parent.joinpath('Utility')
 sys.path.insert(1, str(util_dir))
 from Configuration import extractor_config
-from Abstract import binning_objects
+from Abstract import bin_indices
+from Raster import density_raster
 from Database import *
 from Information import *
 
@@ -145,9 +146,8 @@ def make_data_from_distribution(track_dir, mean, std, windowNum, resolution):
             y_bins = [-810, bbox[2], bbox[3], 810]
 
             # get position tuples in the bounding box
-            pos_selected_by_x = binning_objects(mcs_pos_flatten, xs_flatten, x_bins)[2]
-            pos_selected_by_y = binning_objects(mcs_pos_flatten, ys_flatten, y_bins)[2]
-            selected_mcs_pos = list(set(pos_selected_by_x).intersection(pos_selected_by_y))
+            in_bbox = (bin_indices(xs_flatten, x_bins)==2) & (bin_indices(ys_flatten, y_bins)==2)
+            selected_mcs_pos = list(set( pos for pos, inside in zip(mcs_pos_flatten, in_bbox) if inside ))
             selected_mcs_x = [ x for [x,y,z] in selected_mcs_pos ]
             sorted_selected_mcs_x = deepcopy(selected_mcs_x)
             sorted_selected_mcs_x.sort()
@@ -186,42 +186,21 @@ def make_data_from_distribution(track_dir, mean, std, windowNum, resolution):
 
             ### fill the density in the blank photo and truth
             # first index is row
-            bins_by_row = binning_objects(selected_mcs_pos, selected_mcs_y, ybins)[1:]
-
-            for row, bin in enumerate(bins_by_row):
-                x_bin_flatten = [ x for (x,y,z) in bin]
-                squares_by_column = binning_objects(bin, x_bin_flatten, xbins)[1:]
-                for col, square in enumerate(squares_by_column):
-                    density = len(square)#number density
-                    input_photo[ypixel-row-1][col] = density
-                    if density != 0 :
-                        has_major = False
-                        for pos in square:
-                            if pos in mcs_pos[i]:
-                                has_major = True
-                                break
-                        if has_major == True:
-                            output_truth[ypixel-row-1][col] = is_major
-                        else:
-                            output_truth[ypixel-row-1][col] = is_bg
+            selected_xys = np.array([ (x,y) for (x,y,z) in selected_mcs_pos ])
+            density = density_raster(selected_xys[:,0], selected_xys[:,1],\
+                                            xbins, ybins, shape=input_photo.shape)[0]
+            major_pos = set(mcs_pos[i])
+            majors = np.array([ pos in major_pos for pos in selected_mcs_pos ])
+            major_density = density_raster(selected_xys[majors,0], selected_xys[majors,1],\
+                                            xbins, ybins, shape=input_photo.shape)[0]
+            input_photo[:] = density
+            output_truth[density!=0] = is_bg
+            output_truth[major_density!=0] = is_major
 
             if len(np.where(input_photo!=0)[0]) == 0:
-                pdebug(bins_by_row)
-                ptcl_found = False
-                for row, bin in enumerate(bins_by_row):
-                    x_bin_flatten = [ x for (x,y,z) in bin]
-                    squares_by_column = binning_objects(bin, x_bin_flatten, xbins)[1:]
-                    for square in squares_by_column:
-                        if len(square)!= 0:
-                            ptcl_found = True
-                            break
-                    if ptcl_found:
-                        pdebug(squares_by_column,f'{799-row}th row')
-                    elif len(bin)!=0 :
-                        pdebug(bin,'bin')
-                        pdebug(x_bin_flatten, 'xbin_flatten')
-                        pdebug(xbins, 'xbins')
-                        pdebug(binning_objects(bin, x_bin_flatten, xbins))
+                pdebug(selected_mcs_pos, 'selected positions')
+                pdebug(xbins, 'xbins')
+                pdebug(ybins, 'ybins')
                 pdebug('Empty input photo!')
                 sys.exit()
 